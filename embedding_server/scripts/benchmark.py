@@ -0,0 +1,433 @@
+"""Script to benchmark search, inserts, startup and the HTTP API.
+
+Synthetic corpora of clustered random vectors are written to binary databases
+in a scratch directory, and every query is embedded by a seeded local fake of
+the embedding API, so runs are reproducible and need no network access. For
+each corpus size the script measures setup() time and memory, the latency of
+find_similar_embeddings, insert throughput, and the throughput and latency of
+/similarity and /insert served in-process. With an index, the recall of its
+results against an exact scan is reported too. The results are printed as
+JSON; pass an earlier output as --baseline to print the change of every metric.
+
+    python scripts/benchmark.py --rows 10000 100000 --output bench.json
+    python scripts/benchmark.py --rows 10000 100000 --baseline bench.json
+    python scripts/benchmark.py --rows 100000 --index pca --components 96 --rerank 10
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import platform
+import resource
+import tempfile
+import time
+import tracemalloc
+from collections.abc import Awaitable, Callable, Iterator
+from pathlib import Path
+from typing import Any, cast
+
+import httpx
+import numpy as np
+import numpy.typing as npt
+import pandas as pd
+from embedding_server.gibson.database import EMBEDDING_DIMENSIONS, text_id
+from embedding_server.gibson.embedding import AsyncEmbeddingService
+from embedding_server.gibson.fake import FakeEmbeddingTransport, fake_embedding
+from embedding_server.gibson.storage import BinaryStorage
+from embedding_server.search import INDEX_TYPES, SearchEmbeddingService
+from embedding_server.similarity import normalize, top_k_indices
+
+logger = logging.getLogger(__name__)
+
+# Rows generated and written to the scratch database at once.
+CHUNK_ROWS = 50_000
+# Tenants the synthetic rows are spread over, for filtered searches.
+TENANTS = 10
+
+
+def _synthetic_chunks(
+    rows: int, seed: int
+) -> Iterator[tuple[pd.DataFrame, npt.NDArray[np.float32]]]:
+    """Generates a clustered corpus in chunks.
+
+    Args:
+        rows: The number of rows.
+        seed: Seeds the cluster centers and the noise around them.
+
+    Yields:
+        The records and vectors of consecutive rows.
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((max(16, rows // 1000), EMBEDDING_DIMENSIONS))
+    for start in range(0, rows, CHUNK_ROWS):
+        count = min(CHUNK_ROWS, rows - start)
+        labels = rng.integers(len(centers), size=count)
+        noise = rng.standard_normal((count, EMBEDDING_DIMENSIONS))
+        vectors = (centers[labels] + 0.5 * noise).astype(np.float32)
+        texts = [f"synthetic row {i}" for i in range(start, start + count)]
+        records = pd.DataFrame(
+            {
+                "ID": [text_id(text) for text in texts],
+                "Text": texts,
+                "Metadata": [{"tenant": f"t{i % TENANTS}"} for i in range(count)],
+            }
+        )
+        yield records, vectors
+
+
+def build_corpus(path: Path, rows: int, seed: int) -> None:
+    """Writes a synthetic corpus to a binary database.
+
+    Args:
+        path: The directory of the database.
+        rows: The number of rows.
+        seed: Seeds the generated vectors.
+    """
+    storage = BinaryStorage(path, EMBEDDING_DIMENSIONS)
+    storage.remove()
+    for i, (records, vectors) in enumerate(_synthetic_chunks(rows, seed)):
+        if i == 0:
+            storage.save(records, vectors)
+        else:
+            storage.append(records, vectors)
+
+
+def summarize(seconds: list[float]) -> dict[str, float]:
+    """Summarizes latency samples in milliseconds."""
+    samples = np.asarray(seconds) * 1000
+    return {
+        "mean_ms": float(samples.mean()),
+        "p50_ms": float(np.percentile(samples, 50)),
+        "p90_ms": float(np.percentile(samples, 90)),
+        "p99_ms": float(np.percentile(samples, 99)),
+        "max_ms": float(samples.max()),
+    }
+
+
+async def _timed(
+    call: Callable[..., Awaitable[Any]], *args: Any, **kwargs: Any
+) -> float:
+    """Returns the seconds an awaited call takes."""
+    started = time.perf_counter()
+    await call(*args, **kwargs)
+    return time.perf_counter() - started
+
+
+async def bench_setup(
+    path: Path, embedding_service: AsyncEmbeddingService, **options: Any
+) -> tuple[SearchEmbeddingService, dict[str, float]]:
+    """Measures how long loading a database takes and the memory it holds.
+
+    A first setup trains and saves the index when one is configured, so the
+    measured setups load it like a restarted server would. Memory is traced
+    in a separate setup, as tracing slows allocations down.
+
+    Returns:
+        The loaded service and its startup metrics.
+    """
+
+    def open_service() -> SearchEmbeddingService:
+        return SearchEmbeddingService(
+            path, embedding_service=embedding_service, **options
+        )
+
+    service = open_service()
+    first_setup = await _timed(service.setup)
+    service.save_index()
+
+    tracemalloc.start()
+    await open_service().setup()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    service = open_service()
+    setup = await _timed(service.setup)
+    return service, {
+        "first_setup_seconds": first_setup,
+        "setup_seconds": setup,
+        "setup_peak_bytes": float(peak),
+        "resident_bytes": float(current),
+    }
+
+
+async def bench_search(
+    service: SearchEmbeddingService, queries: int, top_k: int
+) -> dict[str, Any]:
+    """Measures the latency of sequential unfiltered and filtered searches."""
+    await service.find_similar_embeddings("warm up", top_k=top_k)
+    search = service.find_similar_embeddings
+    plain = [await _timed(search, f"query {i}", top_k=top_k) for i in range(queries)]
+    filtered = [
+        await _timed(
+            search, f"query {i}", top_k=top_k, filters={"tenant": f"t{i % TENANTS}"}
+        )
+        for i in range(queries)
+    ]
+    return {"search": summarize(plain), "filtered_search": summarize(filtered)}
+
+
+def exact_neighbours(
+    service: SearchEmbeddingService, queries: npt.NDArray[np.float32], top_k: int
+) -> list[set[str]]:
+    """Finds the IDs of the top_k rows of each query by an exact scan.
+
+    Rows are scored in chunks, keeping the best of each, so memory stays
+    bounded for large corpora.
+    """
+    snapshot = service.snapshot()
+    scores: list[npt.NDArray[np.float32]] = []
+    rows: list[npt.NDArray[np.intp]] = []
+    offset = 0
+    for segment in snapshot.segments:
+        for start in range(0, len(segment), CHUNK_ROWS):
+            similarities = queries @ normalize(segment[start : start + CHUNK_ROWS]).T
+            best = top_k_indices(similarities, top_k)
+            scores.append(np.take_along_axis(similarities, best, axis=1))
+            rows.append(best + offset + start)
+        offset += len(segment)
+    best = top_k_indices(np.concatenate(scores, axis=1), top_k)
+    ids = snapshot.records.ids
+    return [
+        {ids[row] for row in query_rows}
+        for query_rows in np.take_along_axis(np.concatenate(rows, axis=1), best, axis=1)
+    ]
+
+
+async def bench_recall(
+    service: SearchEmbeddingService, queries: int, top_k: int, seed: int
+) -> float:
+    """Measures the share of the exact top_k rows that searches return."""
+    texts = [f"query {i}" for i in range(queries)]
+    expected = exact_neighbours(
+        service, normalize([fake_embedding(text, seed) for text in texts]), top_k
+    )
+    found = 0
+    for text, neighbours in zip(texts, expected, strict=True):
+        matches = await service.find_similar(text, top_k)
+        found += len(neighbours & {match.id for match in matches})
+    return found / (top_k * queries)
+
+
+async def bench_insert(
+    service: SearchEmbeddingService, inserts: int, seed: int
+) -> dict[str, float]:
+    """Measures rows inserted per second one at a time and in one batch.
+
+    Embeddings are computed beforehand so only the database is measured.
+    """
+    texts = [f"benchmark insert {i}" for i in range(2 * inserts)]
+    embeddings = [fake_embedding(text, seed) for text in texts]
+    single = 0.0
+    for text, embedding in zip(texts[:inserts], embeddings[:inserts], strict=True):
+        single += await _timed(service.insert, text=text, embeddings=embedding)
+    batch = await _timed(
+        service.insert_many, texts=texts[inserts:], embeddings=embeddings[inserts:]
+    )
+    return {
+        "single_rows_per_second": inserts / single,
+        "batch_rows_per_second": inserts / batch,
+    }
+
+
+async def _load(
+    client: httpx.AsyncClient,
+    requests: int,
+    concurrency: int,
+    payload: Callable[[int], dict[str, Any]],
+    url: str,
+) -> dict[str, float]:
+    """Sends requests from concurrent clients and measures throughput and latency."""
+    latencies: list[float] = []
+    pending = iter(range(requests))
+
+    async def run_client() -> None:
+        for i in pending:
+            started = time.perf_counter()
+            response = await client.post(url, json=payload(i))
+            latencies.append(time.perf_counter() - started)
+            response.raise_for_status()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(run_client() for _ in range(concurrency)))
+    return {"qps": requests / (time.perf_counter() - started), **summarize(latencies)}
+
+
+async def bench_http(
+    service: SearchEmbeddingService,
+    embedding_service: AsyncEmbeddingService,
+    requests: int,
+    concurrency: int,
+    top_k: int,
+) -> dict[str, Any]:
+    """Measures /similarity and /insert served in-process by the ASGI app.
+
+    Requests skip sockets and the server process, so the numbers cover the
+    routing, validation, embedding and search work of the application.
+    """
+    from embedding_server import server
+
+    previous = server.db, server.es
+    server.db = service
+    server.es = embedding_service
+    # httpx types the app with plain dicts, which FastAPI's signature does not match.
+    transport = httpx.ASGITransport(app=cast(Any, server.app))
+    try:
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://bench"
+        ) as client:
+            similarity = await _load(
+                client,
+                requests,
+                concurrency,
+                lambda i: {"text": f"http query {i}", "top_k": top_k},
+                "/similarity",
+            )
+            insert = await _load(
+                client,
+                requests,
+                concurrency,
+                lambda i: {"text": f"http insert {i}"},
+                "/insert",
+            )
+    finally:
+        server.db, server.es = previous
+    return {"http_similarity": similarity, "http_insert": insert}
+
+
+async def bench_corpus(
+    directory: Path, rows: int, args: argparse.Namespace
+) -> dict[str, Any]:
+    """Runs every benchmark against one synthetic corpus."""
+    path = directory / f"corpus-{rows}"
+    started = time.perf_counter()
+    build_corpus(path, rows, args.seed)
+    logger.info(f"Built {rows} rows in {time.perf_counter() - started:.1f}s.")
+
+    embedding_service = AsyncEmbeddingService(
+        flaky_network_rate=0,
+        batch_window=0.001,
+        transport=FakeEmbeddingTransport(args.seed, latency=args.embed_latency),
+    )
+    async with embedding_service:
+        service, setup = await bench_setup(
+            path,
+            embedding_service,
+            index=args.index,
+            mmap=args.mmap,
+            rerank=args.rerank,
+            components=args.components,
+        )
+        results: dict[str, Any] = {"rows": rows, "setup": setup}
+        results.update(await bench_search(service, args.queries, args.top_k))
+        logger.info(f"Searched {rows} rows: {results['search']}")
+        if args.index != "exact":
+            results["search"]["recall"] = await bench_recall(
+                service, args.queries, args.top_k, args.seed
+            )
+        results["insert"] = await bench_insert(service, args.inserts, args.seed)
+        if args.requests:
+            results.update(
+                await bench_http(
+                    service,
+                    embedding_service,
+                    args.requests,
+                    args.concurrency,
+                    args.top_k,
+                )
+            )
+    return results
+
+
+def _flatten(results: dict[str, Any]) -> dict[str, float]:
+    """Maps the dotted name of every metric, prefixed by its corpus, to its value."""
+    metrics: dict[str, float] = {}
+
+    def visit(prefix: str, value: Any) -> None:
+        if isinstance(value, dict):
+            for key, item in value.items():
+                visit(f"{prefix}.{key}", item)
+        elif isinstance(value, int | float):
+            metrics[prefix] = float(value)
+
+    for corpus in results["corpora"]:
+        visit(f"rows={corpus['rows']}", corpus)
+    return metrics
+
+
+def compare(baseline: dict[str, Any], results: dict[str, Any]) -> None:
+    """Prints the relative change of every metric present in both runs."""
+    before = _flatten(baseline)
+    for name, value in _flatten(results).items():
+        if before.get(name):
+            change = (value - before[name]) / before[name] * 100
+            print(f"{name:60} {before[name]:14.3f} {value:14.3f} {change:+8.1f}%")
+
+
+async def main(args: argparse.Namespace) -> None:
+    """Benchmarks every corpus size and writes or compares the results."""
+    results: dict[str, Any] = {
+        "environment": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "machine": platform.machine(),
+        },
+        "options": {
+            key: value for key, value in vars(args).items() if key != "baseline"
+        },
+        "corpora": [],
+    }
+    with tempfile.TemporaryDirectory() as directory:
+        for rows in args.rows:
+            results["corpora"].append(await bench_corpus(Path(directory), rows, args))
+    results["max_resident_kilobytes"] = resource.getrusage(
+        resource.RUSAGE_SELF
+    ).ru_maxrss
+
+    report = json.dumps(results, indent=2, default=str)
+    if args.output:
+        args.output.write_text(report)
+    print(report)
+    if args.baseline:
+        compare(json.loads(args.baseline.read_text()), results)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, nargs="+", default=[10_000])
+    parser.add_argument("--index", choices=INDEX_TYPES, default="exact")
+    parser.add_argument(
+        "--mmap", action="store_true", help="Memory-map the vector files."
+    )
+    parser.add_argument(
+        "--rerank",
+        type=int,
+        default=4,
+        help="Candidates per result a quantized index re-scores exactly.",
+    )
+    parser.add_argument(
+        "--components",
+        type=int,
+        default=96,
+        help="Dimensions kept by the pca index.",
+    )
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--inserts", type=int, default=200)
+    parser.add_argument(
+        "--requests", type=int, default=500, help="HTTP requests, 0 to skip."
+    )
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument(
+        "--embed-latency",
+        type=float,
+        default=0.0,
+        help="Seconds each fake embedding request takes.",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=Path, help="Write the results as JSON.")
+    parser.add_argument(
+        "--baseline", type=Path, help="An earlier output to compare against."
+    )
+    asyncio.run(main(parser.parse_args()))
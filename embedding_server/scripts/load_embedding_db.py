@@ -1,62 +1,180 @@
-"""Script to refresh embeddings.json with new data from sentences.txt."""
+"""Script to refresh embeddings.json with new data from sentences.txt.
 
+Sentences are streamed from the input file, deduplicated by their hash,
+embedded in batches by a bounded number of concurrent requests and committed
+to a binary database one chunk at a time, with a single write per chunk. The
+database is exported to embeddings.json at the end.
+"""
+
+import argparse
 import asyncio
 import logging
+import time
+from collections.abc import Iterator
 from pathlib import Path
 from typing import Final
 
-from embedding_server.gibson.database import AsyncEmbeddingDatabase
+from embedding_server.gibson.database import (
+    EMBEDDING_DIMENSIONS,
+    AsyncEmbeddingDatabase,
+    text_id,
+)
 from embedding_server.gibson.embedding import AsyncEmbeddingService
+from embedding_server.gibson.storage import BinaryStorage
+from embedding_server.utils import get_embeddings
 
 logger = logging.getLogger(__name__)
 
 root_path: Final[Path] = Path(__file__).parent.parent
 
 embedding_database_file = root_path / "src" / "data" / "embeddings.json"
-Path.unlink(embedding_database_file, missing_ok=True)
-logger.info(
-    "Existing embeddings.json file removed.",
-    extra={"file_path": str(embedding_database_file)},
-)
+# Rows are appended to a binary store while loading and exported to JSON at the end.
+embedding_database_dir = root_path / "src" / "data" / "embeddings"
 
 
-async def _process_data(
-    text: str,
+def _read_chunks(path: Path, chunk_size: int, seen: set[str]) -> Iterator[list[str]]:
+    """Stream unique, non-empty lines of a text file in chunks.
+
+    Args:
+        path: The file to read.
+        chunk_size: The number of texts per chunk.
+        seen: IDs of texts to skip; the IDs of yielded texts are added to it.
+
+    Yields:
+        Lists of at most chunk_size texts.
+    """
+    chunk: list[str] = []
+    with Path.open(path, encoding="utf-8") as file:
+        for line in file:
+            text = line.rstrip("\n")
+            id_value = text_id(text)
+            if not text or id_value in seen:
+                continue
+            seen.add(id_value)
+            chunk.append(text)
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+    if chunk:
+        yield chunk
+
+
+async def _embed_batch(
+    texts: list[str],
     embedding_service: AsyncEmbeddingService,
-    database: AsyncEmbeddingDatabase,
-) -> None:
-    """Embed a single text string and insert it into the database.
+    semaphore: asyncio.Semaphore,
+) -> list[list[float]]:
+    """Embed a batch of texts once a concurrency slot is free.
 
     Args:
-        text: The text to be embedded.
-        embedding_service: The embedding service to use for embedding the text.
-        database: The database to insert the embedded text into.
+        texts: The texts to embed.
+        embedding_service: The embedding service to use for embedding the texts.
+        semaphore: Bounds the number of concurrent upstream requests.
+
+    Returns:
+        One embedding per text.
     """
-    logger.debug(f"Processing text: {text}")
-    embedding = await embedding_service.embed(text=text)
-    await database.insert(text=text, embeddings=embedding)
-    logger.debug("Text inserted into database.", extra={"text": text})
+    async with semaphore:
+        return await get_embeddings(embedding_service, texts)
 
 
-async def main() -> None:
-    """Refresh the cached embedding database with new data from `data/sentences.txt`."""
-    logger.info("Starting to refresh the embedding database from sentences.txt.")
-    embedding_service = AsyncEmbeddingService()
-    logger.debug("Embedding service setup completed.")
+async def _process_chunk(
+    texts: list[str],
+    embedding_service: AsyncEmbeddingService,
+    database: AsyncEmbeddingDatabase,
+    semaphore: asyncio.Semaphore,
+    batch_size: int,
+) -> int:
+    """Embed a chunk of texts concurrently and insert it into the database.
+
+    Args:
+        texts: The texts to embed.
+        embedding_service: The embedding service to use for embedding the texts.
+        database: The database to insert the embedded texts into.
+        semaphore: Bounds the number of concurrent upstream requests.
+        batch_size: The number of texts per upstream request.
+
+    Returns:
+        The number of inserted texts.
+    """
+    batches = [texts[i : i + batch_size] for i in range(0, len(texts), batch_size)]
+    results = await asyncio.gather(
+        *(_embed_batch(batch, embedding_service, semaphore) for batch in batches)
+    )
+    embeddings = [embedding for result in results for embedding in result]
+    return await database.insert_many(texts=texts, embeddings=embeddings)
+
+
+async def main(
+    input_path: Path = root_path / "data" / "sentences.txt",
+    batch_size: int = 32,
+    concurrency: int = 4,
+    chunk_size: int = 1024,
+    append: bool = False,
+) -> None:
+    """Refresh the cached embedding database with new data from `data/sentences.txt`.
 
-    database = AsyncEmbeddingDatabase(cache_path=embedding_database_file)
+    Args:
+        input_path: The file with one sentence per line.
+        batch_size: The number of texts per upstream request.
+        concurrency: The most upstream requests in flight at once.
+        chunk_size: The number of texts committed to the database at once.
+        append: Whether to keep the existing database and add to it.
+    """
+    logger.info("Starting to refresh the embedding database from sentences.txt.")
+    if not append:
+        BinaryStorage(embedding_database_dir, EMBEDDING_DIMENSIONS).remove()
+        logger.info(
+            "Existing binary embedding store removed.",
+            extra={"file_path": str(embedding_database_dir)},
+        )
+
+    database = AsyncEmbeddingDatabase(cache_path=embedding_database_dir)
     await database.setup()
     logger.debug("Database setup completed.")
 
-    with Path.open(root_path / "data" / "sentences.txt") as file:
-        data = file.read().splitlines()
-    logger.info("Data loaded from sentences.txt.", extra={"data_length": len(data)})
-
-    for text in data:
-        await _process_data(text, embedding_service, database)
+    semaphore = asyncio.Semaphore(concurrency)
+    seen = set(database.records.ids)
+    inserted = 0
+    started = time.perf_counter()
+    async with AsyncEmbeddingService() as embedding_service:
+        logger.debug("Embedding service setup completed.")
+        for chunk in _read_chunks(input_path, chunk_size, seen):
+            inserted += await _process_chunk(
+                chunk, embedding_service, database, semaphore, batch_size
+            )
+            elapsed = time.perf_counter() - started
+            logger.info(
+                f"Inserted {inserted} texts ({inserted / elapsed:.1f} texts/s).",
+                extra={"inserted": inserted, "elapsed": elapsed},
+            )
 
     logger.info("All data processed and inserted into database.")
 
+    await database.export_json(embedding_database_file)
+    logger.info(
+        "Database exported to embeddings.json.",
+        extra={"file_path": str(embedding_database_file)},
+    )
+
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--input", type=Path, default=root_path / "data" / "sentences.txt")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--chunk-size", type=int, default=1024)
+    parser.add_argument(
+        "--append", action="store_true", help="Add to the existing database."
+    )
+    args = parser.parse_args()
+    asyncio.run(
+        main(
+            input_path=args.input,
+            batch_size=args.batch_size,
+            concurrency=args.concurrency,
+            chunk_size=args.chunk_size,
+            append=args.append,
+        )
+    )
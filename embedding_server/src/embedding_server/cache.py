@@ -0,0 +1,229 @@
+"""Content-addressed cache of text embeddings."""
+
+import logging
+import os
+import time
+from collections import OrderedDict
+from collections.abc import Hashable
+from pathlib import Path
+from typing import Generic, TypeVar
+
+import numpy as np
+import numpy.typing as npt
+
+from embedding_server.gibson.database import AsyncEmbeddingDatabase, text_id
+
+logging.basicConfig(level=logging.DEBUG if "DEBUG" in os.environ else logging.INFO)
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class EmbeddingCache:
+    """Caches embeddings by the SHA-256 of their text, the database row ID.
+
+    Lookups try an in-process LRU first, then an optional on-disk tier and
+    finally the rows of an optional database. Hits from the slower tiers are
+    promoted into the LRU.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 10_000,
+        ttl: float | None = 24 * 60 * 60,
+        directory: Path | None = None,
+        database: AsyncEmbeddingDatabase | None = None,
+    ):
+        """Initializes the embedding cache.
+
+        Args:
+            max_entries: The most embeddings held in memory.
+            ttl: Seconds an entry stays valid, or None to keep entries forever.
+            directory: The directory of the on-disk tier, disabled if None.
+            database: A database whose stored rows are consulted on misses.
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.directory = directory
+        self.database = database
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[str, tuple[float, npt.NDArray[np.float32]]] = (
+            OrderedDict()
+        )
+        if directory is not None:
+            directory.mkdir(parents=True, exist_ok=True)
+
+    def __len__(self) -> int:
+        """Returns the number of embeddings held in memory."""
+        return len(self._entries)
+
+    @property
+    def hit_rate(self) -> float:
+        """The fraction of lookups answered by the cache."""
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def get(self, text: str) -> list[float] | None:
+        """Looks up the embedding of a text.
+
+        Args:
+            text: The text to look up.
+
+        Returns:
+            The cached embedding, or None on a miss.
+        """
+        key = text_id(text)
+        vector = self._get_memory(key)
+        if vector is None:
+            vector = self._get_disk(key)
+            if vector is None and self.database is not None:
+                embedding = self.database.embedding_for_id(key)
+                if embedding is not None:
+                    vector = np.asarray(embedding, dtype=np.float32)
+            if vector is not None:
+                self._put_memory(key, vector)
+
+        if vector is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        embedding_list: list[float] = vector.tolist()
+        return embedding_list
+
+    def put(self, text: str, embedding: list[float]) -> None:
+        """Stores the embedding of a text in every tier of the cache.
+
+        Args:
+            text: The embedded text.
+            embedding: The embedding of the text.
+        """
+        key = text_id(text)
+        vector = np.asarray(embedding, dtype=np.float32)
+        self._put_memory(key, vector)
+        if self.directory is not None:
+            self._put_disk(key, vector)
+
+    def clear(self) -> None:
+        """Drops every embedding held in memory."""
+        self._entries.clear()
+
+    def _expired(self, stored_at: float, now: float) -> bool:
+        """Returns whether an entry stored at the given time has expired."""
+        return self.ttl is not None and now - stored_at > self.ttl
+
+    def _get_memory(self, key: str) -> npt.NDArray[np.float32] | None:
+        """Looks up the LRU tier, dropping the entry if it has expired."""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        stored_at, vector = entry
+        if self._expired(stored_at, time.monotonic()):
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return vector
+
+    def _put_memory(self, key: str, vector: npt.NDArray[np.float32]) -> None:
+        """Adds an entry to the LRU tier, evicting the least recently used."""
+        self._entries[key] = (time.monotonic(), vector)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _disk_path(self, key: str) -> Path:
+        """Returns the file holding an entry of the on-disk tier."""
+        assert self.directory is not None
+        return self.directory / key[:2] / f"{key}.f32"
+
+    def _get_disk(self, key: str) -> npt.NDArray[np.float32] | None:
+        """Looks up the on-disk tier, deleting the file if it has expired."""
+        if self.directory is None:
+            return None
+        path = self._disk_path(key)
+        try:
+            if self._expired(path.stat().st_mtime, time.time()):
+                Path.unlink(path, missing_ok=True)
+                return None
+            return np.fromfile(path, dtype="<f4").astype(np.float32, copy=False)
+        except FileNotFoundError:
+            return None
+
+    def _put_disk(self, key: str, vector: npt.NDArray[np.float32]) -> None:
+        """Writes an entry of the on-disk tier atomically."""
+        path = self._disk_path(key)
+        path.parent.mkdir(exist_ok=True)
+        temporary = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        temporary.write_bytes(vector.astype("<f4").tobytes())
+        temporary.replace(path)
+
+
+class ResultCache(Generic[T]):
+    """An LRU of search results, valid until the database changes.
+
+    Every entry is tagged with the database generation it was computed at.
+    Entries of an older generation are dropped when they are looked up, so
+    inserts invalidate the cache without scanning it.
+    """
+
+    def __init__(self, max_entries: int = 1024):
+        """Initializes the result cache.
+
+        Args:
+            max_entries: The most results held.
+        """
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[Hashable, tuple[int, T]] = OrderedDict()
+
+    def __len__(self) -> int:
+        """Returns the number of cached results."""
+        return len(self._entries)
+
+    @property
+    def hit_rate(self) -> float:
+        """The fraction of lookups answered by the cache."""
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def get(self, key: Hashable, generation: int) -> T | None:
+        """Looks up a result.
+
+        Args:
+            key: Identifies the search.
+            generation: The current generation of the database.
+
+        Returns:
+            The result, or None if it is missing or was computed for an older
+            generation.
+        """
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] != generation:
+            del self._entries[key]
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    def put(self, key: Hashable, generation: int, result: T) -> None:
+        """Stores a result, evicting the least recently used beyond the limit.
+
+        Args:
+            key: Identifies the search.
+            generation: The database generation the result was computed at.
+            result: The result.
+        """
+        if self.max_entries <= 0:
+            return
+        self._entries[key] = (generation, result)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        """Drops every result."""
+        self._entries.clear()
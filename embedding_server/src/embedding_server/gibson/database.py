@@ -1,63 +1,643 @@
 """Provides an asynchronous API interaction for a simulated remote vector database."""
 
+import asyncio
 import hashlib
 import logging
 import os
+from collections.abc import AsyncIterator, Callable
+from concurrent.futures import Executor
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from enum import StrEnum
 from pathlib import Path
+from typing import Any, TypeVar
 
+import numpy as np
+import numpy.typing as npt
 import pandas as pd
 
+from embedding_server.gibson.metadata import Metadata, validate_metadata
+from embedding_server.gibson.records import EmbeddingRecord, RecordStore
+from embedding_server.gibson.storage import (
+    BinaryStorage,
+    EmbeddingStorage,
+    open_storage,
+    read_json_rows,
+    write_json_rows,
+)
+from embedding_server.gibson.vectors import VectorStore
+from embedding_server.metrics import registry
+
 logging.basicConfig(level=logging.DEBUG if "DEBUG" in os.environ else logging.INFO)
 logger = logging.getLogger(__name__)
 
+EMBEDDING_DIMENSIONS = 768
+
+load_seconds = registry.histogram(
+    "database_load_seconds", "Time to read the stored rows at startup."
+)
+write_seconds = registry.histogram(
+    "database_write_seconds", "Time to write rows to storage."
+)
+
+T = TypeVar("T")
+
+
+@dataclass(frozen=True)
+class Snapshot:
+    """A read-only view of the rows of a database at one point in time."""
+
+    records: RecordStore
+    segments: list[npt.NDArray[np.float32]]
+
+    def __len__(self) -> int:
+        """Returns the number of rows in the view."""
+        return sum(len(segment) for segment in self.segments)
+
+
+class InsertStatus(StrEnum):
+    """The outcome of one entry of a bulk insert."""
+
+    INSERTED = "inserted"
+    # The text was already stored.
+    EXISTS = "exists"
+    # The text appeared earlier in the same batch.
+    DUPLICATE = "duplicate"
+    # The embedding has the wrong dimensions or the metadata is not scalar.
+    INVALID = "invalid"
+
+
+def text_id(text: str) -> str:
+    """Returns the content-addressed ID of a text, the SHA-256 of its UTF-8 bytes.
+
+    Args:
+        text: The text to identify.
+
+    Returns:
+        The hex digest used as the row ID.
+    """
+    return hashlib.sha256(text.encode()).hexdigest()
+
 
 class AsyncEmbeddingDatabase:
-    """Provides asynchronous API interaction for a simulated remote vector database."""
+    """Provides asynchronous API interaction for a simulated remote vector database.
+
+    Loading, saving and other blocking pandas/NumPy work runs on an executor so
+    the event loop keeps serving requests. Writes are coalesced: rows inserted
+    while a flush is running are persisted together by the next flush.
+
+    A `shared` database lets several processes, such as uvicorn workers, serve
+    one binary database. Preferably memory-mapped, so the vectors are held once
+    in the OS page cache. Writes take a lock across processes and are persisted
+    before it is released, and `refresh` picks up the rows other processes
+    wrote once their write counter moves.
 
-    def __init__(self, cache_path: Path):
+    Deleted and replaced rows stay in place as tombstones, masked out of
+    searches, until the dead fraction of the rows passes `compact_threshold`
+    and a background compaction rewrites storage with the live rows only.
+    """
+
+    def __init__(
+        self,
+        cache_path: Path,
+        storage: EmbeddingStorage | None = None,
+        mmap: bool = False,
+        executor: Executor | None = None,
+        flush_delay: float = 0.0,
+        shared: bool = False,
+        compact_threshold: float | None = 0.2,
+        wal: bool = False,
+    ):
         """Initializes the asynchronous embedding database.
 
         Args:
             cache_path: Path to the cache file where the database is stored.
+            storage: The storage backend, chosen from cache_path if not given.
+            mmap: Whether a binary backend should memory-map its vector file.
+            executor: Runs blocking work, the event loop's default executor if None.
+            flush_delay: Seconds a flush waits for more inserts to join it.
+            shared: Whether other processes read and write the same database.
+            compact_threshold: The fraction of deleted rows that starts a
+                background compaction, or None to only compact on request.
+                Shared databases are never compacted, as other processes read
+                them at stored offsets that compaction would invalidate.
+            wal: Whether a directory database uses the write-ahead log backend,
+                which syncs every write and checkpoints the log in the
+                background, rather than the binary one.
+
+        Raises:
+            ValueError: If a shared database does not use the binary backend.
         """
         self.cache_path = cache_path
+        self.storage = storage or open_storage(
+            cache_path, EMBEDDING_DIMENSIONS, mmap=mmap, wal=wal
+        )
+        if shared and not isinstance(self.storage, BinaryStorage):
+            raise ValueError("A shared database needs the binary storage backend")
+        self.shared = shared
+        # The storage generation whose rows this process has read.
+        self._storage_generation = 0
+        # Bumped whenever rows change, so results computed earlier can be
+        # recognized as stale.
+        self.generation = 0
+        self.executor = executor
+        self.flush_delay = flush_delay
+        self.compact_threshold = compact_threshold
+        self._persisted = 0
+        # The tombstones of the record store that have been persisted.
+        self._persisted_tombstones = 0
+        self._flush_task: asyncio.Task[None] | None = None
+        self._compaction: asyncio.Task[None] | None = None
+        # Serializes writers; readers work on snapshots and never take it.
+        self._write_lock = asyncio.Lock()
 
     async def setup(self) -> None:
         """Asynchronously initializes the database structure."""
         logger.info("Initializing AsyncEmbeddingDatabase, please wait.")
 
-        if self.cache_path and self.cache_path.exists():
-            self.data = await self._read_json(self.cache_path)
-        else:
-            self.data = pd.DataFrame(columns=["ID", "Text", "Embeddings"])
-        await self._save()
+        if self.shared:
+            await self._run(self._shared_storage.acquire)
+        try:
+            if self.storage.exists():
+                self.records, base = await self._run(self._load)
+                self.vectors = VectorStore(EMBEDDING_DIMENSIONS, base=base)
+            else:
+                self.records = RecordStore()
+                self.vectors = VectorStore(EMBEDDING_DIMENSIONS)
+                await self._save()
+            self.generation += 1
+            if self.shared:
+                self._storage_generation = self._shared_storage.generation()
+        finally:
+            if self.shared:
+                self._shared_storage.release()
+        self._persisted = len(self.records)
+        self._persisted_tombstones = len(self.records.tombstones)
+        self._rewrite_if_due()
         logger.info("AsyncEmbeddingDatabase is ready.")
 
-    @staticmethod
-    async def _read_json(path: Path) -> pd.DataFrame:
-        """Asynchronously reads JSON file.
+    @property
+    def _shared_storage(self) -> BinaryStorage:
+        """The storage backend of a shared database."""
+        assert isinstance(self.storage, BinaryStorage)
+        return self.storage
+
+    @asynccontextmanager
+    async def _writing(self) -> AsyncIterator[None]:
+        """Holds the write lock, across processes for a shared database.
+
+        A shared database first reads the rows other processes wrote, and
+        persists the rows and tombstones added under the lock before it is
+        released.
+        """
+        async with self._write_lock:
+            if not self.shared:
+                yield
+                return
+            storage = self._shared_storage
+            await self._run(storage.acquire)
+            try:
+                await self._read_new_rows()
+                start = len(self.records)
+                yield
+                stop = len(self.records)
+                tombstones = self.records.tombstones[self._persisted_tombstones :]
+                if stop > start or tombstones:
+                    await self._run(self._write, start, stop, True, tombstones)
+                    self._persisted = stop
+                    self._persisted_tombstones = len(self.records.tombstones)
+                    self._storage_generation = storage.generation()
+            finally:
+                storage.release()
+
+    async def refresh(self) -> bool:
+        """Picks up the rows other processes added to a shared database.
+
+        Only reads the memory-mapped write counter when nothing changed. If a
+        local write is in progress it reads the new rows itself, so the call
+        returns without waiting.
+
+        Returns:
+            Whether new rows were read.
+        """
+        if (
+            not self.shared
+            or self._write_lock.locked()
+            or self._shared_storage.generation() == self._storage_generation
+        ):
+            return False
+        async with self._write_lock:
+            return await self._read_new_rows()
+
+    async def _read_new_rows(self) -> bool:
+        """Reads rows and tombstones other processes wrote.
+
+        Callers hold the write lock. Tombstones are read first, so the rows
+        they refer to are among the rows read next.
+        """
+        storage = self._shared_storage
+        generation = storage.generation()
+        if generation == self._storage_generation:
+            return False
+        tombstones = await self._run(storage.read_tombstones)
+        records, vectors = await self._run(storage.read_new_rows, len(self.records))
+        self.records.append(
+            [str(id_value) for id_value in records["ID"]],
+            [str(text) for text in records["Text"]],
+            list(records["Metadata"]),
+        )
+        if storage.mmap:
+            self.vectors.rebase(vectors)
+        else:
+            self.vectors.append(vectors)
+        self.records.delete_rows(tombstones)
+        self._persisted = len(self.records)
+        self._persisted_tombstones = len(self.records.tombstones)
+        self._storage_generation = generation
+        self.generation += 1
+        logger.debug(
+            "Read rows written by other processes.",
+            extra={"rows": len(records), "tombstones": len(tombstones)},
+        )
+        return len(records) > 0 or len(tombstones) > 0
+
+    async def _run(self, func: Callable[..., T], *args: Any) -> T:
+        """Runs a blocking function on the executor.
+
+        Args:
+            func: The function to run.
+            *args: The positional arguments of the function.
+
+        Returns:
+            The result of the function.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, func, *args)
+
+    def _load(self) -> tuple[RecordStore, npt.NDArray[np.float32]]:
+        """Reads the stored rows and tombstones and indexes their records."""
+        with load_seconds.time():
+            records, vectors = self.storage.load()
+            store = RecordStore.from_frame(records)
+            store.delete_rows(self.storage.read_tombstones())
+            return store, vectors
+
+    @property
+    def data(self) -> pd.DataFrame:
+        """A copy of the live ID/Text/Metadata records as a frame, in row order."""
+        if not self.records.dead:
+            return self.records.to_frame()
+        return self.records.take(self.records.live_rows())
+
+    def __len__(self) -> int:
+        """Returns the number of stored rows, deleted ones excluded."""
+        return self.records.live
+
+    def contains(self, id_value: str) -> bool:
+        """Returns whether a row is stored.
 
         Args:
-            path: The path to the JSON file to read.
+            id_value: The ID of the row, `text_id` of its text.
 
         Returns:
-            A pandas DataFrame containing the database data.
+            True if there is a row with that ID.
         """
-        logger.debug(f"Reading JSON file from {path}.")
-        return pd.read_json(path)
+        return id_value in self.records
+
+    def get(self, id_value: str) -> EmbeddingRecord | None:
+        """Looks up a row by ID.
+
+        Args:
+            id_value: The ID of the row, `text_id` of its text.
+
+        Returns:
+            The stored row, or None if there is no row with that ID.
+        """
+        row = self.records.row(id_value)
+        if row is None:
+            return None
+        return EmbeddingRecord(
+            id=id_value,
+            text=self.records.texts[row],
+            embedding=self.vectors.row(row).tolist(),
+            metadata=self.records.metadata[row],
+        )
 
     async def _save(self) -> None:
-        """Saves the database to JSON asynchronously."""
-        logger.info(f"Saving database to JSON at {self.cache_path=}.")
-        self.data.to_json(self.cache_path, index=False)
-        logger.debug("Database saved.")
+        """Saves the whole database through the storage backend."""
+        await self._run(self._write, 0, len(self.records), False)
+
+    def _write(
+        self, start: int, stop: int, append: bool, tombstones: list[int] | None = None
+    ) -> None:
+        """Writes rows to storage.
+
+        Args:
+            start: The first row to write.
+            stop: The row after the last one to write.
+            append: Whether to append the rows rather than replace the database
+                with the live rows before stop.
+            tombstones: The deleted rows to record after appending.
+        """
+        with write_seconds.time():
+            if not append:
+                self.storage.save(*self._live_rows(stop))
+                return
+            if stop > start:
+                self.storage.append(
+                    self.records.to_frame(start, stop),
+                    self.vectors.to_array(start, stop),
+                )
+            if tombstones:
+                self.storage.delete(np.asarray(tombstones, dtype=np.int64))
+
+    def _live_rows(self, stop: int) -> tuple[pd.DataFrame, npt.NDArray[np.float32]]:
+        """Copies the live rows before stop into records and a vector matrix."""
+        if not self.records.dead:
+            return self.records.to_frame(0, stop), self.vectors.to_array(0, stop)
+        rows = self.records.live_rows(stop)
+        return self.records.take(rows), self.vectors.take(rows)
+
+    async def _persist(self) -> None:
+        """Waits until every row and tombstone added so far has been persisted.
+
+        Callers share the running flush, and rows added while it runs are
+        written together by the next one, so concurrent inserts pay for one
+        storage write instead of one each.
+        """
+        target, tombstones = len(self.records), len(self.records.tombstones)
+        while self._persisted < target or self._persisted_tombstones < tombstones:
+            if self._flush_task is None:
+                self._flush_task = asyncio.create_task(self._flush())
+            await asyncio.shield(self._flush_task)
+
+    async def _flush(self) -> None:
+        """Writes the rows and tombstones added since the last flush on the executor."""
+        try:
+            if self.flush_delay:
+                await asyncio.sleep(self.flush_delay)
+            start, stop = self._persisted, len(self.records)
+            tombstones = self.records.tombstones[self._persisted_tombstones :]
+            if self.storage.append_only:
+                await self._run(self._write, start, stop, True, tombstones)
+            else:
+                await self._run(self._write, 0, stop, False)
+            self._persisted = stop
+            self._persisted_tombstones += len(tombstones)
+            logger.debug(
+                "Database flushed.",
+                extra={"rows": stop - start, "tombstones": len(tombstones)},
+            )
+        finally:
+            self._flush_task = None
+
+    def _add_rows(
+        self,
+        ids: list[str],
+        texts: list[str],
+        vectors: npt.NDArray[np.float32],
+        metadata: list[Metadata],
+    ) -> None:
+        """Adds rows in memory. Callers hold the write lock.
+
+        Args:
+            ids: The IDs of the new rows.
+            texts: The texts of the new rows, aligned with ids.
+            vectors: The new embeddings, aligned with ids.
+            metadata: The metadata of the new rows, aligned with ids.
+        """
+        self.records.append(ids, texts, metadata)
+        self.vectors.append(vectors)
+        self.generation += 1
+
+    async def _commit(self) -> None:
+        """Persists the rows added in memory, after the write lock is released."""
+        await self._persist()
+        self._rewrite_if_due()
+
+    async def _add_new_rows(
+        self,
+        ids: list[str],
+        texts: list[str],
+        vectors: npt.NDArray[np.float32],
+        metadata: list[Metadata],
+    ) -> list[InsertStatus]:
+        """Adds and commits the rows whose IDs are not stored or repeated yet.
+
+        Args:
+            ids: The IDs of the candidate rows.
+            texts: The texts of the candidate rows, aligned with ids.
+            vectors: The embeddings of the candidate rows, aligned with ids.
+            metadata: The metadata of the candidate rows, aligned with ids.
+
+        Returns:
+            The status of every candidate row.
+        """
+        async with self._writing():
+            statuses = self._statuses(ids)
+            new_positions = [
+                position
+                for position, status in enumerate(statuses)
+                if status is InsertStatus.INSERTED
+            ]
+            self._add_rows(
+                [ids[position] for position in new_positions],
+                [texts[position] for position in new_positions],
+                vectors[new_positions],
+                [metadata[position] for position in new_positions],
+            )
+        await self._commit()
+        return statuses
+
+    def snapshot(self) -> Snapshot:
+        """Returns a consistent view of the rows stored so far.
+
+        Rows are only ever appended, so the view stays valid while writers add
+        more rows and reads never need to wait for the write lock.
+        """
+        return Snapshot(self.records, self.vectors.segments())
+
+    def _statuses(self, ids: list[str]) -> list[InsertStatus]:
+        """Checks candidate IDs against the ID index and each other in one pass.
+
+        Only the first occurrence of each ID that is not stored yet is inserted.
+        """
+        seen: set[str] = set()
+        statuses = []
+        for id_value in ids:
+            if id_value in self.records:
+                statuses.append(InsertStatus.EXISTS)
+            elif id_value in seen:
+                statuses.append(InsertStatus.DUPLICATE)
+            else:
+                seen.add(id_value)
+                statuses.append(InsertStatus.INSERTED)
+        return statuses
+
+    async def import_json(self, path: Path) -> int:
+        """Adds the rows of a JSON export that are not in the database yet.
+
+        Args:
+            path: The JSON file to import.
+
+        Returns:
+            The number of imported rows.
+        """
+        records, vectors = await self._run(read_json_rows, path, EMBEDDING_DIMENSIONS)
+        statuses = await self._add_new_rows(
+            [str(id_value) for id_value in records["ID"]],
+            [str(text) for text in records["Text"]],
+            vectors,
+            [validate_metadata(fields) for fields in records["Metadata"]],
+        )
+        count = statuses.count(InsertStatus.INSERTED)
+        logger.info("Imported JSON rows.", extra={"path": str(path), "rows": count})
+        return count
+
+    async def insert_many(
+        self,
+        texts: list[str],
+        embeddings: list[list[float]],
+        metadata: list[Metadata] | None = None,
+    ) -> int:
+        """Inserts many entries with a single storage write.
+
+        Texts that are already stored, or repeated within the call, are skipped.
+
+        Args:
+            texts: The input texts corresponding to the embeddings.
+            embeddings: The embeddings, one per text.
+            metadata: The metadata fields of each entry, none if not given.
+
+        Returns:
+            The number of inserted entries.
+
+        Raises:
+            ValueError: If the number of embeddings or metadata does not match
+                the texts, any embedding has incorrect dimensions, or any
+                metadata is not a mapping of fields to scalar values.
+        """
+        if len(texts) != len(embeddings):
+            raise ValueError("Expected one embedding per text")
+        if metadata is None:
+            metadata = [{} for _ in texts]
+        elif len(metadata) != len(texts):
+            raise ValueError("Expected one metadata mapping per text")
+        metadata = [validate_metadata(fields) for fields in metadata]
+        try:
+            vectors = np.asarray(embeddings, dtype=np.float32).reshape(
+                len(texts), EMBEDDING_DIMENSIONS
+            )
+        except ValueError as error:
+            raise ValueError(
+                f"Embeddings must have {EMBEDDING_DIMENSIONS} dimensions"
+            ) from error
+
+        statuses = await self._add_new_rows(
+            [text_id(text) for text in texts], texts, vectors, metadata
+        )
+        count = statuses.count(InsertStatus.INSERTED)
+        logger.debug("New entries inserted into the database.", extra={"rows": count})
+        return count
+
+    async def insert_batch(
+        self,
+        texts: list[str],
+        embeddings: list[list[float]],
+        metadata: list[Metadata] | None = None,
+    ) -> list[InsertStatus]:
+        """Inserts the valid new entries of a batch with a single storage write.
+
+        Unlike `insert_many`, invalid entries do not fail the whole batch: each
+        entry gets its own status.
+
+        Args:
+            texts: The input texts corresponding to the embeddings.
+            embeddings: The embeddings, one per text.
+            metadata: The metadata fields of each entry, none if not given.
+
+        Returns:
+            The status of every entry, in order.
+
+        Raises:
+            ValueError: If the number of embeddings or metadata does not match
+                the texts.
+        """
+        if len(texts) != len(embeddings):
+            raise ValueError("Expected one embedding per text")
+        if metadata is None:
+            metadata = [{} for _ in texts]
+        elif len(metadata) != len(texts):
+            raise ValueError("Expected one metadata mapping per text")
+        lengths = np.fromiter(
+            (len(embedding) for embedding in embeddings), dtype=np.int64, count=len(texts)
+        )
+        valid = lengths == EMBEDDING_DIMENSIONS
+        for position, fields in enumerate(metadata):
+            try:
+                validate_metadata(fields)
+            except ValueError:
+                valid[position] = False
+        positions = np.flatnonzero(valid)
+        vectors = np.asarray(
+            [embeddings[position] for position in positions], dtype=np.float32
+        ).reshape(len(positions), EMBEDDING_DIMENSIONS)
+
+        valid_statuses = iter(
+            await self._add_new_rows(
+                [text_id(texts[position]) for position in positions],
+                [texts[position] for position in positions],
+                vectors,
+                [metadata[position] for position in positions],
+            )
+        )
+        statuses = [
+            next(valid_statuses) if is_valid else InsertStatus.INVALID
+            for is_valid in valid
+        ]
+        logger.debug(
+            "Batch inserted into the database.",
+            extra={"rows": statuses.count(InsertStatus.INSERTED)},
+        )
+        return statuses
+
+    async def export_json(self, path: Path) -> None:
+        """Writes the live rows of the database in the JSON export format.
+
+        Args:
+            path: The destination JSON file.
+        """
+        stop = len(self.records)
+        await self._run(self._export, path, stop)
 
-    async def insert(self, text: str, embeddings: list[float]) -> None:
+    def _export(self, path: Path, stop: int) -> None:
+        """Writes the live rows before stop in the JSON export format."""
+        write_json_rows(path, *self._live_rows(stop))
+
+    def embedding_for_id(self, id_value: str) -> list[float] | None:
+        """Returns the stored embedding of a row.
+
+        Args:
+            id_value: The ID of the row.
+
+        Returns:
+            The embedding, or None if there is no row with that ID.
+        """
+        row = self.records.row(id_value)
+        if row is None:
+            return None
+        embedding: list[float] = self.vectors.row(row).tolist()
+        return embedding
+
+    async def insert(
+        self, text: str, embeddings: list[float], metadata: Metadata | None = None
+    ) -> None:
         """Inserts a new entry into the database asynchronously.
 
         Args:
             text: The input text corresponding to the embeddings.
             embeddings: The embeddings list to be stored.
+            metadata: Fields to filter searches on, such as a tenant or language.
 
         Raises:
             ValueError: If an entry with the generated id already exists or if the embeddings have incorrect dimensions.
@@ -66,25 +646,187 @@ class AsyncEmbeddingDatabase:
             "Attempting to insert new entry into the database.", extra={"text": text}
         )
 
-        id_value = hashlib.sha256(text.encode()).hexdigest()
+        id_value = text_id(text)
+        metadata = self._validate_entry(id_value, embeddings, metadata)
 
-        if self.data["ID"].isin([id_value]).any():
-            logger.error(
-                "Attempted to insert an entry with an existing id.",
-                extra={"id": id_value},
+        async with self._writing():
+            if id_value in self.records:
+                logger.error(
+                    "Attempted to insert an entry with an existing id.",
+                    extra={"id": id_value},
+                )
+                raise ValueError(
+                    f"Entry with id={id_value} already exists in the database"
+                )
+            self._add_rows(
+                [id_value],
+                [text],
+                np.asarray([embeddings], dtype=np.float32),
+                [metadata],
             )
-            raise ValueError(f"Entry with id={id_value} already exists in the database")
+        await self._commit()
+        logger.debug("New entry inserted into the database.", extra={"id": id_value})
+
+    @staticmethod
+    def _validate_entry(
+        id_value: str, embeddings: list[float], metadata: Metadata | None
+    ) -> Metadata:
+        """Checks the embeddings and metadata of a single entry.
 
-        if len(embeddings) != 768:
+        Returns:
+            The validated metadata, empty if None.
+
+        Raises:
+            ValueError: If the embeddings have incorrect dimensions or the
+                metadata is not a mapping of fields to scalar values.
+        """
+        if len(embeddings) != EMBEDDING_DIMENSIONS:
             logger.error(
                 "Attempted to insert embeddings with incorrect dimensions.",
                 extra={"id": id_value, "dimensions": len(embeddings)},
             )
-            raise ValueError("Embeddings must have 768 dimensions")
+            raise ValueError(
+                f"Embeddings must have {EMBEDDING_DIMENSIONS} dimensions"
+            )
+        return validate_metadata(metadata if metadata is not None else {})
+
+    async def upsert(
+        self, text: str, embeddings: list[float], metadata: Metadata | None = None
+    ) -> bool:
+        """Inserts an entry, replacing the stored row of the same text if any.
+
+        The new row is appended and the stored one becomes a tombstone, so
+        re-embedding a text costs the same storage write as inserting it.
+
+        Args:
+            text: The input text corresponding to the embeddings.
+            embeddings: The embeddings list to be stored.
+            metadata: Fields to filter searches on, such as a tenant or language.
+
+        Returns:
+            Whether a stored row was replaced.
+
+        Raises:
+            ValueError: If the embeddings have incorrect dimensions or the
+                metadata is not a mapping of fields to scalar values.
+        """
+        id_value = text_id(text)
+        metadata = self._validate_entry(id_value, embeddings, metadata)
+        async with self._writing():
+            replaced = id_value in self.records
+            self._add_rows(
+                [id_value],
+                [text],
+                np.asarray([embeddings], dtype=np.float32),
+                [metadata],
+            )
+        await self._commit()
+        logger.debug("Entry upserted.", extra={"id": id_value, "replaced": replaced})
+        return replaced
+
+    async def delete(self, id_value: str) -> bool:
+        """Deletes a row.
+
+        The row is masked out of searches at once and its storage is reclaimed
+        by the next compaction.
+
+        Args:
+            id_value: The ID of the row, `text_id` of its text.
+
+        Returns:
+            Whether a row with that ID was stored.
+        """
+        async with self._writing():
+            row = self.records.delete(id_value)
+            if row is not None:
+                self.generation += 1
+        if row is None:
+            return False
+        await self._commit()
+        logger.debug("Entry deleted.", extra={"id": id_value})
+        return True
+
+    def _rewrite_if_due(self) -> None:
+        """Starts a background compaction or checkpoint once one is due."""
+        if self.shared or self._compaction is not None:
+            return
+        checkpoint = self.storage.needs_checkpoint()
+        if not checkpoint and (
+            self.compact_threshold is None
+            or self.records.dead <= self.compact_threshold * len(self.records)
+        ):
+            return
+        self._compaction = asyncio.create_task(self._rewrite_in_background(checkpoint))
+
+    async def _rewrite_in_background(self, checkpoint: bool) -> None:
+        """Runs a compaction or checkpoint, logging rather than raising its errors."""
+        try:
+            await self._rewrite(checkpoint)
+        except Exception:
+            logger.exception("Background compaction or checkpoint failed.")
+        finally:
+            self._compaction = None
+
+    async def compact(self) -> int:
+        """Rewrites storage with the live rows only and reclaims the dead ones.
+
+        Writers wait for the compaction, while searches keep running on
+        snapshots of the old rows until the compacted rows are swapped in.
+
+        Returns:
+            The number of rows reclaimed.
+
+        Raises:
+            ValueError: If the database is shared.
+        """
+        return await self._rewrite(False)
 
-        self.data = self.data._append(
-            {"ID": id_value, "Text": text, "Embeddings": embeddings}, ignore_index=True
+    async def checkpoint(self) -> int:
+        """Saves the live rows in full, compacting them if any are dead.
+
+        A write-ahead logged database writes a new snapshot and starts an
+        empty log, so recovery no longer replays the writes made so far.
+
+        Returns:
+            The number of rows reclaimed.
+
+        Raises:
+            ValueError: If the database is shared.
+        """
+        return await self._rewrite(True)
+
+    async def _rewrite(self, full: bool) -> int:
+        """Compacts the rows, or saves them in full if none are dead and full is set."""
+        if self.shared:
+            raise ValueError("A shared database cannot be compacted")
+        async with self._writing():
+            await self._persist()
+            dead = self.records.dead
+            if not dead:
+                if full:
+                    await self._run(self._write, 0, len(self.records), False)
+                return 0
+            records, vectors = await self._run(self._compacted)
+            await self._swap_rows(records, vectors)
+        logger.info("Database compacted.", extra={"rows": len(records), "dead": dead})
+        return dead
+
+    def _compacted(self) -> tuple[RecordStore, VectorStore]:
+        """Saves the live rows in place of the stored ones and reads them back."""
+        frame, vectors = self._live_rows(len(self.records))
+        self.storage.save(frame, vectors)
+        if isinstance(self.storage, BinaryStorage) and self.storage.mmap:
+            _, vectors = self.storage.load()
+        return RecordStore.from_frame(frame), VectorStore(
+            EMBEDDING_DIMENSIONS, base=vectors
         )
 
-        await self._save()
-        logger.debug("New entry inserted into the database.", extra={"id": id_value})
+    async def _swap_rows(self, records: RecordStore, vectors: VectorStore) -> None:
+        """Replaces the rows held in memory with compacted ones.
+
+        Callers hold the write lock and every row has been persisted.
+        """
+        self.records, self.vectors = records, vectors
+        self._persisted = len(records)
+        self._persisted_tombstones = 0
+        self.generation += 1
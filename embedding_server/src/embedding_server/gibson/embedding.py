@@ -5,27 +5,117 @@ import logging
 import os
 import random
 from http import HTTPStatus
+from typing import Any
 
-from httpx import AsyncClient
+from httpx import AsyncBaseTransport, AsyncClient, Limits, Timeout
 
-from embedding_server.gibson.exceptions import FlakyNetworkException
+from embedding_server.gibson.exceptions import FlakyNetworkException, UpstreamError
+from embedding_server.metrics import registry
+from embedding_server.retry import (
+    CircuitBreaker,
+    LatencyTracker,
+    RetryPolicy,
+    is_transient,
+)
 
 logging.basicConfig(level=logging.DEBUG if "DEBUG" in os.environ else logging.INFO)
 logger = logging.getLogger(__name__)
 
+embed_seconds = registry.histogram(
+    "embedding_embed_seconds", "Time to embed one text, including batching."
+)
+request_seconds = registry.histogram(
+    "embedding_request_seconds", "Time of upstream embedding requests."
+)
+request_texts = registry.counter(
+    "embedding_request_texts_total", "Texts sent to the upstream embedding API."
+)
 
-class AsyncEmbeddingService:
-    """Provides asynchronous API interaction for a simulated remote embedding service."""
 
-    def __init__(self, flaky_network_rate: float = 0.0025):
+class AsyncEmbeddingService:
+    """Provides asynchronous API interaction for a simulated remote embedding service.
+
+    When `batch_window` is positive, concurrent `embed` calls are coalesced: texts
+    arriving within the window, up to `max_batch_size` of them, are sent upstream
+    in a single request and the results are handed back to each caller.
+
+    Requests go through one long-lived pooled HTTP client that keeps connections
+    alive between calls. It is created on first use and released by `aclose`,
+    or by leaving the service's `async with` block.
+    """
+
+    def __init__(
+        self,
+        flaky_network_rate: float = 0.0025,
+        batch_window: float = 0.0,
+        max_batch_size: int = 32,
+        max_connections: int = 20,
+        max_keepalive_connections: int = 10,
+        keepalive_expiry: float = 30.0,
+        timeout: float = 10.0,
+        transport: AsyncBaseTransport | None = None,
+        retry_policy: RetryPolicy | None = None,
+        circuit_breaker: CircuitBreaker | None = None,
+    ):
         """Initializes the asynchronous embedding service.
 
         Args:
             flaky_network_rate: The probability of encountering a network error.
+            batch_window: Seconds to wait for more texts before sending a batch.
+            max_batch_size: The most texts sent upstream in a single request.
+            max_connections: The most concurrent connections to the API.
+            max_keepalive_connections: The most idle connections kept open.
+            keepalive_expiry: Seconds an idle connection is kept open.
+            timeout: Seconds to wait for the API before giving up on a request.
+            transport: The HTTP transport, replaceable for testing.
+            retry_policy: How callers of `get_embedding` and `get_embeddings`
+                retry and hedge calls, the default policy if None.
+            circuit_breaker: Fails those calls fast while the API is down. It
+                counts the outcome of every upstream request once, however
+                many coalesced callers the request serves.
         """
         self.embedding_model = None
         self.flaky_network_rate = flaky_network_rate
         self.api_key = os.environ.get("HF_API_KEY")
+        self.batch_window = batch_window
+        self.max_batch_size = max_batch_size
+        self._pending: list[tuple[str, asyncio.Future[list[float]]]] = []
+        self._flush_handle: asyncio.TimerHandle | None = None
+        self._batches: set[asyncio.Task[None]] = set()
+        self._limits = Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self._timeout = Timeout(timeout)
+        self._transport = transport
+        self._client: AsyncClient | None = None
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.circuit_breaker = circuit_breaker or CircuitBreaker()
+        self.latencies = LatencyTracker()
+
+    @property
+    def client(self) -> AsyncClient:
+        """The pooled HTTP client, created on first use."""
+        if self._client is None or self._client.is_closed:
+            self._client = AsyncClient(
+                limits=self._limits, timeout=self._timeout, transport=self._transport
+            )
+        return self._client
+
+    async def aclose(self) -> None:
+        """Closes the pooled HTTP client and its connections."""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def __aenter__(self) -> "AsyncEmbeddingService":
+        """Returns the service for use in an `async with` block."""
+        return self
+
+    async def __aexit__(self, *args: object) -> None:
+        """Closes the service at the end of an `async with` block."""
+        await self.aclose()
 
     async def embed(self, text: str) -> list[float]:
         """Generates an embedding for the given text asynchronously.
@@ -39,11 +129,85 @@ class AsyncEmbeddingService:
         Raises:
             FlakyNetworkException: If a simulated network error occurs.
         """
+        with embed_seconds.time():
+            if self.batch_window <= 0:
+                return (await self.embed_batch([text]))[0]
+
+            loop = asyncio.get_running_loop()
+            future: asyncio.Future[list[float]] = loop.create_future()
+            self._pending.append((text, future))
+            if len(self._pending) >= self.max_batch_size:
+                self._flush()
+            elif self._flush_handle is None:
+                self._flush_handle = loop.call_later(self.batch_window, self._flush)
+            return await future
+
+    def _flush(self) -> None:
+        """Sends the pending texts upstream as one batch."""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.create_task(self._run_batch(batch))
+            self._batches.add(task)
+            task.add_done_callback(self._batches.discard)
+
+    async def _run_batch(
+        self, batch: list[tuple[str, asyncio.Future[list[float]]]]
+    ) -> None:
+        """Embeds a coalesced batch and resolves the waiting callers.
+
+        Args:
+            batch: The pending texts and the futures of their callers.
+        """
+        logger.debug("Sending coalesced embedding batch.", extra={"size": len(batch)})
+        texts = list(dict.fromkeys(text for text, _ in batch))
+        try:
+            embeddings = dict(zip(texts, await self.embed_batch(texts), strict=True))
+        except Exception as error:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(error)
+            return
+        for text, future in batch:
+            if not future.done():
+                future.set_result(embeddings[text])
+
+    async def embed_batch(self, texts: list[str]) -> list[list[float]]:
+        """Generates embeddings for several texts with a single upstream request.
+
+        Args:
+            texts: The input texts to generate embeddings for.
+
+        Returns:
+            One embedding per text, in the same order.
+
+        Raises:
+            FlakyNetworkException: If a simulated network error occurs.
+            UpstreamError: If the API answers with an error status.
+        """
+        if not texts:
+            return []
+        try:
+            embeddings = await self._request(texts)
+        except Exception as error:
+            if is_transient(error):
+                self.circuit_breaker.record_failure()
+            else:
+                # The API answered, so it is not down.
+                self.circuit_breaker.record_success()
+            raise
+        self.circuit_breaker.record_success()
+        return embeddings
+
+    async def _request(self, texts: list[str]) -> list[list[float]]:
+        """Sends one upstream request for the embeddings of texts."""
         if random.random() < float(self.flaky_network_rate):
             logger.error("Flaky network error occurred during embedding.")
             raise FlakyNetworkException("Network error occurred")
 
-        logger.debug("Generating embeddings.", extra={"text": text})
+        logger.debug("Generating embeddings.", extra={"count": len(texts)})
 
         url = "https://api-inference.huggingface.co/pipeline/feature-extraction/sentence-transformers/all-mpnet-base-v2"
 
@@ -51,28 +215,31 @@ class AsyncEmbeddingService:
             "Authorization": f"Bearer {self.api_key}",
         }
 
-        async with AsyncClient() as client:
-            response = await client.post(
-                url=url, headers=headers, json={"inputs": [text]}
+        request_texts.inc(amount=len(texts))
+        with request_seconds.time():
+            response = await self.client.post(
+                url=url, headers=headers, json={"inputs": texts}
             )
 
-        # HuggingFace may need to initialize
-        if response.status_code == HTTPStatus.SERVICE_UNAVAILABLE:
-            logger.warning(
-                "HuggingFace Embedding API is initializing, waiting for it to be ready."
-            )
-            await asyncio.sleep(response.json()["estimated_time"] + 1)
-            response = await client.post(
-                url=url, headers=headers, json={"inputs": [text]}
-            )
+            # HuggingFace may need to initialize
+            if response.status_code == HTTPStatus.SERVICE_UNAVAILABLE:
+                logger.warning(
+                    "HuggingFace Embedding API is initializing, waiting for it to be ready."
+                )
+                await asyncio.sleep(response.json()["estimated_time"] + 1)
+                response = await self.client.post(
+                    url=url, headers=headers, json={"inputs": texts}
+                )
 
         if response.status_code != HTTPStatus.OK:
-            raise Exception(f"Request failed with status code {response.status_code}")
+            raise UpstreamError(response.status_code)
 
-        data = response.json()[0]
+        data: list[Any] = response.json()
 
-        if not isinstance(data, list) or not all(
-            isinstance(item, float) for item in data
+        if len(data) != len(texts) or not all(
+            isinstance(embedding, list)
+            and all(isinstance(item, float) for item in embedding)
+            for embedding in data
         ):
             raise ValueError(
                 "Expected a list of floats, but received a different type."
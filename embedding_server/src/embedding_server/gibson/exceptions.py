@@ -1,7 +1,43 @@
 """Custom exceptions for the package."""
 
 
-class FlakyNetworkException(Exception):
+class EmbeddingServiceError(Exception):
+    """Base class of the errors of calls to the embedding API."""
+
+    pass
+
+
+class FlakyNetworkException(EmbeddingServiceError):
     """Exception raised for errors in the network connectivity."""
 
     pass
+
+
+class UpstreamError(EmbeddingServiceError):
+    """Exception raised when the embedding API answers with an error status."""
+
+    def __init__(self, status_code: int):
+        """Initializes the error.
+
+        Args:
+            status_code: The HTTP status of the response.
+        """
+        super().__init__(f"Request failed with status code {status_code}")
+        self.status_code = status_code
+
+    @property
+    def retryable(self) -> bool:
+        """Whether the status signals a transient failure worth retrying."""
+        return self.status_code >= 500 or self.status_code == 429
+
+
+class DeadlineExceededError(EmbeddingServiceError):
+    """Exception raised when a call and its retries run out of time."""
+
+    pass
+
+
+class CircuitOpenError(EmbeddingServiceError):
+    """Exception raised instead of calling an embedding API that keeps failing."""
+
+    pass
@@ -0,0 +1,62 @@
+"""A deterministic local stand-in for the remote embedding API."""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+
+import httpx
+import numpy as np
+
+from embedding_server.gibson.database import EMBEDDING_DIMENSIONS
+
+logging.basicConfig(level=logging.DEBUG if "DEBUG" in os.environ else logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def fake_embedding(text: str, seed: int = 0) -> list[float]:
+    """Returns the embedding the fake API gives a text.
+
+    Args:
+        text: The text to embed.
+        seed: Selects one of many reproducible embeddings per text.
+
+    Returns:
+        A unit-length vector drawn from a generator seeded by the text hash.
+    """
+    digest = hashlib.sha256(text.encode()).digest()
+    rng = np.random.default_rng([int.from_bytes(digest[:8], "little"), seed])
+    vector = rng.standard_normal(EMBEDDING_DIMENSIONS)
+    embedding: list[float] = (vector / np.linalg.norm(vector)).tolist()
+    return embedding
+
+
+class FakeEmbeddingTransport(httpx.AsyncBaseTransport):
+    """Answers embedding requests locally with seeded random vectors.
+
+    Pass it as the `transport` of an `AsyncEmbeddingService`, created with a
+    `flaky_network_rate` of 0, to run without network access or an API key
+    while still exercising the pooled client and JSON handling.
+    """
+
+    def __init__(self, seed: int = 0, latency: float = 0.0):
+        """Initializes the fake API.
+
+        Args:
+            seed: Selects one of many reproducible embeddings per text.
+            latency: Seconds each request takes, simulating the network.
+        """
+        self.seed = seed
+        self.latency = latency
+        self.requests = 0
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        """Returns one embedding for every input text of the request."""
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        texts = json.loads(await request.aread())["inputs"]
+        return httpx.Response(
+            200, json=[fake_embedding(text, self.seed) for text in texts]
+        )
@@ -0,0 +1,112 @@
+"""Metadata fields of database rows and the index used to filter on them."""
+
+import json
+import logging
+import os
+from collections.abc import Iterable
+from typing import Any
+
+import numpy as np
+import numpy.typing as npt
+
+logging.basicConfig(level=logging.DEBUG if "DEBUG" in os.environ else logging.INFO)
+logger = logging.getLogger(__name__)
+
+MetadataValue = str | int | float | bool
+Metadata = dict[str, MetadataValue]
+# A filter maps fields to the value, or any of the values, a row must have.
+Filters = dict[str, MetadataValue | list[MetadataValue]]
+
+
+def validate_metadata(metadata: Any) -> Metadata:
+    """Checks metadata maps field names to scalar JSON values.
+
+    Args:
+        metadata: The metadata of a row.
+
+    Returns:
+        The metadata.
+
+    Raises:
+        ValueError: If the metadata is not a mapping of strings to strings,
+            numbers or booleans.
+    """
+    if not isinstance(metadata, dict) or not all(
+        isinstance(field, str) and isinstance(value, MetadataValue)
+        for field, value in metadata.items()
+    ):
+        raise ValueError("Metadata must map field names to strings, numbers or booleans")
+    return metadata
+
+
+def _value_key(value: MetadataValue) -> str:
+    """Returns the index key of a value, keeping e.g. `True` and `1` apart."""
+    return json.dumps(value)
+
+
+class MetadataIndex:
+    """The rows holding each value of each metadata field.
+
+    Every (field, value) pair keeps the sorted rows that hold it in an array
+    that grows by doubling. A filter is evaluated into a boolean mask over the
+    rows before the similarity scan, so filtered-out rows are never scored.
+    Building the mask costs time proportional to the matching rows, and the
+    index needs memory proportional to the stored fields rather than one dense
+    bitmap of every row per distinct value.
+    """
+
+    def __init__(self) -> None:
+        """Initializes an empty index."""
+        self._rows: dict[tuple[str, str], npt.NDArray[np.int64]] = {}
+        self._sizes: dict[tuple[str, str], int] = {}
+
+    def add(self, start: int, metadata: Iterable[Metadata]) -> None:
+        """Indexes the metadata of appended rows.
+
+        Args:
+            start: The row of the first metadata.
+            metadata: The metadata of consecutive rows.
+        """
+        for row, fields in enumerate(metadata, start):
+            for field, value in fields.items():
+                self._append((field, _value_key(value)), row)
+
+    def _append(self, key: tuple[str, str], row: int) -> None:
+        """Appends a row to one value, doubling its capacity when it is full."""
+        size = self._sizes.get(key, 0)
+        rows = self._rows.get(key)
+        if rows is None or size == len(rows):
+            grown = np.empty(max(2 * size, 16), dtype=np.int64)
+            if rows is not None:
+                grown[:size] = rows
+            self._rows[key] = rows = grown
+        rows[size] = row
+        self._sizes[key] = size + 1
+
+    def rows(self, field: str, value: MetadataValue) -> npt.NDArray[np.int64]:
+        """Returns the sorted rows whose field holds a value."""
+        key = (field, _value_key(value))
+        rows = self._rows.get(key)
+        if rows is None:
+            return np.empty(0, dtype=np.int64)
+        return rows[: self._sizes[key]]
+
+    def mask(self, filters: Filters, count: int) -> npt.NDArray[np.bool_]:
+        """Evaluates filters over the first rows.
+
+        Args:
+            filters: The value, or list of accepted values, of each field. A
+                row must match every field.
+            count: The number of rows to evaluate.
+
+        Returns:
+            One flag per row, set for the rows matching the filters.
+        """
+        mask = np.ones(count, dtype=np.bool_)
+        for field, accepted in filters.items():
+            field_mask = np.zeros(count, dtype=np.bool_)
+            for value in accepted if isinstance(accepted, list) else [accepted]:
+                rows = self.rows(field, value)
+                field_mask[rows[: np.searchsorted(rows, count)]] = True
+            mask &= field_mask
+        return mask
@@ -0,0 +1,224 @@
+"""In-memory records of an embedding database, indexed by ID."""
+
+import logging
+import os
+from collections.abc import Iterable
+from dataclasses import dataclass, field
+
+import numpy as np
+import numpy.typing as npt
+import pandas as pd
+
+from embedding_server.gibson.metadata import Filters, Metadata, MetadataIndex
+from embedding_server.gibson.storage import RECORD_COLUMNS
+
+logging.basicConfig(level=logging.DEBUG if "DEBUG" in os.environ else logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class EmbeddingRecord:
+    """A stored row of an embedding database."""
+
+    id: str
+    text: str
+    embedding: list[float]
+    metadata: Metadata = field(default_factory=dict)
+
+
+class RecordStore:
+    """The ID, text and metadata of every row, with a hash index from ID to row.
+
+    Rows are kept in insertion order in plain lists, so appending is amortized
+    O(1) and never copies the existing rows, and the index makes duplicate
+    checks and lookups by ID O(1) instead of a scan of the ID column. The
+    metadata is indexed by value for filtered searches.
+
+    Deleting a row leaves it in place as a tombstone: it is dropped from the
+    ID index and cleared in a boolean array of live rows, which searches use
+    as a mask. Appending a row with a stored ID supersedes the stored row the
+    same way. Compaction later copies the live rows into a new store.
+    """
+
+    def __init__(self) -> None:
+        """Initializes an empty record store."""
+        self.ids: list[str] = []
+        self.texts: list[str] = []
+        self.metadata: list[Metadata] = []
+        self.metadata_index = MetadataIndex()
+        self._rows: dict[str, int] = {}
+        # One flag per row with spare capacity that doubles when it is full.
+        self._alive = np.empty(0, dtype=np.bool_)
+        # The number of deleted or superseded rows.
+        self.dead = 0
+        # The rows deleted by ID, in order, for storage to persist.
+        self.tombstones: list[int] = []
+
+    @classmethod
+    def from_frame(cls, frame: pd.DataFrame) -> "RecordStore":
+        """Builds a record store from an ID/Text frame read from storage.
+
+        Args:
+            frame: The records, one per row.
+
+        Returns:
+            A record store holding the same rows in the same order.
+        """
+        store = cls()
+        store.append(
+            [str(id_value) for id_value in frame["ID"]],
+            [str(text) for text in frame["Text"]],
+            list(frame["Metadata"]),
+        )
+        return store
+
+    def __len__(self) -> int:
+        """Returns the number of rows, deleted ones included."""
+        return len(self.ids)
+
+    @property
+    def live(self) -> int:
+        """The number of rows that are not deleted."""
+        return len(self.ids) - self.dead
+
+    def __contains__(self, id_value: object) -> bool:
+        """Returns whether a live row with the given ID is stored."""
+        return id_value in self._rows
+
+    def row(self, id_value: str) -> int | None:
+        """Returns the position of the row with the given ID, or None."""
+        return self._rows.get(id_value)
+
+    def append(
+        self,
+        ids: Iterable[str],
+        texts: Iterable[str],
+        metadata: Iterable[Metadata] | None = None,
+    ) -> None:
+        """Adds rows to the end of the store.
+
+        Args:
+            ids: The IDs of the new rows, none of them stored yet.
+            texts: The texts of the new rows, aligned with ids.
+            metadata: The metadata of the new rows, aligned with ids, or None
+                for rows without metadata.
+        """
+        ids, texts = list(ids), list(texts)
+        metadata = list(metadata) if metadata is not None else [{} for _ in ids]
+        needed = len(self.ids) + len(ids)
+        if needed > len(self._alive):
+            grown = np.zeros(max(needed, 2 * len(self._alive), 16), dtype=np.bool_)
+            grown[: len(self.ids)] = self._alive[: len(self.ids)]
+            self._alive = grown
+        self._alive[len(self.ids) : needed] = True
+        self.metadata_index.add(len(self.ids), metadata)
+        for id_value, text, fields in zip(ids, texts, metadata, strict=True):
+            superseded = self._rows.get(id_value)
+            if superseded is not None:
+                self._kill(superseded)
+            self.ids.append(id_value)
+            self.texts.append(text)
+            self.metadata.append(fields)
+            self._rows[id_value] = len(self.ids) - 1
+
+    def _kill(self, row: int) -> None:
+        """Flags a live row as deleted."""
+        self._alive[row] = False
+        self.dead += 1
+
+    def delete(self, id_value: str) -> int | None:
+        """Deletes the live row with the given ID.
+
+        Args:
+            id_value: The ID of the row.
+
+        Returns:
+            The position of the deleted row, or None if no live row has the ID.
+        """
+        row = self._rows.pop(id_value, None)
+        if row is not None:
+            self._kill(row)
+            self.tombstones.append(row)
+        return row
+
+    def delete_rows(self, rows: Iterable[int]) -> None:
+        """Applies tombstones read from storage.
+
+        Rows that are deleted already, or not held, are skipped.
+
+        Args:
+            rows: The positions of the deleted rows.
+        """
+        for row in map(int, rows):
+            if row >= len(self.ids) or not self._alive[row]:
+                continue
+            self._kill(row)
+            self.tombstones.append(row)
+            if self._rows.get(self.ids[row]) == row:
+                del self._rows[self.ids[row]]
+
+    def live_mask(self, count: int) -> npt.NDArray[np.bool_] | None:
+        """Flags which of the first count rows are live.
+
+        Returns:
+            A read-only view with one flag per row, or None while no row has
+            been deleted, so searches of a store without tombstones skip masking.
+        """
+        if not self.dead:
+            return None
+        mask = self._alive[:count]
+        mask.flags.writeable = False
+        return mask
+
+    def live_rows(self, stop: int | None = None) -> npt.NDArray[np.intp]:
+        """Returns the positions of the live rows before stop, in order."""
+        return np.flatnonzero(self._alive[: len(self.ids) if stop is None else stop])
+
+    def mask(self, filters: Filters, count: int) -> npt.NDArray[np.bool_]:
+        """Flags the first count rows whose metadata matches filters.
+
+        Args:
+            filters: The value, or list of accepted values, of each field.
+            count: The number of rows to evaluate.
+
+        Returns:
+            One flag per row.
+        """
+        return self.metadata_index.mask(filters, count)
+
+    def to_frame(self, start: int = 0, stop: int | None = None) -> pd.DataFrame:
+        """Copies rows into an ID/Text/Metadata frame for storage.
+
+        Args:
+            start: The first row to copy.
+            stop: The row after the last one to copy, the end of the store if None.
+
+        Returns:
+            A frame with the rows from start to stop.
+        """
+        return pd.DataFrame(
+            {
+                "ID": self.ids[start:stop],
+                "Text": self.texts[start:stop],
+                "Metadata": self.metadata[start:stop],
+            },
+            columns=RECORD_COLUMNS,
+        )
+
+    def take(self, rows: npt.NDArray[np.intp]) -> pd.DataFrame:
+        """Copies the given rows into an ID/Text/Metadata frame for storage.
+
+        Args:
+            rows: The positions of the rows to copy, in the order wanted.
+
+        Returns:
+            A frame with one record per position.
+        """
+        return pd.DataFrame(
+            {
+                "ID": [self.ids[row] for row in rows],
+                "Text": [self.texts[row] for row in rows],
+                "Metadata": [self.metadata[row] for row in rows],
+            },
+            columns=RECORD_COLUMNS,
+        )
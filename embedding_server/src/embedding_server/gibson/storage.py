@@ -0,0 +1,800 @@
+"""Storage backends that persist the rows of an embedding database."""
+
+import fcntl
+import json
+import logging
+import os
+import struct
+import zlib
+from abc import ABC, abstractmethod
+from collections.abc import Iterator
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+import numpy.typing as npt
+import pandas as pd
+
+logging.basicConfig(level=logging.DEBUG if "DEBUG" in os.environ else logging.INFO)
+logger = logging.getLogger(__name__)
+
+RECORD_COLUMNS = ["ID", "Text", "Metadata"]
+
+# The size of one stored tombstone, a little-endian int64 row position.
+TOMBSTONE_BYTES = 8
+
+
+def empty_records() -> pd.DataFrame:
+    """Returns an empty records frame with the database columns."""
+    return pd.DataFrame(columns=RECORD_COLUMNS)
+
+
+def _metadata_column(values: Any) -> list[dict[str, Any]]:
+    """Returns the metadata of stored rows, empty for rows stored without any."""
+    return [value if isinstance(value, dict) else {} for value in values]
+
+
+def read_json_rows(
+    path: Path, dimensions: int
+) -> tuple[pd.DataFrame, npt.NDArray[np.float32]]:
+    """Reads rows from the JSON export format.
+
+    Args:
+        path: The path to a JSON file with ID, Text and Embeddings columns, and
+            optionally Metadata.
+        dimensions: The expected number of dimensions per embedding.
+
+    Returns:
+        The ID/Text/Metadata records and a float32 matrix with one embedding per
+        row.
+    """
+    logger.debug(f"Reading JSON file from {path}.")
+    frame = pd.read_json(path)
+    frame["Metadata"] = _metadata_column(
+        frame["Metadata"] if "Metadata" in frame else [None] * len(frame)
+    )
+    vectors = np.asarray(frame["Embeddings"].tolist(), dtype=np.float32)
+    return frame[RECORD_COLUMNS].reset_index(drop=True), vectors.reshape(
+        -1, dimensions
+    )
+
+
+def write_json_rows(
+    path: Path, records: pd.DataFrame, vectors: npt.NDArray[np.float32]
+) -> None:
+    """Writes rows in the JSON export format.
+
+    Args:
+        path: The destination JSON file.
+        records: The ID/Text/Metadata records.
+        vectors: The embeddings, aligned with records.
+    """
+    frame = records[RECORD_COLUMNS].reset_index(drop=True)
+    frame["Embeddings"] = vectors.astype(float).tolist()
+    frame.to_json(path, index=False, double_precision=15)
+
+
+def _record_bytes(records: pd.DataFrame) -> bytes:
+    """Encodes records as JSON lines, leaving out empty metadata."""
+    lines = []
+    for row in records.itertuples(index=False):
+        record: dict[str, Any] = {"ID": str(row.ID), "Text": str(row.Text)}
+        if row.Metadata:
+            record["Metadata"] = row.Metadata
+        lines.append(json.dumps(record) + "\n")
+    return "".join(lines).encode("utf-8")
+
+
+def _parse_records(lines: list[bytes]) -> pd.DataFrame:
+    """Decodes JSON lines records into a frame."""
+    if not lines:
+        return empty_records()
+    frame = pd.DataFrame([json.loads(line) for line in lines], columns=RECORD_COLUMNS)
+    frame["Metadata"] = _metadata_column(frame["Metadata"])
+    return frame
+
+
+def _vector_bytes(vectors: npt.NDArray[np.float32], dimensions: int) -> bytes:
+    """Encodes vectors as raw little-endian float32 rows."""
+    rows = np.ascontiguousarray(vectors, dtype="<f4")
+    return rows.reshape(-1, dimensions).tobytes()
+
+
+def _write_durably(target: Path, content: bytes) -> None:
+    """Writes a file under a temporary name, syncs it and renames it into place.
+
+    The directory is synced too, so after a crash the target holds either its
+    old or its new content.
+    """
+    temporary = target.with_suffix(target.suffix + ".tmp")
+    with Path.open(temporary, "wb") as file:
+        file.write(content)
+        file.flush()
+        os.fsync(file.fileno())
+    temporary.replace(target)
+    _sync_directory(target.parent)
+
+
+def _remove_files(path: Path, patterns: list[str]) -> None:
+    """Deletes the files of a storage directory, then the directory if it is empty.
+
+    Only files matching the patterns, and their temporary copies, are deleted,
+    so a path naming an unrelated directory keeps its other content.
+    """
+    if not path.is_dir():
+        return
+    for pattern in patterns:
+        for name in (pattern, f"{pattern}.tmp"):
+            for file in path.glob(name):
+                if not file.is_dir():
+                    file.unlink(missing_ok=True)
+    try:
+        path.rmdir()
+    except OSError:
+        logger.warning(f"Leaving {path} in place, as it holds other files.")
+
+
+def _sync_directory(path: Path) -> None:
+    """Persists the entries of a directory, such as a rename into it."""
+    descriptor = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(descriptor)
+    finally:
+        os.close(descriptor)
+
+
+class EmbeddingStorage(ABC):
+    """Persists records and their embedding vectors.
+
+    Backends that set `append_only` can add rows without rewriting the stored
+    database; the others are always saved in full.
+    """
+
+    append_only = False
+
+    def __init__(self, path: Path, dimensions: int):
+        """Initializes the storage backend.
+
+        Args:
+            path: The location of the stored database.
+            dimensions: The number of dimensions per embedding.
+        """
+        self.path = path
+        self.dimensions = dimensions
+
+    @abstractmethod
+    def exists(self) -> bool:
+        """Returns whether a database has been stored at the path."""
+
+    @abstractmethod
+    def remove(self) -> None:
+        """Deletes the stored database if there is one."""
+
+    @abstractmethod
+    def load(self) -> tuple[pd.DataFrame, npt.NDArray[np.float32]]:
+        """Loads all stored records and their vectors."""
+
+    @abstractmethod
+    def save(self, records: pd.DataFrame, vectors: npt.NDArray[np.float32]) -> None:
+        """Replaces the stored database with the given rows."""
+
+    def append(self, records: pd.DataFrame, vectors: npt.NDArray[np.float32]) -> None:
+        """Adds rows to the stored database.
+
+        Args:
+            records: The new ID/Text/Metadata records.
+            vectors: The new embeddings, aligned with records.
+
+        Raises:
+            NotImplementedError: If the backend is not append-only.
+        """
+        raise NotImplementedError(f"{type(self).__name__} does not support appends")
+
+    def delete(self, rows: npt.NDArray[np.int64]) -> None:
+        """Marks stored rows as deleted without rewriting them.
+
+        Args:
+            rows: The positions of the deleted rows.
+
+        Raises:
+            NotImplementedError: If the backend is not append-only.
+        """
+        raise NotImplementedError(f"{type(self).__name__} does not support tombstones")
+
+    def needs_checkpoint(self) -> bool:
+        """Returns whether the database should be saved in full to bound recovery."""
+        return False
+
+    def read_tombstones(self) -> npt.NDArray[np.int64]:
+        """Reads the rows marked as deleted since the last load or call.
+
+        Backends that are always saved in full store no tombstones.
+        """
+        return np.empty(0, dtype=np.int64)
+
+
+class JsonStorage(EmbeddingStorage):
+    """Stores the whole database as a single JSON file.
+
+    Every change rewrites the file, so this backend is meant for small databases
+    and for exchanging data with other tools.
+    """
+
+    def exists(self) -> bool:
+        """Returns whether the JSON file exists."""
+        return self.path.exists()
+
+    def remove(self) -> None:
+        """Deletes the JSON file if it exists."""
+        Path.unlink(self.path, missing_ok=True)
+
+    def load(self) -> tuple[pd.DataFrame, npt.NDArray[np.float32]]:
+        """Loads all rows from the JSON file."""
+        return read_json_rows(self.path, self.dimensions)
+
+    def save(self, records: pd.DataFrame, vectors: npt.NDArray[np.float32]) -> None:
+        """Rewrites the JSON file with the given rows.
+
+        The rows are written to a temporary file that is renamed into place,
+        so an interrupted save leaves the previous file intact.
+        """
+        logger.info(f"Saving database to JSON at {self.path=}.")
+        temporary = self.path.with_suffix(self.path.suffix + ".tmp")
+        write_json_rows(temporary, records, vectors)
+        temporary.replace(self.path)
+        logger.debug("Database saved.")
+
+
+class BinaryStorage(EmbeddingStorage):
+    """Stores the database as an append-only directory of binary files.
+
+    The directory holds `vectors.f32` with raw little-endian float32 rows and
+    `records.jsonl` with one ID/Text record per line, both in insertion order.
+    Records of rows with metadata also hold a Metadata object.
+    Appending writes only the new rows. Deleting a row appends its position to
+    `tombstones.i64`, and a row whose ID appears again later is superseded by
+    the later one, so neither rewrites the stored rows.
+
+    Saving writes the rows under the names of a new snapshot, such as
+    `vectors-2.f32`, and syncs them before `manifest.json` is renamed to name
+    that snapshot, so a crash leaves either the previous files or the new ones.
+    Snapshot 0 uses the plain names.
+
+    Several processes can share one directory: writers hold an exclusive
+    `flock` on the `lock` file and bump the counter in `generation` after each
+    write, and readers compare that memory-mapped counter with the last one
+    they saw to know when to read the rows other processes appended.
+    """
+
+    def __init__(self, path: Path, dimensions: int, mmap: bool = False):
+        """Initializes the binary backend.
+
+        Args:
+            path: The database directory.
+            dimensions: The number of dimensions per embedding.
+            mmap: Whether to memory-map the vector file instead of reading it.
+        """
+        super().__init__(path, dimensions)
+        self.mmap = mmap
+        self.snapshot = 0
+        self._records_offset = 0
+        self._tombstones_offset = 0
+        self._lock_file: int | None = None
+        self._generation: np.memmap[Any, np.dtype[np.uint64]] | None = None
+
+    append_only = True
+    manifest_name = "manifest.json"
+    vectors_name = "vectors.f32"
+    records_name = "records.jsonl"
+    tombstones_name = "tombstones.i64"
+    lock_name = "lock"
+    generation_name = "generation"
+    format_version = 1
+
+    @property
+    def manifest_path(self) -> Path:
+        """The path to the manifest describing the layout."""
+        return self.path / self.manifest_name
+
+    def _snapshot_path(self, name: str, snapshot: int) -> Path:
+        """Returns the path of a file of a snapshot, e.g. `vectors-2.f32`."""
+        if snapshot == 0:
+            return self.path / name
+        stem, suffix = name.split(".")
+        return self.path / f"{stem}-{snapshot}.{suffix}"
+
+    @property
+    def vectors_path(self) -> Path:
+        """The path to the raw float32 vector file."""
+        return self._snapshot_path(self.vectors_name, self.snapshot)
+
+    @property
+    def records_path(self) -> Path:
+        """The path to the JSON lines records file."""
+        return self._snapshot_path(self.records_name, self.snapshot)
+
+    @property
+    def tombstones_path(self) -> Path:
+        """The path to the raw int64 positions of deleted rows."""
+        return self._snapshot_path(self.tombstones_name, self.snapshot)
+
+    def exists(self) -> bool:
+        """Returns whether a manifest exists in the directory."""
+        return self.manifest_path.exists()
+
+    def remove(self) -> None:
+        """Deletes the files of the database and its directory if it exists."""
+        self._generation = None
+        self.snapshot = 0
+        names = (self.vectors_name, self.records_name, self.tombstones_name)
+        _remove_files(
+            self.path,
+            [
+                self.manifest_name,
+                self.lock_name,
+                self.generation_name,
+                *(name.replace(".", "*.") for name in names),
+            ],
+        )
+
+    def acquire(self) -> None:
+        """Blocks until this process holds the exclusive write lock."""
+        self.path.mkdir(parents=True, exist_ok=True)
+        lock_file = os.open(self.path / self.lock_name, os.O_RDWR | os.O_CREAT)
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        self._lock_file = lock_file
+
+    def release(self) -> None:
+        """Releases the write lock taken by `acquire`."""
+        if self._lock_file is not None:
+            os.close(self._lock_file)
+            self._lock_file = None
+
+    def generation(self) -> int:
+        """Returns the number of writes to the directory, 0 before the first one."""
+        if self._generation is None:
+            path = self.path / self.generation_name
+            if not path.exists():
+                return 0
+            self._generation = np.memmap(path, dtype="<u8", mode="r+", shape=(1,))
+        return int(self._generation[0])
+
+    def _bump_generation(self) -> None:
+        """Increments the write counter. Callers hold the write lock."""
+        path = self.path / self.generation_name
+        if not path.exists():
+            self._replace(path, np.zeros(1, dtype="<u8").tobytes())
+            self._generation = None
+        self.generation()
+        assert self._generation is not None
+        # Stores to a shared mapping are visible to other processes at once.
+        self._generation[0] += 1
+
+    def _check_manifest(self) -> None:
+        """Validates the stored layout against this backend and reads its snapshot.
+
+        Raises:
+            ValueError: If the stored format or dimensions do not match.
+        """
+        manifest = json.loads(self.manifest_path.read_text(encoding="utf-8"))
+        if manifest.get("version") != self.format_version:
+            raise ValueError(f"Unsupported storage version {manifest.get('version')}")
+        if manifest.get("dimensions") != self.dimensions:
+            raise ValueError(
+                f"Stored embeddings have {manifest.get('dimensions')} dimensions, "
+                f"expected {self.dimensions}"
+            )
+        self.snapshot = manifest.get("snapshot", 0)
+
+    def _read_records(self, offset: int = 0) -> tuple[list[bytes], int]:
+        """Reads the complete lines of the records file from a byte offset.
+
+        Args:
+            offset: The byte offset to start reading at.
+
+        Returns:
+            The lines, and the offset after the last complete one.
+        """
+        with Path.open(self.records_path, "rb") as file:
+            file.seek(offset)
+            content = file.read()
+        complete = content[: content.rfind(b"\n") + 1]
+        return complete.splitlines(keepends=True), offset + len(complete)
+
+    def _vector_rows(self) -> int:
+        """Returns the number of complete rows in the vector file."""
+        row_bytes = self.dimensions * np.dtype("<f4").itemsize
+        return self.vectors_path.stat().st_size // row_bytes
+
+    def _map_vectors(self, rows: int) -> npt.NDArray[np.float32]:
+        """Memory-maps the first rows of the vector file read-only."""
+        if rows == 0:
+            return np.empty((0, self.dimensions), dtype=np.float32)
+        vectors: npt.NDArray[np.float32] = np.memmap(
+            self.vectors_path, dtype="<f4", mode="r", shape=(rows, self.dimensions)
+        )
+        return vectors
+
+    def read_new_rows(
+        self, start: int
+    ) -> tuple[pd.DataFrame, npt.NDArray[np.float32]]:
+        """Reads the rows other processes appended after the loaded ones.
+
+        Rows still being written are left for a later call.
+
+        Args:
+            start: The number of rows already loaded.
+
+        Returns:
+            The new records, and the vectors of the new rows or, in mmap mode,
+            a read-only map of every row including the loaded ones.
+        """
+        lines, _ = self._read_records(self._records_offset)
+        count = max(min(len(lines), self._vector_rows() - start), 0)
+        lines = lines[:count]
+        self._records_offset += sum(len(line) for line in lines)
+        if self.mmap:
+            return _parse_records(lines), self._map_vectors(start + count)
+        row_bytes = self.dimensions * np.dtype("<f4").itemsize
+        flat = np.fromfile(
+            self.vectors_path,
+            dtype="<f4",
+            count=count * self.dimensions,
+            offset=start * row_bytes,
+        )
+        return _parse_records(lines), flat.reshape(count, self.dimensions)
+
+    def load(self) -> tuple[pd.DataFrame, npt.NDArray[np.float32]]:
+        """Loads all rows, repairing a partially written trailing row.
+
+        In mmap mode the vectors are returned as a read-only `np.memmap`, so no
+        vector data is read until it is used.
+        """
+        logger.debug(f"Reading binary database from {self.path}.")
+        self._check_manifest()
+        self._remove_stale_files()
+        lines, self._records_offset = self._read_records()
+        row_bytes = self.dimensions * np.dtype("<f4").itemsize
+        size = self.vectors_path.stat().st_size
+        rows = min(len(lines), size // row_bytes)
+        if rows != len(lines) or rows * row_bytes != size:
+            logger.warning(
+                "Truncating incomplete trailing rows in binary database.",
+                extra={"records": len(lines), "rows": rows},
+            )
+            lines = lines[:rows]
+            with Path.open(self.vectors_path, "r+b") as file:
+                file.truncate(rows * row_bytes)
+            content = b"".join(lines)
+            self._replace(self.records_path, content)
+            self._records_offset = len(content)
+        records = _parse_records(lines)
+        self._tombstones_offset = 0
+        if self.tombstones_path.exists():
+            size = self.tombstones_path.stat().st_size
+            if size % TOMBSTONE_BYTES:
+                logger.warning("Truncating an incomplete trailing tombstone.")
+                with Path.open(self.tombstones_path, "r+b") as file:
+                    file.truncate(size - size % TOMBSTONE_BYTES)
+
+        if self.mmap:
+            return records, self._map_vectors(rows)
+        flat = np.fromfile(self.vectors_path, dtype="<f4", count=rows * self.dimensions)
+        return records, flat.reshape(rows, self.dimensions)
+
+    def save(self, records: pd.DataFrame, vectors: npt.NDArray[np.float32]) -> None:
+        """Writes the given rows as a new snapshot without tombstones.
+
+        The vector and records files of the snapshot are synced before the
+        manifest is renamed to name it, then the previous snapshot is deleted.
+        """
+        logger.info(f"Saving binary database at {self.path=}.")
+        self.path.mkdir(parents=True, exist_ok=True)
+        previous = self.snapshot
+        if self.exists():
+            manifest = json.loads(self.manifest_path.read_text(encoding="utf-8"))
+            previous = max(previous, manifest.get("snapshot", 0))
+        snapshot = previous + 1
+        record_bytes = _record_bytes(records)
+        _write_durably(
+            self._snapshot_path(self.vectors_name, snapshot),
+            self._vector_bytes(vectors),
+        )
+        _write_durably(self._snapshot_path(self.records_name, snapshot), record_bytes)
+        manifest = {
+            "version": self.format_version,
+            "dimensions": self.dimensions,
+            "snapshot": snapshot,
+        }
+        _write_durably(self.manifest_path, json.dumps(manifest).encode())
+        self.snapshot = snapshot
+        self._records_offset = len(record_bytes)
+        self._tombstones_offset = 0
+        self._remove_stale_files()
+        self._bump_generation()
+        logger.debug("Database saved.", extra={"snapshot": snapshot})
+
+    def _remove_stale_files(self) -> None:
+        """Deletes the files of the snapshots the manifest no longer names."""
+        current = {self.vectors_path, self.records_path, self.tombstones_path}
+        names = (self.vectors_name, self.records_name, self.tombstones_name)
+        patterns = [name.replace(".", "*.") for name in names]
+        for pattern in patterns:
+            for path in self.path.glob(pattern):
+                if path not in current:
+                    path.unlink(missing_ok=True)
+
+    @staticmethod
+    def _replace(target: Path, content: bytes) -> None:
+        """Writes a file under a temporary name and renames it into place."""
+        temporary = target.with_suffix(target.suffix + ".tmp")
+        temporary.write_bytes(content)
+        temporary.replace(target)
+
+    def append(self, records: pd.DataFrame, vectors: npt.NDArray[np.float32]) -> None:
+        """Appends the new rows to the vector and records files."""
+        record_bytes = _record_bytes(records)
+        with Path.open(self.vectors_path, "ab") as file:
+            file.write(self._vector_bytes(vectors))
+        with Path.open(self.records_path, "ab") as file:
+            file.write(record_bytes)
+        self._records_offset += len(record_bytes)
+        self._bump_generation()
+
+    def delete(self, rows: npt.NDArray[np.int64]) -> None:
+        """Appends the positions of deleted rows to the tombstones file."""
+        content = np.asarray(rows, dtype="<i8").tobytes()
+        with Path.open(self.tombstones_path, "ab") as file:
+            file.write(content)
+        self._tombstones_offset += len(content)
+        self._bump_generation()
+
+    def read_tombstones(self) -> npt.NDArray[np.int64]:
+        """Reads the tombstones appended since the last load or call.
+
+        Tombstones this process wrote are skipped, and one still being written
+        is left for a later call.
+        """
+        if not self.tombstones_path.exists():
+            return np.empty(0, dtype=np.int64)
+        with Path.open(self.tombstones_path, "rb") as file:
+            file.seek(self._tombstones_offset)
+            content = file.read()
+        content = content[: len(content) - len(content) % TOMBSTONE_BYTES]
+        self._tombstones_offset += len(content)
+        return np.frombuffer(content, dtype="<i8").astype(np.int64)
+
+    def _vector_bytes(self, vectors: npt.NDArray[np.float32]) -> bytes:
+        """Encodes vectors as raw little-endian float32 rows."""
+        return _vector_bytes(vectors, self.dimensions)
+
+
+class WalStorage(EmbeddingStorage):
+    """Stores the database as a snapshot plus a write-ahead log of later writes.
+
+    Every append or delete is one checksummed entry appended to the log and
+    fsynced before the write returns. The database coalesces the inserts that
+    arrive while a write is running into its next write, so concurrent inserts
+    share one fsync.
+
+    Saving writes a numbered snapshot of every row and starts an empty log,
+    then switches `manifest.json` over to them with an atomic rename. Loading
+    reads the snapshot the manifest names and replays its log, dropping an
+    entry torn by a crash.
+    """
+
+    append_only = True
+    manifest_name = "manifest.json"
+    format_version = 1
+    # The length and CRC-32 of the payload that follows, ahead of each entry.
+    entry_header = struct.Struct("<II")
+    append_entry = b"A"
+    delete_entry = b"D"
+
+    def __init__(
+        self,
+        path: Path,
+        dimensions: int,
+        checkpoint_bytes: int = 64 * 1024 * 1024,
+        fsync: bool = True,
+    ):
+        """Initializes the write-ahead log backend.
+
+        Args:
+            path: The database directory.
+            dimensions: The number of dimensions per embedding.
+            checkpoint_bytes: The log size at which a checkpoint is due.
+            fsync: Whether writes wait until the log is on disk.
+        """
+        super().__init__(path, dimensions)
+        self.checkpoint_bytes = checkpoint_bytes
+        self.fsync = fsync
+        self.snapshot = 0
+        self._log_bytes = 0
+        self._tombstones = np.empty(0, dtype=np.int64)
+
+    @property
+    def manifest_path(self) -> Path:
+        """The path to the manifest naming the current snapshot."""
+        return self.path / self.manifest_name
+
+    def _snapshot_paths(self, snapshot: int) -> tuple[Path, Path]:
+        """Returns the records and vector files of a snapshot."""
+        return (
+            self.path / f"snapshot-{snapshot}.jsonl",
+            self.path / f"snapshot-{snapshot}.f32",
+        )
+
+    def _log_path(self, snapshot: int) -> Path:
+        """Returns the log of the writes made after a snapshot."""
+        return self.path / f"wal-{snapshot}.log"
+
+    @property
+    def log_path(self) -> Path:
+        """The log of the writes made after the current snapshot."""
+        return self._log_path(self.snapshot)
+
+    def exists(self) -> bool:
+        """Returns whether a manifest exists in the directory."""
+        return self.manifest_path.exists()
+
+    def remove(self) -> None:
+        """Deletes the files of the database and its directory if it exists."""
+        _remove_files(
+            self.path,
+            [self.manifest_name, "snapshot-*.jsonl", "snapshot-*.f32", "wal-*.log"],
+        )
+        self.snapshot = self._log_bytes = 0
+
+    def needs_checkpoint(self) -> bool:
+        """Returns whether the log has grown past the checkpoint size."""
+        return self._log_bytes >= self.checkpoint_bytes
+
+    def load(self) -> tuple[pd.DataFrame, npt.NDArray[np.float32]]:
+        """Loads the current snapshot and replays the log written after it.
+
+        The deletes found in the log are returned by `read_tombstones`.
+        """
+        logger.debug(f"Recovering database from {self.path}.")
+        manifest = json.loads(self.manifest_path.read_text(encoding="utf-8"))
+        if manifest.get("version") != self.format_version:
+            raise ValueError(f"Unsupported storage version {manifest.get('version')}")
+        if manifest.get("dimensions") != self.dimensions:
+            raise ValueError(
+                f"Stored embeddings have {manifest.get('dimensions')} dimensions, "
+                f"expected {self.dimensions}"
+            )
+        self.snapshot = manifest["snapshot"]
+        self._remove_stale_files()
+
+        records_path, vectors_path = self._snapshot_paths(self.snapshot)
+        frames = [_parse_records(records_path.read_bytes().splitlines())]
+        blocks = [
+            np.fromfile(vectors_path, dtype="<f4").reshape(-1, self.dimensions)
+        ]
+        tombstones = []
+        for kind, payload in self._replay():
+            if kind == self.append_entry:
+                (size,) = struct.unpack_from("<I", payload)
+                lines = payload[4 : 4 + size].splitlines()
+                vectors = np.frombuffer(payload[4 + size :], dtype="<f4")
+                frames.append(_parse_records(lines))
+                blocks.append(vectors.reshape(len(lines), self.dimensions))
+            else:
+                tombstones.append(np.frombuffer(payload, dtype="<i8"))
+        self._tombstones = np.concatenate(
+            [np.empty(0, dtype=np.int64), *tombstones]
+        ).astype(np.int64)
+        logger.debug(
+            "Replayed the write-ahead log.",
+            extra={"entries": len(frames) - 1 + len(tombstones)},
+        )
+        records = pd.concat(frames, ignore_index=True) if len(frames) > 1 else frames[0]
+        return records, np.concatenate(blocks).astype(np.float32, copy=False)
+
+    def _replay(self) -> Iterator[tuple[bytes, bytes]]:
+        """Yields the kind and payload of each complete entry of the log.
+
+        A torn or corrupt trailing entry, left by a crash during a write that
+        never returned, is cut off so later entries follow the last good one.
+        """
+        content = self.log_path.read_bytes() if self.log_path.exists() else b""
+        offset = 0
+        while offset + self.entry_header.size <= len(content):
+            size, checksum = self.entry_header.unpack_from(content, offset)
+            start = offset + self.entry_header.size
+            payload = content[start : start + size]
+            if len(payload) < size or zlib.crc32(payload) != checksum:
+                break
+            yield payload[:1], payload[1:]
+            offset = start + size
+        if offset < len(content):
+            logger.warning(
+                "Truncating a torn entry of the write-ahead log.",
+                extra={"bytes": len(content) - offset},
+            )
+            with Path.open(self.log_path, "r+b") as file:
+                file.truncate(offset)
+        self._log_bytes = offset
+
+    def read_tombstones(self) -> npt.NDArray[np.int64]:
+        """Returns the deletes replayed by the last load, once."""
+        tombstones, self._tombstones = self._tombstones, np.empty(0, dtype=np.int64)
+        return tombstones
+
+    def save(self, records: pd.DataFrame, vectors: npt.NDArray[np.float32]) -> None:
+        """Writes the rows as a new snapshot with an empty log.
+
+        The snapshot is synced before the manifest is renamed to name it, so a
+        crash leaves either the previous snapshot and log or the new ones.
+        """
+        logger.info(f"Writing snapshot of the database at {self.path=}.")
+        self.path.mkdir(parents=True, exist_ok=True)
+        snapshot = self.snapshot + 1
+        records_path, vectors_path = self._snapshot_paths(snapshot)
+        _write_durably(records_path, _record_bytes(records))
+        _write_durably(vectors_path, _vector_bytes(vectors, self.dimensions))
+        _write_durably(self._log_path(snapshot), b"")
+        manifest = {
+            "version": self.format_version,
+            "dimensions": self.dimensions,
+            "snapshot": snapshot,
+        }
+        _write_durably(self.manifest_path, json.dumps(manifest).encode())
+        self.snapshot, self._log_bytes = snapshot, 0
+        self._remove_stale_files()
+        logger.debug("Snapshot written.", extra={"snapshot": snapshot})
+
+    def _remove_stale_files(self) -> None:
+        """Deletes the snapshots and logs the manifest no longer names."""
+        current = {*self._snapshot_paths(self.snapshot), self.log_path}
+        for path in self.path.glob("*"):
+            if path.name.startswith(("snapshot-", "wal-")) and path not in current:
+                path.unlink(missing_ok=True)
+
+    def _log(self, kind: bytes, payload: bytes) -> None:
+        """Appends one entry to the log and waits until it is on disk."""
+        payload = kind + payload
+        entry = self.entry_header.pack(len(payload), zlib.crc32(payload)) + payload
+        with Path.open(self.log_path, "ab") as file:
+            file.write(entry)
+            file.flush()
+            if self.fsync:
+                os.fsync(file.fileno())
+        self._log_bytes += len(entry)
+
+    def append(self, records: pd.DataFrame, vectors: npt.NDArray[np.float32]) -> None:
+        """Logs the new rows as one entry."""
+        record_bytes = _record_bytes(records)
+        self._log(
+            self.append_entry,
+            struct.pack("<I", len(record_bytes))
+            + record_bytes
+            + _vector_bytes(vectors, self.dimensions),
+        )
+
+    def delete(self, rows: npt.NDArray[np.int64]) -> None:
+        """Logs the positions of deleted rows as one entry."""
+        self._log(self.delete_entry, np.asarray(rows, dtype="<i8").tobytes())
+
+
+def open_storage(
+    path: Path, dimensions: int, mmap: bool = False, wal: bool = False
+) -> EmbeddingStorage:
+    """Chooses a storage backend from the shape of the path.
+
+    Args:
+        path: A `.json` file for the JSON backend, or a directory otherwise.
+        dimensions: The number of dimensions per embedding.
+        mmap: Whether a binary backend should memory-map its vector file.
+        wal: Whether a directory holds a write-ahead logged database rather
+            than a binary one.
+
+    Returns:
+        The storage backend for the path.
+    """
+    if path.suffix == ".json":
+        return JsonStorage(path, dimensions)
+    if wal:
+        return WalStorage(path, dimensions)
+    return BinaryStorage(path, dimensions, mmap=mmap)
@@ -0,0 +1,137 @@
+"""In-memory layout of the embedding vectors held by a database."""
+
+import logging
+import os
+
+import numpy as np
+import numpy.typing as npt
+
+logging.basicConfig(level=logging.DEBUG if "DEBUG" in os.environ else logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class VectorStore:
+    """An append-only float32 matrix split into a base and a tail segment.
+
+    The base segment holds the rows that were loaded from storage and is never
+    modified, so it can be a read-only `np.memmap` shared with other processes
+    through the OS page cache. Rows added afterwards go to an in-memory tail
+    whose capacity doubles when it is full, so appends are amortized O(1).
+    Rows are written into spare capacity and never moved in place, so views
+    returned by `segments` stay valid while more rows are appended.
+    """
+
+    def __init__(
+        self, dimensions: int, base: npt.NDArray[np.float32] | None = None
+    ):
+        """Initializes the vector store.
+
+        Args:
+            dimensions: The number of dimensions per vector.
+            base: The loaded rows, used without copying.
+        """
+        self.dimensions = dimensions
+        self._base = (
+            base if base is not None else np.empty((0, dimensions), dtype=np.float32)
+        )
+        self._buffer = np.empty((0, dimensions), dtype=np.float32)
+        # The filled rows of the buffer, replaced in one assignment per append
+        # so that readers on other threads always see a consistent view.
+        self._tail = self._buffer
+
+    def __len__(self) -> int:
+        """Returns the number of stored rows."""
+        return len(self._base) + len(self._tail)
+
+    def append(self, vectors: npt.ArrayLike) -> None:
+        """Adds rows to the end of the store.
+
+        Args:
+            vectors: A matrix with one vector per row.
+        """
+        rows = np.asarray(vectors, dtype=np.float32).reshape(-1, self.dimensions)
+        size = len(self._tail)
+        needed = size + len(rows)
+        if needed > len(self._buffer):
+            capacity = max(needed, 2 * len(self._buffer), 16)
+            grown = np.empty((capacity, self.dimensions), dtype=np.float32)
+            grown[:size] = self._tail
+            self._buffer = grown
+        self._buffer[size:needed] = rows
+        self._tail = self._buffer[:needed]
+
+    def rebase(self, base: npt.NDArray[np.float32]) -> None:
+        """Replaces every row with a larger base, such as a remapped vector file.
+
+        Args:
+            base: The stored rows, starting with the rows already held.
+        """
+        if len(base) < len(self):
+            raise ValueError("The new base must hold at least the existing rows")
+        self._base = base
+        self._buffer = np.empty((0, self.dimensions), dtype=np.float32)
+        self._tail = self._buffer
+
+    def segments(self) -> list[npt.NDArray[np.float32]]:
+        """Returns the non-empty contiguous blocks of rows in row order."""
+        return [segment for segment in (self._base, self._tail) if len(segment)]
+
+    def row(self, index: int) -> npt.NDArray[np.float32]:
+        """Returns a single row.
+
+        Args:
+            index: The position of the row.
+
+        Returns:
+            The vector stored at index.
+        """
+        if index < 0:
+            index += len(self)
+        if index < len(self._base):
+            return np.array(self._base[index], dtype=np.float32)
+        vector: npt.NDArray[np.float32] = self._tail[index - len(self._base)]
+        return vector
+
+    def to_array(
+        self, start: int = 0, stop: int | None = None
+    ) -> npt.NDArray[np.float32]:
+        """Copies rows into a single in-memory matrix.
+
+        Rows below a stop captured earlier never change, so the copy may run on
+        another thread while rows are appended.
+
+        Args:
+            start: The first row to copy.
+            stop: The row after the last one to copy, the end of the store if None.
+
+        Returns:
+            A matrix with the rows from start to stop.
+        """
+        blocks = [np.empty((0, self.dimensions), dtype=np.float32)]
+        offset = 0
+        for segment in self.segments():
+            if stop is not None and offset >= stop:
+                break
+            end = len(segment) if stop is None else min(len(segment), stop - offset)
+            if start < offset + end:
+                blocks.append(segment[max(start - offset, 0) : end])
+            offset += len(segment)
+        matrix: npt.NDArray[np.float32] = np.concatenate(blocks)
+        return matrix
+
+    def take(self, rows: npt.NDArray[np.intp]) -> npt.NDArray[np.float32]:
+        """Copies the given rows into a single in-memory matrix.
+
+        Args:
+            rows: The positions of the rows to copy, in ascending order.
+
+        Returns:
+            A matrix with one vector per position.
+        """
+        matrix = np.empty((len(rows), self.dimensions), dtype=np.float32)
+        offset = 0
+        for segment in self.segments():
+            start, stop = np.searchsorted(rows, [offset, offset + len(segment)])
+            matrix[start:stop] = segment[rows[start:stop] - offset]
+            offset += len(segment)
+        return matrix
@@ -0,0 +1,272 @@
+"""Approximate nearest-neighbour index for sublinear similarity search."""
+
+import logging
+import os
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+import numpy.typing as npt
+
+from embedding_server.similarity import normalize, top_k_indices
+
+logging.basicConfig(level=logging.DEBUG if "DEBUG" in os.environ else logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Rows per block when assigning vectors to centroids, bounding temporary memory.
+ASSIGN_BLOCK_ROWS = 16384
+
+
+def assign(
+    vectors: npt.NDArray[np.float32], centroids: npt.NDArray[np.float32]
+) -> npt.NDArray[np.intp]:
+    """Returns the index of the most similar centroid for every vector.
+
+    Args:
+        vectors: Unit-length vectors, one per row.
+        centroids: Unit-length centroids, one per row.
+
+    Returns:
+        One centroid index per vector.
+    """
+    assignments = np.empty(len(vectors), dtype=np.intp)
+    for start in range(0, len(vectors), ASSIGN_BLOCK_ROWS):
+        block = vectors[start : start + ASSIGN_BLOCK_ROWS]
+        assignments[start : start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+    return assignments
+
+
+def spherical_kmeans(
+    vectors: npt.NDArray[np.float32],
+    clusters: int,
+    iterations: int = 20,
+    seed: int = 0,
+) -> npt.NDArray[np.float32]:
+    """Clusters unit-length vectors by cosine similarity.
+
+    Args:
+        vectors: Unit-length vectors, one per row.
+        clusters: The number of centroids, at most the number of vectors.
+        iterations: The number of assignment and update rounds.
+        seed: Seeds the initial centroids and the reseeding of empty clusters.
+
+    Returns:
+        Unit-length centroids, one per row.
+    """
+    rng = np.random.default_rng(seed)
+    centroids: npt.NDArray[np.float32] = vectors[
+        rng.choice(len(vectors), clusters, replace=False)
+    ].copy()
+    for _ in range(iterations):
+        assignments = assign(vectors, centroids)
+        counts = np.bincount(assignments, minlength=clusters)
+        starts = np.cumsum(counts) - counts
+        sums = np.zeros_like(centroids)
+        sums[counts > 0] = np.add.reduceat(
+            vectors[np.argsort(assignments, kind="stable")], starts[counts > 0]
+        )
+        empty = np.flatnonzero(counts == 0)
+        sums[empty] = vectors[rng.choice(len(vectors), len(empty), replace=False)]
+        centroids = normalize(sums)
+    return centroids
+
+
+class IVFIndex:
+    """An inverted file index over unit-length vectors.
+
+    A spherical k-means coarse quantizer splits the vectors into `nlist` lists.
+    A query is compared with the centroids and only the `nprobe` closest lists
+    are scanned, trading recall for latency. Each list keeps its vectors and
+    their database rows in arrays that grow by doubling, so rows can be added
+    one at a time.
+
+    Attributes:
+        fingerprint: Identifies the database rows the index was saved with, so
+            their owner can tell whether a loaded index still matches them.
+    """
+
+    def __init__(self, centroids: npt.NDArray[np.float32], nprobe: int = 8):
+        """Initializes an empty index.
+
+        Args:
+            centroids: Unit-length list centroids, one per row.
+            nprobe: The number of lists scanned per query.
+        """
+        self.centroids = np.ascontiguousarray(centroids, dtype=np.float32)
+        self.nprobe = nprobe
+        dimensions = self.centroids.shape[1]
+        self._vectors = [
+            np.empty((0, dimensions), dtype=np.float32) for _ in range(self.nlist)
+        ]
+        self._rows = [np.empty(0, dtype=np.int64) for _ in range(self.nlist)]
+        self._sizes = np.zeros(self.nlist, dtype=np.int64)
+        self.fingerprint = ""
+
+    @classmethod
+    def train(
+        cls,
+        vectors: npt.NDArray[np.float32],
+        nlist: int,
+        nprobe: int = 8,
+        sample_size: int | None = None,
+        seed: int = 0,
+    ) -> "IVFIndex":
+        """Fits the coarse quantizer on a sample of vectors.
+
+        The vectors are not added to the index.
+
+        Args:
+            vectors: Unit-length training vectors, one per row.
+            nlist: The number of lists.
+            nprobe: The number of lists scanned per query.
+            sample_size: The most vectors used for training, 256 per list if None.
+            seed: Seeds the sampling and the clustering.
+
+        Returns:
+            An empty trained index.
+        """
+        sample_size = sample_size or 256 * nlist
+        if len(vectors) > sample_size:
+            rng = np.random.default_rng(seed)
+            sample = rng.choice(len(vectors), sample_size, replace=False)
+            vectors = vectors[np.sort(sample)]
+        nlist = min(nlist, len(vectors))
+        logger.info("Training IVF index.", extra={"nlist": nlist, "rows": len(vectors)})
+        return cls(spherical_kmeans(np.asarray(vectors), nlist, seed=seed), nprobe)
+
+    @property
+    def nlist(self) -> int:
+        """The number of lists."""
+        return len(self.centroids)
+
+    def __len__(self) -> int:
+        """Returns the number of indexed vectors."""
+        return int(self._sizes.sum())
+
+    def add(self, vectors: npt.NDArray[np.float32], rows: npt.ArrayLike) -> None:
+        """Adds vectors to the lists of their closest centroids.
+
+        Args:
+            vectors: Unit-length vectors, one per row.
+            rows: The database row of each vector.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        assignments = assign(vectors, self.centroids)
+        order = np.argsort(assignments, kind="stable")
+        counts = np.bincount(assignments, minlength=self.nlist)
+        start = 0
+        for list_id in np.flatnonzero(counts):
+            members = order[start : start + counts[list_id]]
+            self._append(int(list_id), vectors[members], rows[members])
+            start += counts[list_id]
+
+    def _append(
+        self,
+        list_id: int,
+        vectors: npt.NDArray[np.float32],
+        rows: npt.NDArray[np.int64],
+    ) -> None:
+        """Appends to one list, doubling its capacity when it is full."""
+        size = int(self._sizes[list_id])
+        needed = size + len(rows)
+        if needed > len(self._rows[list_id]):
+            capacity = max(needed, 2 * len(self._rows[list_id]), 16)
+            grown_vectors = np.empty((capacity, self.centroids.shape[1]), np.float32)
+            grown_vectors[:size] = self._vectors[list_id][:size]
+            grown_rows = np.empty(capacity, dtype=np.int64)
+            grown_rows[:size] = self._rows[list_id][:size]
+            self._vectors[list_id], self._rows[list_id] = grown_vectors, grown_rows
+        self._vectors[list_id][size:needed] = vectors
+        self._rows[list_id][size:needed] = rows
+        self._sizes[list_id] = needed
+
+    def search(
+        self,
+        query: npt.NDArray[np.float32],
+        k: int,
+        nprobe: int | None = None,
+        mask: npt.NDArray[np.bool_] | None = None,
+        stop: int | None = None,
+    ) -> tuple[npt.NDArray[np.float32], npt.NDArray[np.int64]]:
+        """Finds the indexed vectors most similar to a query.
+
+        Args:
+            query: A unit-length query vector.
+            k: The number of results.
+            nprobe: The number of lists to scan, the index default if None.
+            mask: Flags the database rows that may be returned, all if None.
+                Only the flagged vectors of the probed lists are scored.
+            stop: Only rows before it may be returned, such as the rows of a
+                snapshot the index has grown past. Unbounded if None.
+
+        Returns:
+            The cosine similarities and database rows of at most k results,
+            best first.
+        """
+        if mask is not None:
+            stop = len(mask) if stop is None else min(stop, len(mask))
+        probe = top_k_indices(self.centroids @ query, nprobe or self.nprobe)
+        score_blocks = [np.empty(0, dtype=np.float32)]
+        row_blocks = [np.empty(0, dtype=np.int64)]
+        for list_id in probe:
+            size = self._sizes[list_id]
+            vectors, rows = self._vectors[list_id][:size], self._rows[list_id][:size]
+            if stop is not None:
+                allowed = rows < stop
+                if mask is not None:
+                    allowed[allowed] = mask[rows[allowed]]
+                vectors, rows = vectors[allowed], rows[allowed]
+            score_blocks.append(vectors @ query)
+            row_blocks.append(rows)
+        scores, rows = np.concatenate(score_blocks), np.concatenate(row_blocks)
+        best = top_k_indices(scores, k)
+        return scores[best], rows[best]
+
+    def save(self, path: Path) -> None:
+        """Writes the index to a `.npz` file atomically.
+
+        Args:
+            path: The destination file.
+        """
+        arrays: dict[str, Any] = {
+            "fingerprint": np.array(self.fingerprint),
+            "centroids": self.centroids,
+            "sizes": self._sizes,
+            "rows": np.concatenate(
+                [rows[:n] for rows, n in zip(self._rows, self._sizes, strict=True)]
+            ),
+            "vectors": np.concatenate(
+                [vecs[:n] for vecs, n in zip(self._vectors, self._sizes, strict=True)]
+            ),
+        }
+        temporary = path.with_name(f"{path.name}.tmp")
+        with Path.open(temporary, "wb") as file:
+            np.savez(file, **arrays)
+        temporary.replace(path)
+        logger.debug("IVF index saved.", extra={"path": str(path), "rows": len(self)})
+
+    @classmethod
+    def load(cls, path: Path, nprobe: int = 8) -> "IVFIndex":
+        """Reads an index written by `save`.
+
+        Args:
+            path: The `.npz` file.
+            nprobe: The number of lists scanned per query.
+
+        Returns:
+            The loaded index.
+        """
+        with np.load(path) as arrays:
+            index = cls(arrays["centroids"], nprobe)
+            if "fingerprint" in arrays.files:
+                index.fingerprint = str(arrays["fingerprint"])
+            boundaries = np.cumsum(arrays["sizes"])[:-1]
+            for list_id, (vectors, rows) in enumerate(
+                zip(
+                    np.split(arrays["vectors"], boundaries),
+                    np.split(arrays["rows"], boundaries),
+                    strict=True,
+                )
+            ):
+                index._append(list_id, vectors, rows)
+        return index
@@ -0,0 +1,257 @@
+"""Counters and timing histograms of the hot paths, in the Prometheus format."""
+
+import bisect
+import logging
+import os
+import threading
+import time
+from collections.abc import Callable, Iterator
+from contextlib import AbstractContextManager, contextmanager, nullcontext
+from contextvars import ContextVar
+from types import TracebackType
+
+logging.basicConfig(level=logging.DEBUG if "DEBUG" in os.environ else logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Upper bounds of the latency buckets, in seconds.
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+)
+
+# The timings of the current request, collected for its Server-Timing header.
+_request_timings: ContextVar[list[tuple[str, float]] | None] = ContextVar(
+    "request_timings", default=None
+)
+
+_DISABLED = nullcontext()
+
+
+class Registry:
+    """The metrics of the process.
+
+    Metrics record nothing until the registry is enabled, and their timers
+    are then a shared no-op, so instrumented code pays one attribute check.
+    """
+
+    def __init__(self) -> None:
+        """Initializes a disabled registry without metrics."""
+        self.enabled = False
+        self._metrics: dict[str, Counter | Histogram] = {}
+        self._gauges: dict[str, tuple[str, Callable[[], float]]] = {}
+
+    def counter(self, name: str, help: str, labels: tuple[str, ...] = ()) -> "Counter":
+        """Declares a counter, or returns the one declared under the name."""
+        metric = self._metrics.setdefault(name, Counter(self, name, help, labels))
+        assert isinstance(metric, Counter)
+        return metric
+
+    def histogram(
+        self,
+        name: str,
+        help: str,
+        labels: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ) -> "Histogram":
+        """Declares a histogram, or returns the one declared under the name."""
+        metric = self._metrics.setdefault(
+            name, Histogram(self, name, help, labels, buckets)
+        )
+        assert isinstance(metric, Histogram)
+        return metric
+
+    def gauge(self, name: str, help: str, read: Callable[[], float]) -> None:
+        """Declares a gauge whose value is read when the metrics are rendered."""
+        self._gauges[name] = (help, read)
+
+    def render(self) -> str:
+        """Returns every metric in the Prometheus text exposition format."""
+        lines: list[str] = []
+        for name, (help, read) in sorted(self._gauges.items()):
+            lines += [f"# HELP {name} {help}", f"# TYPE {name} gauge"]
+            lines.append(f"{name} {float(read())}")
+        for _, metric in sorted(self._metrics.items()):
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+    def reset(self) -> None:
+        """Clears the recorded values of every metric."""
+        for metric in self._metrics.values():
+            metric.reset()
+
+
+def _label_text(
+    names: tuple[str, ...], values: tuple[str, ...], extra: str = ""
+) -> str:
+    """Formats label pairs, e.g. `{path="/insert",le="0.5"}`."""
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values, strict=True)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    """A count that only goes up, kept per combination of label values."""
+
+    def __init__(
+        self, registry: Registry, name: str, help: str, labels: tuple[str, ...]
+    ):
+        """Initializes the counter at zero."""
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values: dict[tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels: str, amount: float = 1.0) -> None:
+        """Adds to the count of the label values."""
+        if not self.registry.enabled:
+            return
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def value(self, *labels: str) -> float:
+        """Returns the count of the label values."""
+        return self._values.get(labels, 0.0)
+
+    def reset(self) -> None:
+        """Clears every count."""
+        with self._lock:
+            self._values.clear()
+
+    def render(self) -> list[str]:
+        """Returns the exposition lines of the counter."""
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for labels, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_label_text(self.labels, labels)} {value}")
+        return lines
+
+
+class _Series:
+    """The bucket counts, sum and count of one histogram series."""
+
+    def __init__(self, buckets: int):
+        self.counts = [0] * (buckets + 1)
+        self.sum = 0.0
+        self.count = 0
+
+
+class Histogram:
+    """The distribution of durations, kept per combination of label values."""
+
+    def __init__(
+        self,
+        registry: Registry,
+        name: str,
+        help: str,
+        labels: tuple[str, ...],
+        buckets: tuple[float, ...],
+    ):
+        """Initializes the histogram without observations."""
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self._series: dict[tuple[str, ...], _Series] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels: str) -> None:
+        """Records one observation of the label values."""
+        if not self.registry.enabled:
+            return
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = _Series(len(self.buckets))
+            series.counts[bisect.bisect_left(self.buckets, value)] += 1
+            series.sum += value
+            series.count += 1
+
+    def time(self, *labels: str) -> AbstractContextManager[object]:
+        """Times a block, also adding it to the Server-Timing of the request.
+
+        Returns:
+            A context manager observing the seconds its block takes.
+        """
+        if not self.registry.enabled:
+            return _DISABLED
+        return _Timer(self, labels)
+
+    def count(self, *labels: str) -> int:
+        """Returns the number of observations of the label values."""
+        series = self._series.get(labels)
+        return 0 if series is None else series.count
+
+    def reset(self) -> None:
+        """Clears every observation."""
+        with self._lock:
+            self._series.clear()
+
+    def render(self) -> list[str]:
+        """Returns the exposition lines of the histogram."""
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for labels, series in sorted(self._series.items()):
+            cumulative = 0
+            for bound, count in zip(
+                (*self.buckets, float("inf")), series.counts, strict=True
+            ):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                label_text = _label_text(self.labels, labels, f'le="{le}"')
+                lines.append(f"{self.name}_bucket{label_text} {cumulative}")
+            label_text = _label_text(self.labels, labels)
+            lines.append(f"{self.name}_sum{label_text} {series.sum}")
+            lines.append(f"{self.name}_count{label_text} {series.count}")
+        return lines
+
+
+class _Timer:
+    """Observes the duration of a block in a histogram."""
+
+    def __init__(self, histogram: Histogram, labels: tuple[str, ...]):
+        self.histogram = histogram
+        self.labels = labels
+        self.started = 0.0
+
+    def __enter__(self) -> "_Timer":
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(
+        self,
+        error_type: type[BaseException] | None,
+        error: BaseException | None,
+        traceback: TracebackType | None,
+    ) -> None:
+        elapsed = time.perf_counter() - self.started
+        self.histogram.observe(elapsed, *self.labels)
+        timings = _request_timings.get()
+        if timings is not None:
+            timings.append((self.histogram.name.removesuffix("_seconds"), elapsed))
+
+
+@contextmanager
+def server_timing() -> Iterator[list[tuple[str, float]]]:
+    """Collects the timers that finish in the current context.
+
+    Timers in tasks created inside the block are collected too; work handed
+    to executor threads is not.
+
+    Yields:
+        The name and seconds of every finished timer, in order.
+    """
+    timings: list[tuple[str, float]] = []
+    token = _request_timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _request_timings.reset(token)
+
+
+def server_timing_header(timings: list[tuple[str, float]]) -> str:
+    """Formats timings as a Server-Timing header value, in milliseconds."""
+    return ", ".join(f"{name};dur={seconds * 1000:.3f}" for name, seconds in timings)
+
+
+registry = Registry()
@@ -0,0 +1,476 @@
+"""Quantized vector indexes for compact storage and fast approximate scans.
+
+The indexes keep one code per database row, in row order, and score a query
+against the codes with asymmetric distance computation: the query stays in
+float32 and only the stored vectors are approximated. The search service can
+re-rank the best candidates with the exact float32 vectors.
+"""
+
+import logging
+import os
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import Any, ClassVar
+
+import numpy as np
+import numpy.typing as npt
+
+from embedding_server.similarity import top_k_indices
+
+logging.basicConfig(level=logging.DEBUG if "DEBUG" in os.environ else logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Rows per block when scoring or encoding, bounding the temporary memory used.
+SCORE_BLOCK_ROWS = 65536
+
+
+def kmeans(
+    vectors: npt.NDArray[np.float32],
+    clusters: int,
+    iterations: int = 20,
+    seed: int = 0,
+) -> npt.NDArray[np.float32]:
+    """Clusters vectors by Euclidean distance.
+
+    Args:
+        vectors: The vectors, one per row.
+        clusters: The number of centroids, at most the number of vectors.
+        iterations: The number of assignment and update rounds.
+        seed: Seeds the initial centroids and the reseeding of empty clusters.
+
+    Returns:
+        The centroids, one per row.
+    """
+    rng = np.random.default_rng(seed)
+    centroids: npt.NDArray[np.float32] = vectors[
+        rng.choice(len(vectors), clusters, replace=False)
+    ].copy()
+    for _ in range(iterations):
+        assignments = nearest(vectors, centroids)
+        counts = np.bincount(assignments, minlength=clusters)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, vectors)
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, np.newaxis]
+        centroids[empty] = vectors[rng.choice(len(vectors), empty.sum(), replace=False)]
+    return centroids
+
+
+def nearest(
+    vectors: npt.NDArray[np.float32], centroids: npt.NDArray[np.float32]
+) -> npt.NDArray[np.intp]:
+    """Returns the index of the closest centroid by Euclidean distance per vector."""
+    distances = (
+        np.einsum("ij,ij->i", centroids, centroids)[np.newaxis, :]
+        - 2 * vectors @ centroids.T
+    )
+    assignments: npt.NDArray[np.intp] = np.argmin(distances, axis=1)
+    return assignments
+
+
+class QuantizedIndex(ABC):
+    """Codes for every database row, scored against float32 queries.
+
+    Codes are appended in row order into a buffer that doubles its capacity
+    when it is full.
+
+    Attributes:
+        fingerprint: Identifies the database rows the index was saved with, so
+            their owner can tell whether a loaded index still matches them.
+    """
+
+    kind: ClassVar[str]
+    code_dtype: ClassVar[type[np.number[Any]]]
+
+    def __init__(self, code_size: int):
+        """Initializes an empty index.
+
+        Args:
+            code_size: The number of code values per row.
+        """
+        self._codes = np.empty((0, code_size), dtype=self.code_dtype)
+        self._size = 0
+        self.fingerprint = ""
+
+    def __len__(self) -> int:
+        """Returns the number of indexed rows."""
+        return self._size
+
+    @property
+    def nbytes(self) -> int:
+        """The memory used by the codes of the indexed rows."""
+        return int(self._codes[: self._size].nbytes)
+
+    @abstractmethod
+    def encode(self, vectors: npt.NDArray[np.float32]) -> npt.NDArray[Any]:
+        """Returns the codes of unit-length vectors, one row per vector."""
+
+    @abstractmethod
+    def _scores(
+        self, query: npt.NDArray[np.float32], codes: npt.NDArray[Any]
+    ) -> npt.NDArray[np.float32]:
+        """Returns the approximate similarities of a query with a block of codes."""
+
+    @abstractmethod
+    def _parameters(self) -> dict[str, npt.NDArray[Any]]:
+        """Returns the trained parameters to persist."""
+
+    @classmethod
+    @abstractmethod
+    def _from_parameters(cls, parameters: dict[str, Any]) -> "QuantizedIndex":
+        """Builds an empty index from persisted parameters."""
+
+    def add(self, vectors: npt.NDArray[np.float32], rows: npt.ArrayLike) -> None:
+        """Appends the codes of vectors.
+
+        Args:
+            vectors: Unit-length vectors, one per row.
+            rows: The database rows of the vectors, which must follow the
+                indexed ones.
+
+        Raises:
+            ValueError: If the rows do not continue the indexed rows.
+        """
+        rows = np.asarray(rows)
+        if len(rows) and (rows[0] != self._size or rows[-1] != self._size + len(rows) - 1):
+            raise ValueError("Quantized indexes need rows in database order")
+        for start in range(0, len(vectors), SCORE_BLOCK_ROWS):
+            self._append(self.encode(vectors[start : start + SCORE_BLOCK_ROWS]))
+
+    def _append(self, codes: npt.NDArray[Any]) -> None:
+        """Appends codes, doubling the capacity when the buffer is full."""
+        needed = self._size + len(codes)
+        if needed > len(self._codes):
+            grown = np.empty(
+                (max(needed, 2 * len(self._codes), 16), self._codes.shape[1]),
+                dtype=self.code_dtype,
+            )
+            grown[: self._size] = self._codes[: self._size]
+            self._codes = grown
+        self._codes[self._size : needed] = codes
+        self._size = needed
+
+    def search(
+        self,
+        query: npt.NDArray[np.float32],
+        k: int,
+        mask: npt.NDArray[np.bool_] | None = None,
+        stop: int | None = None,
+    ) -> tuple[npt.NDArray[np.float32], npt.NDArray[np.int64]]:
+        """Finds the rows with the highest approximate similarity to a query.
+
+        Args:
+            query: A unit-length query vector.
+            k: The number of results.
+            mask: Flags the rows that may be returned, all if None. Only the
+                codes of flagged rows are scored.
+            stop: Only rows before it are scored, such as the rows of a
+                snapshot the index has grown past. Unbounded if None.
+
+        Returns:
+            The approximate cosine similarities and rows of at most k results,
+            best first.
+        """
+        size = self._size if stop is None else min(self._size, stop)
+        if mask is None:
+            scores = np.empty(size, dtype=np.float32)
+            for start in range(0, size, SCORE_BLOCK_ROWS):
+                end = min(start + SCORE_BLOCK_ROWS, size)
+                scores[start:end] = self._scores(query, self._codes[start:end])
+            best = top_k_indices(scores, k)
+            return scores[best], best.astype(np.int64)
+        rows = np.flatnonzero(mask[:size]).astype(np.int64)
+        scores = np.empty(len(rows), dtype=np.float32)
+        for start in range(0, len(rows), SCORE_BLOCK_ROWS):
+            block = rows[start : start + SCORE_BLOCK_ROWS]
+            scores[start : start + len(block)] = self._scores(query, self._codes[block])
+        best = top_k_indices(scores, k)
+        return scores[best], rows[best]
+
+    def save(self, path: Path) -> None:
+        """Writes the index to a `.npz` file atomically.
+
+        Args:
+            path: The destination file.
+        """
+        temporary = path.with_name(f"{path.name}.tmp")
+        with Path.open(temporary, "wb") as file:
+            np.savez(
+                file,
+                codes=self._codes[: self._size],
+                fingerprint=np.array(self.fingerprint),
+                **self._parameters(),
+            )
+        temporary.replace(path)
+        logger.debug(
+            "Quantized index saved.",
+            extra={"path": str(path), "kind": self.kind, "rows": len(self)},
+        )
+
+    @classmethod
+    def load(cls, path: Path) -> "QuantizedIndex":
+        """Reads an index written by `save`.
+
+        Args:
+            path: The `.npz` file.
+
+        Returns:
+            The loaded index.
+        """
+        with np.load(path) as arrays:
+            parameters = {name: arrays[name] for name in arrays.files}
+        index = cls._from_parameters(parameters)
+        index._append(parameters["codes"])
+        index.fingerprint = str(parameters.get("fingerprint", ""))
+        return index
+
+
+class ScalarQuantizedIndex(QuantizedIndex):
+    """Stores each dimension as an int8 with a per-dimension offset and scale.
+
+    Rows take one byte per dimension, a quarter of float32. A query is scored
+    as `codes @ (query * scale)` plus a per-query constant.
+    """
+
+    kind = "int8"
+    code_dtype = np.int8
+
+    def __init__(self, offset: npt.NDArray[np.float32], scale: npt.NDArray[np.float32]):
+        """Initializes an empty index.
+
+        Args:
+            offset: The value of each dimension that code -128 stands for.
+            scale: The step between codes of each dimension.
+        """
+        super().__init__(len(offset))
+        self.offset = offset.astype(np.float32)
+        self.scale = scale.astype(np.float32)
+
+    @classmethod
+    def train(cls, vectors: npt.NDArray[np.float32]) -> "ScalarQuantizedIndex":
+        """Fits the range of every dimension.
+
+        Args:
+            vectors: Unit-length training vectors, one per row.
+
+        Returns:
+            An empty trained index.
+        """
+        low, high = vectors.min(axis=0), vectors.max(axis=0)
+        scale = (high - low) / 255
+        scale[scale == 0] = 1.0
+        return cls(low, scale)
+
+    def encode(self, vectors: npt.NDArray[np.float32]) -> npt.NDArray[np.int8]:
+        """Rounds every dimension to the nearest of its 256 levels."""
+        levels = np.rint((vectors - self.offset) / self.scale)
+        codes: npt.NDArray[np.int8] = (np.clip(levels, 0, 255) - 128).astype(np.int8)
+        return codes
+
+    def _scores(
+        self, query: npt.NDArray[np.float32], codes: npt.NDArray[Any]
+    ) -> npt.NDArray[np.float32]:
+        """Scores decoded rows `offset + scale * (codes + 128)` against a query."""
+        weights = query * self.scale
+        constant = float(query @ self.offset + 128 * weights.sum())
+        scores: npt.NDArray[np.float32] = codes.astype(np.float32) @ weights + constant
+        return scores
+
+    def _parameters(self) -> dict[str, npt.NDArray[Any]]:
+        """Returns the offsets and scales."""
+        return {"offset": self.offset, "scale": self.scale}
+
+    @classmethod
+    def _from_parameters(cls, parameters: dict[str, Any]) -> "ScalarQuantizedIndex":
+        """Builds an empty index from persisted offsets and scales."""
+        return cls(parameters["offset"], parameters["scale"])
+
+
+class ProductQuantizedIndex(QuantizedIndex):
+    """Splits vectors into subspaces and stores each part as a centroid number.
+
+    With 256 centroids per subspace a row takes one byte per subspace, e.g. 96
+    bytes instead of 3072 for 768 float32 dimensions in 96 subspaces. A query
+    is scored by summing, over the subspaces, the precomputed similarity of
+    the query part with the centroid each row refers to.
+    """
+
+    kind = "pq"
+    code_dtype = np.uint8
+
+    def __init__(self, centroids: npt.NDArray[np.float32]):
+        """Initializes an empty index.
+
+        Args:
+            centroids: The centroids of each subspace, shaped
+                (subspaces, centroids per subspace, dimensions per subspace).
+        """
+        super().__init__(len(centroids))
+        self.centroids = centroids.astype(np.float32)
+
+    @classmethod
+    def train(
+        cls,
+        vectors: npt.NDArray[np.float32],
+        subspaces: int = 96,
+        sample_size: int = 65536,
+        seed: int = 0,
+    ) -> "ProductQuantizedIndex":
+        """Fits a codebook of at most 256 centroids per subspace.
+
+        Args:
+            vectors: Unit-length training vectors, one per row.
+            subspaces: The number of subspaces, a divisor of the dimensions.
+            sample_size: The most vectors used for training.
+            seed: Seeds the sampling and the clustering.
+
+        Returns:
+            An empty trained index.
+
+        Raises:
+            ValueError: If the dimensions are not divisible by the subspaces.
+        """
+        dimensions = vectors.shape[1]
+        if dimensions % subspaces:
+            raise ValueError(f"{dimensions} dimensions do not split into {subspaces}")
+        if len(vectors) > sample_size:
+            rng = np.random.default_rng(seed)
+            vectors = vectors[np.sort(rng.choice(len(vectors), sample_size, replace=False))]
+        clusters = min(256, len(vectors))
+        logger.info(
+            "Training product quantizer.",
+            extra={"subspaces": subspaces, "rows": len(vectors)},
+        )
+        parts = np.asarray(vectors, dtype=np.float32).reshape(len(vectors), subspaces, -1)
+        return cls(
+            np.stack(
+                [kmeans(parts[:, i], clusters, seed=seed + i) for i in range(subspaces)]
+            )
+        )
+
+    def encode(self, vectors: npt.NDArray[np.float32]) -> npt.NDArray[np.uint8]:
+        """Replaces every part of every vector by its closest centroid."""
+        subspaces = len(self.centroids)
+        parts = vectors.reshape(len(vectors), subspaces, -1)
+        codes = np.empty((len(vectors), subspaces), dtype=np.uint8)
+        for i in range(subspaces):
+            codes[:, i] = nearest(parts[:, i], self.centroids[i])
+        return codes
+
+    def _scores(
+        self, query: npt.NDArray[np.float32], codes: npt.NDArray[Any]
+    ) -> npt.NDArray[np.float32]:
+        """Sums the query-centroid similarities looked up for every subspace."""
+        subspaces, clusters, _ = self.centroids.shape
+        table = np.einsum(
+            "scd,sd->sc", self.centroids, query.reshape(subspaces, -1)
+        ).ravel()
+        offsets = np.arange(subspaces) * clusters
+        scores: npt.NDArray[np.float32] = table[codes + offsets].sum(axis=1)
+        return scores
+
+    def _parameters(self) -> dict[str, npt.NDArray[Any]]:
+        """Returns the codebook."""
+        return {"centroids": self.centroids}
+
+    @classmethod
+    def _from_parameters(cls, parameters: dict[str, Any]) -> "ProductQuantizedIndex":
+        """Builds an empty index from a persisted codebook."""
+        return cls(parameters["centroids"])
+
+
+class ProjectedIndex(QuantizedIndex):
+    """Stores each row projected onto the principal components of the corpus.
+
+    Rows take `components` float32 values instead of one per dimension, e.g.
+    96 instead of 768, so a coarse scan reads an eighth of the memory. A row
+    is approximated as `mean + components.T @ code`, so a query is scored as
+    `codes @ (components @ query) + mean @ query`.
+    """
+
+    kind = "pca"
+    code_dtype = np.float32
+
+    def __init__(self, mean: npt.NDArray[np.float32], components: npt.NDArray[np.float32]):
+        """Initializes an empty index.
+
+        Args:
+            mean: The mean of the training vectors.
+            components: The orthonormal principal components, one per row,
+                most significant first.
+        """
+        super().__init__(len(components))
+        self.mean = mean.astype(np.float32)
+        self.components = components.astype(np.float32)
+
+    @classmethod
+    def train(
+        cls,
+        vectors: npt.NDArray[np.float32],
+        components: int = 96,
+        sample_size: int = 65536,
+        seed: int = 0,
+    ) -> "ProjectedIndex":
+        """Fits the principal components of a sample of the vectors.
+
+        Args:
+            vectors: Unit-length training vectors, one per row.
+            components: The number of components kept, at most the dimensions.
+            sample_size: The most vectors used for training.
+            seed: Seeds the sampling.
+
+        Returns:
+            An empty trained index.
+
+        Raises:
+            ValueError: If more components than dimensions are requested.
+        """
+        dimensions = vectors.shape[1]
+        if not 0 < components <= dimensions:
+            raise ValueError(f"Cannot keep {components} of {dimensions} dimensions")
+        if len(vectors) > sample_size:
+            rng = np.random.default_rng(seed)
+            vectors = vectors[np.sort(rng.choice(len(vectors), sample_size, replace=False))]
+        logger.info(
+            "Fitting principal components.",
+            extra={"components": components, "rows": len(vectors)},
+        )
+        sample = np.asarray(vectors, dtype=np.float64)
+        mean = sample.mean(axis=0)
+        centered = sample - mean
+        # The eigenvectors of the covariance, in ascending order of variance.
+        _, eigenvectors = np.linalg.eigh(centered.T @ centered)
+        return cls(
+            mean.astype(np.float32),
+            eigenvectors[:, ::-1][:, :components].T.astype(np.float32),
+        )
+
+    def encode(self, vectors: npt.NDArray[np.float32]) -> npt.NDArray[np.float32]:
+        """Projects the centered vectors onto the components."""
+        codes: npt.NDArray[np.float32] = (vectors - self.mean) @ self.components.T
+        return codes
+
+    def _scores(
+        self, query: npt.NDArray[np.float32], codes: npt.NDArray[Any]
+    ) -> npt.NDArray[np.float32]:
+        """Scores the approximated rows against a query in the reduced space."""
+        scores: npt.NDArray[np.float32] = codes @ (self.components @ query) + float(
+            self.mean @ query
+        )
+        return scores
+
+    def _parameters(self) -> dict[str, npt.NDArray[Any]]:
+        """Returns the mean and components."""
+        return {"mean": self.mean, "components": self.components}
+
+    @classmethod
+    def _from_parameters(cls, parameters: dict[str, Any]) -> "ProjectedIndex":
+        """Builds an empty index from a persisted mean and components."""
+        return cls(parameters["mean"], parameters["components"])
+
+
+# The quantized index classes by the index type that selects them.
+QUANTIZED_INDEXES: dict[str, type[QuantizedIndex]] = {
+    index.kind: index
+    for index in (ScalarQuantizedIndex, ProductQuantizedIndex, ProjectedIndex)
+}
@@ -0,0 +1,274 @@
+"""Retries, hedged requests and a circuit breaker for calls to the embedding API."""
+
+import asyncio
+import logging
+import os
+import random
+import time
+from collections import deque
+from collections.abc import Awaitable, Callable
+from dataclasses import dataclass
+from typing import TypeVar
+
+import httpx
+
+from embedding_server.gibson.exceptions import (
+    CircuitOpenError,
+    DeadlineExceededError,
+    FlakyNetworkException,
+    UpstreamError,
+)
+from embedding_server.metrics import registry
+
+logging.basicConfig(level=logging.DEBUG if "DEBUG" in os.environ else logging.INFO)
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+retries = registry.counter(
+    "embedding_retries_total", "Embedding calls retried after a transient error."
+)
+hedges = registry.counter(
+    "embedding_hedged_requests_total", "Second requests sent for slow embedding calls."
+)
+rejections = registry.counter(
+    "embedding_circuit_rejections_total", "Embedding calls failed fast by the breaker."
+)
+
+
+@dataclass(frozen=True)
+class RetryPolicy:
+    """How calls to the embedding API are retried and hedged.
+
+    Attributes:
+        attempts: The most attempts per call, the first one included.
+        base_delay: The backoff ceiling before the first retry, in seconds.
+        multiplier: The factor the backoff ceiling grows by per retry.
+        max_delay: The largest backoff ceiling, in seconds.
+        deadline: Seconds a call may take including its retries, or None.
+        hedge_quantile: Once an attempt has taken longer than this quantile of
+            recent latencies, a second request is sent and the first answer
+            wins. Hedging is disabled if None.
+        hedge_min_samples: The latencies observed before hedging starts.
+    """
+
+    attempts: int = 5
+    base_delay: float = 0.1
+    multiplier: float = 2.0
+    max_delay: float = 2.0
+    deadline: float | None = 10.0
+    hedge_quantile: float | None = None
+    hedge_min_samples: int = 20
+
+    def delay(self, retry: int) -> float:
+        """Returns a backoff before a retry, with full jitter.
+
+        Args:
+            retry: The number of retries made so far.
+
+        Returns:
+            A random delay up to the exponentially growing ceiling, so callers
+            that failed together do not retry together.
+        """
+        ceiling = min(self.max_delay, self.base_delay * self.multiplier**retry)
+        return random.uniform(0, ceiling)
+
+
+def is_transient(error: BaseException) -> bool:
+    """Returns whether an error of the embedding API is worth retrying."""
+    if isinstance(error, UpstreamError):
+        return error.retryable
+    return isinstance(error, FlakyNetworkException | httpx.TransportError)
+
+
+class LatencyTracker:
+    """The latencies of recent successful calls."""
+
+    def __init__(self, window: int = 256):
+        """Initializes an empty tracker.
+
+        Args:
+            window: The number of latest latencies kept.
+        """
+        self._samples: deque[float] = deque(maxlen=window)
+
+    def __len__(self) -> int:
+        """Returns the number of kept latencies."""
+        return len(self._samples)
+
+    def record(self, seconds: float) -> None:
+        """Adds the latency of a successful call."""
+        self._samples.append(seconds)
+
+    def quantile(self, q: float) -> float:
+        """Returns a quantile of the kept latencies, 0 if there are none."""
+        if not self._samples:
+            return 0.0
+        ordered = sorted(self._samples)
+        return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+
+class CircuitBreaker:
+    """Fails calls fast while the embedding API keeps failing.
+
+    The breaker opens after `failure_threshold` transient failures in a row.
+    While open, calls are rejected without reaching the API. After
+    `reset_timeout` seconds it lets a single trial call through: success
+    closes it, failure opens it again.
+    """
+
+    def __init__(
+        self,
+        failure_threshold: int = 20,
+        reset_timeout: float = 30.0,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        """Initializes a closed breaker.
+
+        Args:
+            failure_threshold: Consecutive failures that open the breaker.
+            reset_timeout: Seconds the breaker stays open before a trial call.
+            clock: Returns the current time in seconds.
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.failures = 0
+        self._opened_at: float | None = None
+        # When the trial call of a half-open breaker started, if one is running.
+        self._trial_started: float | None = None
+
+    @property
+    def state(self) -> str:
+        """The breaker state: closed, open, or half_open once a trial call is due."""
+        if self._opened_at is None:
+            return "closed"
+        if self.clock() - self._opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def allow(self) -> None:
+        """Admits a call.
+
+        Raises:
+            CircuitOpenError: If the breaker is open, or a trial call is
+                already in flight. A trial call that never reports back is
+                given up on after `reset_timeout`.
+        """
+        state = self.state
+        if state == "closed":
+            return
+        now = self.clock()
+        if state == "open" or (
+            self._trial_started is not None
+            and now - self._trial_started < self.reset_timeout
+        ):
+            rejections.inc()
+            raise CircuitOpenError("Embedding service unavailable, circuit open")
+        self._trial_started = now
+
+    def record_success(self) -> None:
+        """Closes the breaker after a successful call."""
+        self.failures = 0
+        self._opened_at = None
+        self._trial_started = None
+
+    def record_failure(self) -> None:
+        """Counts a transient failure, opening the breaker at the threshold."""
+        self.failures += 1
+        if self._trial_started is not None or self.failures >= self.failure_threshold:
+            if self._opened_at is None:
+                logger.warning("Opening the embedding circuit breaker.")
+            self._opened_at = self.clock()
+        self._trial_started = None
+
+    def reset(self) -> None:
+        """Closes the breaker and forgets past failures."""
+        self.record_success()
+
+
+async def _hedged(call: Callable[[], Awaitable[T]], delay: float) -> T:
+    """Awaits a call, racing a second one if the first is slower than delay."""
+    first = asyncio.ensure_future(call())
+    pending = {first}
+    try:
+        done, pending = await asyncio.wait(pending, timeout=delay)
+        if done:
+            return first.result()
+        hedges.inc()
+        pending.add(asyncio.ensure_future(call()))
+        error: BaseException | None = None
+        while pending:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                error = task.exception()
+        assert error is not None
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def call_with_retries(
+    call: Callable[[], Awaitable[T]],
+    policy: RetryPolicy,
+    breaker: CircuitBreaker | None = None,
+    latencies: LatencyTracker | None = None,
+) -> T:
+    """Calls the embedding API, retrying transient failures.
+
+    Args:
+        call: Starts one attempt.
+        policy: The attempts, backoff, deadline and hedging of the call.
+        breaker: Rejects the attempts while the API keeps failing, if given.
+            Failures are recorded by the upstream request rather than here,
+            so callers sharing a coalesced request count as one.
+        latencies: The latencies the hedging delay is derived from, updated
+            with the latency of the call.
+
+    Returns:
+        The result of the first successful attempt.
+
+    Raises:
+        CircuitOpenError: If the breaker rejects an attempt.
+        DeadlineExceededError: If the deadline passes first.
+        EmbeddingServiceError: The error of the last attempt, once the
+            attempts are used up, or any error that is not transient.
+    """
+    try:
+        async with asyncio.timeout(policy.deadline):
+            for attempt in range(policy.attempts):
+                if breaker is not None:
+                    breaker.allow()
+                started = time.monotonic()
+                try:
+                    if (
+                        policy.hedge_quantile is not None
+                        and latencies is not None
+                        and len(latencies) >= policy.hedge_min_samples
+                    ):
+                        delay = latencies.quantile(policy.hedge_quantile)
+                        result = await _hedged(call, delay)
+                    else:
+                        result = await call()
+                except Exception as error:
+                    if not is_transient(error):
+                        raise
+                    logger.info(f"Embedding attempt failed: {error!r}")
+                    if attempt == policy.attempts - 1:
+                        raise
+                    retries.inc()
+                    await asyncio.sleep(policy.delay(attempt))
+                    continue
+                if latencies is not None:
+                    latencies.record(time.monotonic() - started)
+                return result
+    except TimeoutError as error:
+        raise DeadlineExceededError(
+            f"Embedding did not finish within {policy.deadline}s"
+        ) from error
+    raise AssertionError("A retry policy needs at least one attempt")
@@ -1,64 +1,652 @@
 """Search Service that implements embeddings search by similarity metric."""
 
+import hashlib
+import json
 import logging
 import os
+from collections.abc import Sequence
+from concurrent.futures import Executor
+from dataclasses import dataclass
 from pathlib import Path
-from typing import Any
 
 import numpy as np
 import numpy.typing as npt
-import pandas as pd
 
-from embedding_server.gibson.database import AsyncEmbeddingDatabase
+from embedding_server.cache import EmbeddingCache, ResultCache
+from embedding_server.gibson.database import AsyncEmbeddingDatabase, Snapshot, text_id
 from embedding_server.gibson.embedding import AsyncEmbeddingService
-from embedding_server.utils import get_embedding
+from embedding_server.gibson.metadata import Filters
+from embedding_server.gibson.records import RecordStore
+from embedding_server.gibson.vectors import VectorStore
+from embedding_server.index import IVFIndex
+from embedding_server.metrics import registry
+from embedding_server.quantization import (
+    QUANTIZED_INDEXES,
+    ProductQuantizedIndex,
+    ProjectedIndex,
+    QuantizedIndex,
+    ScalarQuantizedIndex,
+)
+from embedding_server.similarity import normalize, top_k_indices
+from embedding_server.utils import get_embedding, get_embeddings
 
 logging.basicConfig(level=logging.DEBUG if "DEBUG" in os.environ else logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Rows per block when computing norms, bounding the temporary memory used.
+NORM_BLOCK_ROWS = 65536
+
+# Below this many rows an exact scan is fast enough and no index is trained.
+MIN_INDEX_ROWS = 1024
+
+# The index types a search service accepts.
+INDEX_TYPES = ("exact", "ivf", *QUANTIZED_INDEXES)
+
+# Most similarity scores held at once when ranking a batch of queries; the
+# queries are scored in blocks of at most this many scores divided by the rows.
+QUERY_BLOCK_SCORES = 1 << 25
+
+search_seconds = registry.histogram(
+    "search_seconds", "Time of a similarity search, embedding the query included."
+)
+rank_seconds = registry.histogram(
+    "search_rank_seconds", "Time to score and select the best rows of a search."
+)
+
+
+@dataclass(frozen=True)
+class SimilarityMatch:
+    """A database row returned by a similarity search."""
+
+    id: str
+    text: str
+    score: float
+
+
+def row_fingerprint(ids: Sequence[str], rows: int) -> str:
+    """Identifies the first rows of a database by their number and IDs.
+
+    Storage that drops deleted rows renumbers the rows after them, which
+    changes the fingerprint of every longer prefix.
+    """
+    digest = hashlib.sha256("\n".join(ids[:rows]).encode()).hexdigest()
+    return f"{rows}:{digest}"
+
 
 class SearchEmbeddingService(AsyncEmbeddingDatabase):
-    """Provides functionality to search the embeddings database."""
+    """Provides functionality to search the embeddings database.
+
+    Search is an exact scan by default. With `index="ivf"` an IVF index, with
+    `index="int8"` or `index="pq"` a scalar or product quantized index, and
+    with `index="pca"` an index of the rows projected onto their principal
+    components, is trained once the database holds `min_index_rows` rows, kept
+    up to date on inserts and persisted beside the database as
+    `<name>.<index>.npz`. Compaction retrains it on the remaining rows.
 
+    Quantized indexes scan compact codes instead of the float32 vectors. The
+    best `rerank` times top_k candidates are then re-scored exactly from the
+    float32 vectors, which with `mmap` stay on disk apart from those rows.
+    """
 
-    def __init__(self, cache_path: Path):
+    def __init__(
+        self,
+        cache_path: Path,
+        mmap: bool = False,
+        embedding_service: AsyncEmbeddingService | None = None,
+        embedding_cache: EmbeddingCache | None = None,
+        result_cache: ResultCache[list[SimilarityMatch]] | None = None,
+        index: str = "exact",
+        nlist: int | None = None,
+        nprobe: int = 8,
+        min_index_rows: int = MIN_INDEX_ROWS,
+        rerank: int = 4,
+        subspaces: int = 96,
+        components: int = 96,
+        executor: Executor | None = None,
+        flush_delay: float = 0.0,
+        shared: bool = False,
+        compact_threshold: float | None = 0.2,
+        wal: bool = False,
+    ):
         """Initializes the Search Service.
 
         Args:
             cache_path: The path to the local cache.
+            mmap: Whether a binary database should memory-map its vector file.
+            embedding_service: The service used to embed queries.
+            embedding_cache: The cache consulted before embedding queries.
+            result_cache: The cache of search results, kept until rows change.
+            index: "exact" for brute-force search, "ivf" for the IVF index,
+                "int8" or "pq" for a scalar or product quantized index, or
+                "pca" for the principal components index.
+            nlist: The number of IVF lists, the square root of the rows if None.
+            nprobe: The number of IVF lists scanned per query.
+            min_index_rows: The number of rows needed to train the index.
+            rerank: Candidates per requested result that a quantized index
+                re-scores exactly, or 0 to return the approximate scores.
+            subspaces: The number of product quantization subspaces.
+            components: The dimensions the principal components index keeps.
+            executor: Runs blocking work, the event loop's default executor if None.
+            flush_delay: Seconds a flush waits for more inserts to join it.
+            shared: Whether other processes read and write the same database.
+            compact_threshold: The fraction of deleted rows that starts a
+                background compaction, or None to only compact on request.
+            wal: Whether a directory database uses the write-ahead log backend.
+
+        Raises:
+            ValueError: If the index type is unknown, or a shared database does
+                not use the binary backend.
         """
-        super().__init__(cache_path)
-
-    def _cosine_similarity(
-        self, embedding1: list[float], embedding2: npt.NDArray[Any]
-    ) -> float:
-        return float(
-            np.dot(embedding1, embedding2)
-            / (np.linalg.norm(embedding1) * np.linalg.norm(embedding2))
+        if index not in INDEX_TYPES:
+            raise ValueError(f"Unknown index type {index!r}")
+        super().__init__(
+            cache_path,
+            mmap=mmap,
+            executor=executor,
+            flush_delay=flush_delay,
+            shared=shared,
+            compact_threshold=compact_threshold,
+            wal=wal,
+        )
+        self.embedding_service = embedding_service or AsyncEmbeddingService()
+        self.embedding_cache = embedding_cache
+        self.result_cache = result_cache
+        self.index_type = index
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.min_index_rows = min_index_rows
+        self.rerank = rerank
+        self.subspaces = subspaces
+        self.components = components
+        self.index: IVFIndex | QuantizedIndex | None = None
+        self._indexing = False
+        # The inverse norms of the first rows of a record store, replaced in one
+        # assignment so that threads always see a consistent pair.
+        self._inverse_norms: tuple[RecordStore | None, npt.NDArray[np.float32]] = (
+            None,
+            np.empty(0, dtype=np.float32),
         )
 
+    @property
+    def index_path(self) -> Path:
+        """The file the index is persisted to, beside the database."""
+        return self.cache_path.with_name(
+            f"{self.cache_path.name}.{self.index_type}.npz"
+        )
+
+    async def setup(self) -> None:
+        """Loads the database and its index when one is configured.
+
+        A persisted index is only used if the rows it covers are still stored
+        under the same row numbers, which a full save dropping deleted rows
+        changes. Otherwise a new index is trained.
+        """
+        await super().setup()
+        if self.index_type != "exact" and self.index_path.exists():
+            self.index = await self._run(self._load_index)
+            fingerprint = row_fingerprint(self.records.ids, len(self.index))
+            if self.index.fingerprint != fingerprint:
+                logger.warning("Index does not match the stored rows, retraining.")
+                self.index = None
+        await self._sync_index()
+
+    def _load_index(self) -> IVFIndex | QuantizedIndex:
+        """Reads the persisted index of the configured type."""
+        if self.index_type == "ivf":
+            return IVFIndex.load(self.index_path, self.nprobe)
+        return QUANTIZED_INDEXES[self.index_type].load(self.index_path)
+
+    async def _commit(self) -> None:
+        """Persists the rows added in memory and adds them to the index."""
+        await super()._commit()
+        await self._sync_index()
+
+    async def refresh(self) -> bool:
+        """Picks up rows other processes added and adds them to the index."""
+        refreshed = await super().refresh()
+        if refreshed:
+            await self._sync_index()
+        return refreshed
+
+    async def _sync_index(self) -> None:
+        """Trains the index when due and adds rows it does not cover yet.
+
+        Training runs on the executor. Rows inserted meanwhile are added once it
+        finishes, by the call that started it. An index trained on rows that a
+        compaction replaced meanwhile is dropped, as the compaction trains its own.
+        """
+        if self.index_type == "exact" or self._indexing:
+            return
+        self._indexing = True
+        try:
+            if self.index is None:
+                store = self.vectors
+                if len(store) < self.min_index_rows:
+                    return
+                index = await self._run(self._train_index, store)
+                if store is not self.vectors:
+                    return
+                self.index = index
+                await self._run(self.save_index)
+            assert self.index is not None
+            start, stop = len(self.index), len(self.vectors)
+            if start < stop:
+                vectors = normalize(self.vectors.to_array(start, stop))
+                self.index.add(vectors, np.arange(start, stop))
+        finally:
+            self._indexing = False
+
+    def rebuild_index(self) -> None:
+        """Trains a new index of the configured type on every row and persists it."""
+        self.index = self._train_index(self.vectors)
+        self.save_index()
+
+    def _train_index(self, store: VectorStore) -> IVFIndex | QuantizedIndex:
+        """Trains an index of the configured type on the rows of a vector store."""
+        vectors = normalize(store.to_array(0, len(store)))
+        index: IVFIndex | QuantizedIndex
+        if self.index_type == "ivf":
+            nlist = self.nlist or max(1, round(np.sqrt(len(vectors))))
+            index = IVFIndex.train(vectors, nlist, nprobe=self.nprobe)
+        elif self.index_type == "pq":
+            index = ProductQuantizedIndex.train(vectors, self.subspaces)
+        elif self.index_type == "pca":
+            index = ProjectedIndex.train(vectors, self.components)
+        else:
+            index = ScalarQuantizedIndex.train(vectors)
+        index.add(vectors, np.arange(len(vectors)))
+        return index
+
+    async def _swap_rows(self, records: RecordStore, vectors: VectorStore) -> None:
+        """Swaps in compacted rows together with an index trained on them.
+
+        The index is trained before the swap, so searches never pair an index
+        with the rows of the other side of it. Deleted rows stay in the old
+        index, masked out, until then.
+        """
+        index = None
+        if self.index_type != "exact" and len(vectors) >= self.min_index_rows:
+            index = await self._run(self._train_index, vectors)
+        await super()._swap_rows(records, vectors)
+        self.index = index
+        if index is not None:
+            await self._run(self.save_index)
+
+    def save_index(self) -> None:
+        """Persists the index beside the database if there is one."""
+        if self.index is not None:
+            self.index.fingerprint = row_fingerprint(
+                self.records.ids, len(self.index)
+            )
+            self.index.save(self.index_path)
+
+    def _inverse_norms_for(self, snapshot: Snapshot) -> npt.NDArray[np.float32]:
+        """Returns the inverse norms of the rows in a snapshot.
+
+        Norms are computed lazily in blocks so that opening a memory-mapped
+        database does not touch the vector data, and only for rows added since
+        the last search. Concurrent searches may compute the same new norms.
+        They are cached per record store, so compacted rows start afresh.
+        """
+        segments = snapshot.segments
+        owner, known = self._inverse_norms
+        if owner is not snapshot.records:
+            known = np.empty(0, dtype=np.float32)
+        count = sum(len(segment) for segment in segments)
+        if len(known) >= count:
+            return known[:count]
+        blocks = [known]
+        offset = 0
+        for segment in segments:
+            start = max(len(known) - offset, 0)
+            for block_start in range(start, len(segment), NORM_BLOCK_ROWS):
+                block = segment[block_start : block_start + NORM_BLOCK_ROWS]
+                norms = np.linalg.norm(block, axis=1)
+                norms[norms == 0] = 1.0
+                blocks.append((1.0 / norms).astype(np.float32))
+            offset += len(segment)
+        inverse_norms = np.concatenate(blocks)
+        if owner is not snapshot.records or len(inverse_norms) > len(known):
+            self._inverse_norms = (snapshot.records, inverse_norms)
+        return inverse_norms
+
+    def _similarities(
+        self, query: npt.NDArray[np.float32], snapshot: Snapshot
+    ) -> npt.NDArray[np.float32]:
+        """Computes the cosine similarity of every row with a unit-length query."""
+        segments = snapshot.segments
+        if not segments:
+            return np.empty(0, dtype=np.float32)
+        dots = np.concatenate([segment @ query for segment in segments])
+        similarities: npt.NDArray[np.float32] = dots * self._inverse_norms_for(
+            snapshot
+        )
+        return similarities
 
     async def find_similar_embeddings(
-        self, query_text: str, top_k: int = 5
+        self, query_text: str, top_k: int = 5, filters: Filters | None = None
     ) -> list[str]:
         """Finds the most similar embeddings given a query and returns a list.
 
         Args:
             query_text: a string with the query to search similarities for.
             top_k: default number of items to return in descending order.
+            filters: The metadata values the returned rows must have.
 
         Returns:
             A list of matching embeddings in descending order.
 
         Raises:
-            FlakyNetworkException after 5 retries expire.
+            EmbeddingServiceError once the retry policy gives up.
+        """
+        matches = await self.find_similar(query_text, top_k, filters=filters)
+        return [match.text for match in matches]
+
+    async def find_similar(
+        self,
+        query_text: str,
+        top_k: int = 5,
+        offset: int = 0,
+        min_score: float | None = None,
+        filters: Filters | None = None,
+    ) -> list[SimilarityMatch]:
+        """Finds a page of the rows most similar to a query.
+
+        Only the best offset + top_k rows are selected and sorted, not every row.
+        With a result cache, repeating a search while the rows are unchanged
+        skips both embedding the query and scoring.
+
+        Args:
+            query_text: The query to search similarities for.
+            top_k: The number of matches to return.
+            offset: The number of best matches to skip.
+            min_score: The lowest similarity returned, unbounded if None.
+            filters: The metadata values the returned rows must have, e.g.
+                `{"tenant": "x", "language": ["en", "de"]}`. Rows that do not
+                match are excluded before scoring.
+
+        Returns:
+            The matches in descending order of similarity.
+
+        Raises:
+            EmbeddingServiceError once the retry policy gives up.
+        """
+        with search_seconds.time():
+            await self.refresh()
+            key = (
+                text_id(query_text),
+                top_k,
+                offset,
+                min_score,
+                json.dumps(filters, sort_keys=True) if filters else None,
+            )
+            if self.result_cache is not None:
+                cached = self.result_cache.get(key, self.generation)
+                if cached is not None:
+                    return list(cached)
+
+            query_embedding = await get_embedding(
+                self.embedding_service, query_text, cache=self.embedding_cache
+            )
+            generation = self.generation
+            snapshot = self.snapshot()
+            mask = self._mask(filters, snapshot)
+            with rank_seconds.time():
+                scores, rows = await self._run(
+                    self._rank,
+                    normalize(query_embedding),
+                    offset + top_k,
+                    snapshot,
+                    mask,
+                )
+            matches = self._matches(
+                scores[offset:], rows[offset:], snapshot, min_score
+            )
+            if self.result_cache is not None:
+                self.result_cache.put(key, generation, list(matches))
+            return matches
+
+    @staticmethod
+    def _mask(
+        filters: Filters | None, snapshot: Snapshot
+    ) -> npt.NDArray[np.bool_] | None:
+        """Flags the live rows of a snapshot matching filters.
+
+        Returns:
+            The mask, or None if every row qualifies, which is the case without
+            filters until a row is deleted.
+        """
+        live = snapshot.records.live_mask(len(snapshot))
+        if not filters:
+            return live
+        mask = snapshot.records.mask(filters, len(snapshot))
+        return mask if live is None else mask & live
+
+    @staticmethod
+    def _matches(
+        scores: npt.NDArray[np.float32],
+        rows: npt.NDArray[np.intp],
+        snapshot: Snapshot,
+        min_score: float | None = None,
+    ) -> list[SimilarityMatch]:
+        """Builds the matches of ranked rows scoring at least min_score."""
+        if min_score is not None:
+            rows = rows[scores >= min_score]
+            scores = scores[scores >= min_score]
+        ids, texts = snapshot.records.ids, snapshot.records.texts
+        return [
+            SimilarityMatch(ids[row], texts[row], float(score))
+            for score, row in zip(scores, rows, strict=True)
+        ]
+
+    async def find_similar_batch(
+        self,
+        query_texts: list[str],
+        top_k: int = 5,
+        filters: Filters | None = None,
+    ) -> list[list[SimilarityMatch]]:
+        """Finds the most similar rows for many queries at once.
+
+        The queries are embedded in one upstream batch and scored with a
+        matrix-matrix product rather than one scan per query.
+
+        Args:
+            query_texts: The queries to search similarities for.
+            top_k: The number of matches to return per query.
+            filters: The metadata values the returned rows must have.
+
+        Returns:
+            The matches of every query in descending order of similarity.
+
+        Raises:
+            EmbeddingServiceError once the retry policy gives up.
         """
-        query_embedding = await get_embedding(AsyncEmbeddingService(), query_text)
-        similarities = self.data["Embeddings"].apply(
-            lambda emb, query=query_embedding: self._cosine_similarity(query, np.array(emb))
+        if not query_texts:
+            return []
+        query_embeddings = await get_embeddings(
+            self.embedding_service, query_texts, cache=self.embedding_cache
+        )
+        return await self.search_vectors(
+            normalize(query_embeddings), top_k, filters=filters
         )
-        sorted_indices = similarities.argsort()[::-1][
-            :top_k
-        ]  # Sort in descending order
-        res: pd.Series[str] = self.data.iloc[sorted_indices]["Text"]
-        return res.astype(str).to_list()  # type: ignore
+
+    async def search_vectors(
+        self,
+        queries: npt.NDArray[np.float32],
+        top_k: int = 5,
+        min_score: float | None = None,
+        filters: Filters | None = None,
+    ) -> list[list[SimilarityMatch]]:
+        """Finds the most similar rows for queries that are already embedded.
+
+        Args:
+            queries: The normalized query embeddings, one per row.
+            top_k: The number of matches to return per query.
+            min_score: The lowest similarity returned, unbounded if None.
+            filters: The metadata values the returned rows must have.
+
+        Returns:
+            The matches of every query in descending order of similarity.
+        """
+        await self.refresh()
+        snapshot = self.snapshot()
+        mask = self._mask(filters, snapshot)
+        with rank_seconds.time():
+            ranked = await self._run(self._rank_many, queries, top_k, snapshot, mask)
+        return [
+            self._matches(scores, rows, snapshot, min_score) for scores, rows in ranked
+        ]
+
+    def _use_index(self, mask: npt.NDArray[np.bool_] | None) -> bool:
+        """Returns whether to search the index rather than scan exactly.
+
+        Filters leaving fewer rows than the index needs to be trained are
+        answered by an exact scan of just those rows, which is both cheap and
+        complete, where probing a few IVF lists may miss most of them.
+        """
+        if self.index is None:
+            return False
+        return mask is None or np.count_nonzero(mask) >= self.min_index_rows
+
+    def _rank_many(
+        self,
+        queries: npt.NDArray[np.float32],
+        top_k: int,
+        snapshot: Snapshot,
+        mask: npt.NDArray[np.bool_] | None = None,
+    ) -> list[tuple[npt.NDArray[np.float32], npt.NDArray[np.intp]]]:
+        """Finds the rows most similar to each of many unit-length queries.
+
+        Args:
+            queries: The normalized query embeddings, one per row.
+            top_k: The number of rows to return per query.
+            snapshot: The rows to search.
+            mask: Flags the rows that may be returned, all if None.
+
+        Returns:
+            The cosine similarities and rows of at most top_k results per
+            query, best first.
+        """
+        if self._use_index(mask):
+            return [self._rank(query, top_k, snapshot, mask) for query in queries]
+        return self._rank_exact(queries, top_k, snapshot, mask)
+
+    def _rank_exact(
+        self,
+        queries: npt.NDArray[np.float32],
+        top_k: int,
+        snapshot: Snapshot,
+        mask: npt.NDArray[np.bool_] | None = None,
+    ) -> list[tuple[npt.NDArray[np.float32], npt.NDArray[np.intp]]]:
+        """Scores queries against every row, or only the rows a mask flags.
+
+        When a mask leaves fewer than half of the rows, their vectors are
+        gathered once and only they are scored. Otherwise every row is scored
+        and the flagged columns are kept.
+        """
+        segments = snapshot.segments
+        rows = None if mask is None else np.flatnonzero(mask)
+        columns = rows
+        if rows is not None and 2 * len(rows) < len(snapshot):
+            vectors = self._gather(rows, snapshot)
+            norms = np.linalg.norm(vectors, axis=1)
+            norms[norms == 0] = 1.0
+            segments, inverse_norms = [vectors], (1.0 / norms).astype(np.float32)
+            columns = None
+        else:
+            inverse_norms = self._inverse_norms_for(snapshot)
+        scored = sum(len(segment) for segment in segments)
+        block_size = max(1, QUERY_BLOCK_SCORES // max(scored, 1))
+        results: list[tuple[npt.NDArray[np.float32], npt.NDArray[np.intp]]] = []
+        for start in range(0, len(queries), block_size):
+            block = queries[start : start + block_size]
+            if segments:
+                dots = np.concatenate([segment @ block.T for segment in segments])
+                similarities = (dots * inverse_norms[:, np.newaxis]).T
+            else:
+                similarities = np.empty((len(block), 0), dtype=np.float32)
+            if columns is not None:
+                similarities = similarities[:, columns]
+            best = top_k_indices(similarities, top_k)
+            results.extend(
+                zip(
+                    np.take_along_axis(similarities, best, axis=1),
+                    best if rows is None else rows[best],
+                    strict=True,
+                )
+            )
+        return results
+
+    def _rank(
+        self,
+        query: npt.NDArray[np.float32],
+        top_k: int,
+        snapshot: Snapshot,
+        mask: npt.NDArray[np.bool_] | None = None,
+    ) -> tuple[npt.NDArray[np.float32], npt.NDArray[np.intp]]:
+        """Finds the rows most similar to a unit-length query.
+
+        Args:
+            query: The normalized query embedding.
+            top_k: The number of rows to return.
+            snapshot: The rows to search.
+            mask: Flags the rows that may be returned, all if None.
+
+        Returns:
+            The cosine similarities and rows of at most top_k results, best first.
+        """
+        index = self.index
+        if index is None or not self._use_index(mask):
+            if mask is not None:
+                [result] = self._rank_exact(query[np.newaxis], top_k, snapshot, mask)
+                return result
+            similarities = self._similarities(query, snapshot)
+            best = top_k_indices(similarities, top_k)
+            return similarities[best], best
+        if isinstance(index, QuantizedIndex) and self.rerank:
+            _, candidates = index.search(
+                query, top_k * self.rerank, mask=mask, stop=len(snapshot)
+            )
+            return self._rerank(query, top_k, candidates, snapshot)
+        scores, rows = index.search(query, top_k, mask=mask, stop=len(snapshot))
+        return scores, rows.astype(np.intp)
+
+    @staticmethod
+    def _gather(
+        rows: npt.NDArray[np.intp], snapshot: Snapshot
+    ) -> npt.NDArray[np.float32]:
+        """Copies the vectors of sorted rows out of the snapshot segments."""
+        dimensions = snapshot.segments[0].shape[1] if snapshot.segments else 0
+        vectors = np.empty((len(rows), dimensions), dtype=np.float32)
+        offset = 0
+        for segment in snapshot.segments:
+            start, stop = np.searchsorted(rows, [offset, offset + len(segment)])
+            vectors[start:stop] = segment[rows[start:stop] - offset]
+            offset += len(segment)
+        return vectors
+
+    def _rerank(
+        self,
+        query: npt.NDArray[np.float32],
+        top_k: int,
+        candidates: npt.NDArray[np.int64],
+        snapshot: Snapshot,
+    ) -> tuple[npt.NDArray[np.float32], npt.NDArray[np.intp]]:
+        """Re-scores candidate rows exactly with their float32 vectors.
+
+        Args:
+            query: The normalized query embedding.
+            top_k: The number of rows to return.
+            candidates: The rows to re-score.
+            snapshot: The rows searched.
+
+        Returns:
+            The cosine similarities and rows of at most top_k results, best first.
+        """
+        rows = np.sort(candidates).astype(np.intp)
+        vectors = self._gather(rows, snapshot)
+        norms = np.linalg.norm(vectors, axis=1)
+        norms[norms == 0] = 1.0
+        similarities: npt.NDArray[np.float32] = (vectors @ query) / norms
+        best = top_k_indices(similarities, top_k)
+        return similarities[best], rows[best]
@@ -1,53 +1,439 @@
 """Main entry point for FastAPI application."""
 
+import asyncio
+import dataclasses
+import json
 import logging
 import os
+import re
+import time
+from collections.abc import AsyncIterator
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 from http import HTTPStatus
 from pathlib import Path
+from typing import Any
 
 import uvicorn
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
+from fastapi import Depends, FastAPI, HTTPException
+from fastapi.responses import PlainTextResponse, Response
+from pydantic import BaseModel, Field
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
 
+from embedding_server.cache import EmbeddingCache, ResultCache
+from embedding_server.gibson.database import InsertStatus
 from embedding_server.gibson.embedding import AsyncEmbeddingService
-from embedding_server.gibson.exceptions import FlakyNetworkException
-from embedding_server.search import SearchEmbeddingService
-from embedding_server.utils import get_embedding
+from embedding_server.gibson.exceptions import (
+    CircuitOpenError,
+    DeadlineExceededError,
+    EmbeddingServiceError,
+)
+from embedding_server.gibson.metadata import Filters, Metadata
+from embedding_server.metrics import registry, server_timing, server_timing_header
+from embedding_server.retry import CircuitBreaker, RetryPolicy
+from embedding_server.search import SearchEmbeddingService, SimilarityMatch
+from embedding_server.shards import RemoteShard, ShardedSearchService, parse_address
+from embedding_server.utils import get_embedding, get_embeddings
 
 logging.basicConfig(level=logging.DEBUG if "DEBUG" in os.environ else logging.INFO)
 logger = logging.getLogger(__name__)
 
+Database = SearchEmbeddingService | ShardedSearchService
+
 app = FastAPI(docs_url="/docs", redoc_url="/redoc")
 
-db_path = Path(__file__).parent.parent / "data" / "embeddings.json"
-db = SearchEmbeddingService(db_path)
-es = AsyncEmbeddingService()
+# A `.json` path uses the JSON backend, any other path a binary database directory.
+# Shards need a directory, so sharding defaults to one beside the JSON file.
+shard_count = int(os.environ.get("EMBEDDING_SHARDS", 1))
+db_path = Path(
+    os.environ.get(
+        "EMBEDDING_DB_PATH",
+        Path(__file__).parent.parent
+        / "data"
+        / ("embeddings" if shard_count > 1 else "embeddings.json"),
+    )
+)
+# Concurrent embed calls within this many seconds share one upstream request.
+# Transient failures are retried with jittered backoff within a deadline, slow
+# calls may be hedged, and the breaker fails calls fast during an outage.
+es = AsyncEmbeddingService(
+    batch_window=float(os.environ.get("EMBEDDING_BATCH_WINDOW", 0.005)),
+    retry_policy=RetryPolicy(
+        attempts=int(os.environ.get("EMBEDDING_RETRY_ATTEMPTS", 5)),
+        deadline=float(os.environ.get("EMBEDDING_RETRY_DEADLINE", 10.0)),
+        hedge_quantile=(
+            float(os.environ["EMBEDDING_HEDGE_QUANTILE"])
+            if "EMBEDDING_HEDGE_QUANTILE" in os.environ
+            else None
+        ),
+    ),
+    circuit_breaker=CircuitBreaker(
+        failure_threshold=int(os.environ.get("EMBEDDING_BREAKER_THRESHOLD", 20)),
+        reset_timeout=float(os.environ.get("EMBEDDING_BREAKER_RESET", 30.0)),
+    ),
+)
+# Query and insert embeddings are cached by text hash; the database rows are the
+# last tier. Test databases are isolated from the shared cache.
+embedding_cache = EmbeddingCache(
+    max_entries=int(os.environ.get("EMBEDDING_CACHE_SIZE", 10_000)),
+    directory=(
+        Path(os.environ["EMBEDDING_CACHE_DIR"])
+        if "EMBEDDING_CACHE_DIR" in os.environ
+        else None
+    ),
+)
+# Results of repeated searches are reused until the rows change.
+result_cache = ResultCache[list[SimilarityMatch]](
+    max_entries=int(os.environ.get("EMBEDDING_RESULT_CACHE_SIZE", 1024))
+)
+# Blocking load, save and search work runs on this pool; NumPy releases the GIL.
+executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("EMBEDDING_WORKERS", min(8, os.cpu_count() or 1))),
+    thread_name_prefix="embedding-db",
+)
+search_options: dict[str, Any] = {
+    "mmap": "EMBEDDING_DB_MMAP" in os.environ,
+    "index": os.environ.get("EMBEDDING_INDEX", "exact"),
+    "nprobe": int(os.environ.get("EMBEDDING_NPROBE", 8)),
+    "rerank": int(os.environ.get("EMBEDDING_RERANK", 4)),
+    "components": int(os.environ.get("EMBEDDING_PCA_COMPONENTS", 96)),
+    "executor": executor,
+    "flush_delay": float(os.environ.get("EMBEDDING_FLUSH_DELAY", 0.0)),
+    "shared": "EMBEDDING_DB_SHARED" in os.environ,
+    "wal": "EMBEDDING_DB_WAL" in os.environ,
+    "compact_threshold": float(os.environ.get("EMBEDDING_COMPACT_THRESHOLD", 0.2)),
+}
+# The corpus may be split into shards by ID, hosted in this process under the
+# database directory or by shard servers in other local processes.
+db: Database
+if "EMBEDDING_SHARD_ADDRESSES" in os.environ:
+    db = ShardedSearchService(
+        [
+            RemoteShard(
+                parse_address(address),
+                authkey=os.environ["EMBEDDING_SHARD_AUTHKEY"].encode(),
+                executor=executor,
+            )
+            for address in os.environ["EMBEDDING_SHARD_ADDRESSES"].split(",")
+        ],
+        embedding_service=es,
+        embedding_cache=embedding_cache,
+    )
+elif shard_count > 1:
+    db = ShardedSearchService.local(
+        db_path,
+        shard_count,
+        embedding_service=es,
+        embedding_cache=embedding_cache,
+        **search_options,
+    )
+else:
+    db = SearchEmbeddingService(
+        db_path,
+        embedding_service=es,
+        embedding_cache=embedding_cache,
+        result_cache=result_cache,
+        **search_options,
+    )
+    embedding_cache.database = db
+
+# Metrics are only recorded when enabled. Server-Timing headers, which show
+# clients where their request spent its time, need a flag of their own.
+server_timing_enabled = "EMBEDDING_SERVER_TIMING" in os.environ
+registry.enabled = "EMBEDDING_METRICS" in os.environ or server_timing_enabled
+http_seconds = registry.histogram(
+    "http_request_seconds",
+    "Time to handle a request, serializing the response included.",
+    labels=("path",),
+)
+
+
+def database_rows() -> int:
+    """Counts the rows of the database, or of the shards this process hosts."""
+    if isinstance(db, ShardedSearchService):
+        return sum(
+            len(shard)
+            for shard in db.shards
+            if isinstance(shard, SearchEmbeddingService)
+        )
+    return len(db)
+
+
+registry.gauge(
+    "database_rows", "Rows in the database hosted by this process.", database_rows
+)
+registry.gauge(
+    "embedding_cache_entries", "Embeddings held in memory.", lambda: len(embedding_cache)
+)
+registry.gauge(
+    "embedding_cache_hit_ratio",
+    "Fraction of embedding lookups answered by the cache.",
+    lambda: embedding_cache.hit_rate,
+)
+registry.gauge(
+    "result_cache_hit_ratio",
+    "Fraction of searches answered by the result cache.",
+    lambda: result_cache.hit_rate,
+)
+
+
+class MetricsMiddleware:
+    """Times every request and adds its Server-Timing header when enabled.
+
+    This is a plain ASGI middleware, so with metrics disabled a request only
+    pays for one flag check.
+    """
+
+    def __init__(self, app: ASGIApp):
+        """Wraps an ASGI application."""
+        self.app = app
+        # The paths of the routes, read on the first request as routes are
+        # declared after the middleware is added.
+        self._known_paths: set[str] | None = None
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        """Handles a request, timing it when metrics are enabled."""
+        if scope["type"] != "http" or not registry.enabled:
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        if self._known_paths is None:
+            self._known_paths = {getattr(route, "path", "") for route in app.routes}
+        path = scope["path"] if scope["path"] in self._known_paths else "other"
+
+        with server_timing() as timings:
+
+            async def send_with_timing(message: Message) -> None:
+                if message["type"] == "http.response.start" and server_timing_enabled:
+                    timings.append(("total", time.perf_counter() - started))
+                    header = server_timing_header(timings).encode("latin-1")
+                    message = {
+                        **message,
+                        "headers": [
+                            *message.get("headers", []),
+                            (b"server-timing", header),
+                        ],
+                    }
+                await send(message)
+
+            try:
+                await self.app(scope, receive, send_with_timing)
+            finally:
+                http_seconds.observe(time.perf_counter() - started, path)
+
+
+app.add_middleware(MetricsMiddleware)
 
 
 class EmbeddingRequest(BaseModel):
     """Represents an insert request."""
     text: str
+    metadata: Metadata = Field(default_factory=dict)
+    test_db: str | None = None
+
+
+class SimilarityRequest(EmbeddingRequest):
+    """Represents a similarity query for a page of the best matches."""
+    top_k: int = Field(default=5, ge=1, le=1000)
+    offset: int = Field(default=0, ge=0, le=10_000)
+    min_score: float | None = None
+    filters: Filters | None = None
+    stream: bool = False
+
+
+class BatchSimilarityRequest(BaseModel):
+    """Represents a batch of similarity queries."""
+    texts: list[str] = Field(min_length=1, max_length=1024)
+    top_k: int = Field(default=5, ge=1, le=1000)
+    filters: Filters | None = None
+    test_db: str | None = None
+
+
+class BatchInsertRequest(BaseModel):
+    """Represents a bulk insert request."""
+    texts: list[str] = Field(min_length=1, max_length=10_000)
+    metadata: list[Metadata] | None = None
+    test_db: str | None = None
+
+
+class BatchInsertResponse(BaseModel):
+    """Reports the outcome of a bulk insert."""
+    inserted: int
+    statuses: list[InsertStatus]
+
+
+class UpsertResponse(BaseModel):
+    """Reports the outcome of an upsert."""
+    message: str
+    replaced: bool
+
+
+class DeleteRequest(BaseModel):
+    """Represents a request to delete a row by ID."""
+    id: str
     test_db: str | None = None
 
 
+# Test databases live in the package directory and are named by the client, so
+# only bare names are accepted, optionally with the `.json` suffix.
+TEST_DB_ROOT = Path(__file__).parent
+TEST_DB_NAME = re.compile(r"[A-Za-z0-9_-]+(\.json)?")
+# Requests using test databases take turns; only tests send them.
+test_db_lock = asyncio.Lock()
+
+
+def resolve_test_db(test_db: str) -> Path:
+    """Resolves the name of a test database under the test database root.
+
+    Raises:
+        HTTPException: The name is not a bare name inside the root.
+    """
+    root = TEST_DB_ROOT.resolve()
+    path = (root / test_db).resolve()
+    if not TEST_DB_NAME.fullmatch(test_db) or path.parent != root:
+        raise HTTPException(
+            status_code=HTTPStatus.BAD_REQUEST,
+            detail=f"Invalid test database name {test_db!r}",
+        )
+    return path
+
+
+@asynccontextmanager
+async def open_database(test_db: str | None) -> AsyncIterator[Database]:
+    """Selects the database a request works on.
+
+    Args:
+        test_db: The name of a throwaway test database, or None for the shared one.
+
+    Yields:
+        The shared database, or a fresh test database that is deleted afterwards.
+    """
+    if test_db is None:
+        yield db
+        return
+
+    # If a test database is provided, use it instead of the default database.
+    # This is used in tests.
+    path = resolve_test_db(test_db)
+    async with test_db_lock:
+        test_database = SearchEmbeddingService(
+            path, embedding_service=es, executor=executor
+        )
+        test_database.storage.remove()
+        try:
+            await test_database.setup()
+            logger.info("Test database setup complete")
+            yield test_database
+        finally:
+            test_database.storage.remove()
+
+
+async def request_database(
+    request: EmbeddingRequest,
+) -> AsyncIterator[Database]:
+    """Provides the database selected by a single-text request."""
+    async with open_database(request.test_db) as database:
+        yield database
+
+
+async def similarity_request_database(
+    request: SimilarityRequest,
+) -> AsyncIterator[Database]:
+    """Provides the database selected by a similarity request."""
+    async with open_database(request.test_db) as database:
+        yield database
+
+
+async def batch_request_database(
+    request: BatchSimilarityRequest,
+) -> AsyncIterator[Database]:
+    """Provides the database selected by a batch request."""
+    async with open_database(request.test_db) as database:
+        yield database
+
+
+async def batch_insert_database(
+    request: BatchInsertRequest,
+) -> AsyncIterator[Database]:
+    """Provides the database selected by a bulk insert request."""
+    async with open_database(request.test_db) as database:
+        yield database
+
+
+async def delete_request_database(
+    request: DeleteRequest,
+) -> AsyncIterator[Database]:
+    """Provides the database selected by a delete request."""
+    async with open_database(request.test_db) as database:
+        yield database
+
+
 @app.on_event("startup")
 async def on_startup() -> None:
     """Initialize the services aynchronously on startup."""
     await db.setup()
 
 
+@app.on_event("shutdown")
+async def on_shutdown() -> None:
+    """Persist the search index and release pooled connections on shutdown."""
+    db.save_index()
+    await es.aclose()
+
+
 @app.get("/ready")
 async def ready() -> dict[str, str]:
-    """Returns a simple health check endpoint to indicate the application is ready."""
-    return {"message": "Ready"}
+    """Returns a simple health check endpoint to indicate the application is ready.
+
+    Raises:
+        HTTPException: The circuit breaker of the embedding API is open, so
+            requests needing embeddings would fail.
+    """
+    state = es.circuit_breaker.state
+    if state == "open":
+        raise HTTPException(
+            status_code=HTTPStatus.SERVICE_UNAVAILABLE,
+            detail="Embedding service unavailable, circuit open",
+        )
+    return {"message": "Ready", "embedding_circuit": state}
+
+
+def embedding_error_status(error: EmbeddingServiceError) -> HTTPStatus:
+    """Chooses the response status of a failed embedding call."""
+    if isinstance(error, CircuitOpenError):
+        return HTTPStatus.SERVICE_UNAVAILABLE
+    if isinstance(error, DeadlineExceededError):
+        return HTTPStatus.GATEWAY_TIMEOUT
+    return HTTPStatus.INTERNAL_SERVER_ERROR
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics() -> PlainTextResponse:
+    """Returns the metrics in the Prometheus text exposition format.
+
+    Raises:
+        HTTPException: Metrics are disabled.
+    """
+    if not registry.enabled:
+        raise HTTPException(
+            status_code=HTTPStatus.NOT_FOUND, detail="Metrics are disabled"
+        )
+    return PlainTextResponse(
+        registry.render(), media_type="text/plain; version=0.0.4"
+    )
 
 
 @app.post("/insert")
-async def insert_data(request: EmbeddingRequest) -> dict[str, str]:
+async def insert_data(
+    request: EmbeddingRequest,
+    database: Database = Depends(request_database),
+) -> dict[str, str]:
     """Inserts the provided text and its embeddings into the database.
 
     Args:
         request: The insert request containing text to embed and store.
+        database: The database selected for the request.
 
     Returns:
         A dictionary with a message indicating successful insertion.
@@ -59,21 +445,14 @@ async def insert_data(request: EmbeddingRequest) -> dict[str, str]:
         "Received insert request",
         extra={"text": request.text, "test_db": request.test_db},
     )
-    global db
-    # If a test database is provided, use it instead of the default database.
-    # This is used in tests.
-    if request.test_db is not None:
-        test_db_path = Path(__file__).parent / request.test_db
-        Path.unlink(test_db_path, missing_ok=True)
-        db = SearchEmbeddingService(test_db_path)
-        await db.setup()
-        logger.info("Test database setup complete")
-
     try:
-        # Note, we don't handle FlakyNetworkException here yet
-        embedding = await get_embedding(es, request.text)
+        embedding = await get_embedding(
+            es, request.text, cache=database.embedding_cache
+        )
 
-        await db.insert(text=request.text, embeddings=embedding)
+        await database.insert(
+            text=request.text, embeddings=embedding, metadata=request.metadata
+        )
         logger.info("Data inserted successfully")
         return {"message": "Data inserted successfully"}
     except ValueError as error:
@@ -84,38 +463,185 @@ async def insert_data(request: EmbeddingRequest) -> dict[str, str]:
         raise HTTPException(
             status_code=HTTPStatus.BAD_REQUEST, detail=str(error)
         ) from error
-    except FlakyNetworkException as error:
+    except EmbeddingServiceError as error:
+        raise HTTPException(
+            status_code=embedding_error_status(error), detail=str(error)
+        ) from error
+
+
+@app.post("/upsert")
+async def upsert_data(
+    request: EmbeddingRequest,
+    database: Database = Depends(request_database),
+) -> UpsertResponse:
+    """Embeds a text afresh and stores it, replacing its stored row if any.
+
+    The embedding cache is bypassed and then updated, so re-embedding a text
+    replaces a stale vector, e.g. after the embedding model changed.
+
+    Returns:
+        A message and whether a stored row was replaced.
+
+    Raises:
+        HTTPException: The embedding has incorrect dimensions, or embedding failed.
+    """
+    try:
+        embedding = await get_embedding(es, request.text)
+        replaced = await database.upsert(
+            text=request.text, embeddings=embedding, metadata=request.metadata
+        )
+    except ValueError as error:
+        raise HTTPException(
+            status_code=HTTPStatus.BAD_REQUEST, detail=str(error)
+        ) from error
+    except EmbeddingServiceError as error:
+        raise HTTPException(
+            status_code=embedding_error_status(error), detail=str(error)
+        ) from error
+    if database.embedding_cache is not None:
+        database.embedding_cache.put(request.text, embedding)
+    logger.info("Data upserted", extra={"replaced": replaced})
+    message = "Data replaced successfully" if replaced else "Data inserted successfully"
+    return UpsertResponse(message=message, replaced=replaced)
+
+
+@app.post("/delete")
+async def delete_data(
+    request: DeleteRequest,
+    database: Database = Depends(delete_request_database),
+) -> dict[str, str]:
+    """Deletes a row by the ID returned with its similarity matches.
+
+    The row stops matching searches at once; its storage is reclaimed by
+    a background compaction.
+
+    Returns:
+        A dictionary with a message indicating successful deletion.
+
+    Raises:
+        HTTPException: No row has the ID.
+    """
+    try:
+        deleted = await database.delete(request.id)
+    except ValueError as error:
+        raise HTTPException(
+            status_code=HTTPStatus.BAD_REQUEST, detail=str(error)
+        ) from error
+    if not deleted:
+        raise HTTPException(
+            status_code=HTTPStatus.NOT_FOUND, detail=f"No entry with id={request.id}"
+        )
+    logger.info("Data deleted", extra={"id": request.id})
+    return {"message": "Data deleted successfully"}
+
+
+def ndjson(matches: list[SimilarityMatch]) -> str:
+    """Serializes matches as newline-delimited JSON, one match per line."""
+    return "".join(json.dumps(dataclasses.asdict(match)) + "\n" for match in matches)
+
+
+@app.post("/insert/batch")
+async def insert_data_batch(
+    request: BatchInsertRequest,
+    database: Database = Depends(batch_insert_database),
+) -> BatchInsertResponse:
+    """Embeds and inserts many texts with one database write.
+
+    The texts are embedded in concurrent upstream batches. Texts that are
+    already stored or repeated are skipped rather than failing the request.
+
+    Returns:
+        The number of inserted texts and the status of each one, in order.
+
+    Raises:
+        HTTPException: The metadata does not match the texts, or embedding failed.
+    """
+    logger.debug(
+        "Received bulk insert request",
+        extra={"texts": len(request.texts), "test_db": request.test_db},
+    )
+    try:
+        embeddings = await get_embeddings(
+            es, request.texts, cache=database.embedding_cache
+        )
+        statuses = await database.insert_batch(
+            texts=request.texts, embeddings=embeddings, metadata=request.metadata
+        )
+    except ValueError as error:
+        raise HTTPException(
+            status_code=HTTPStatus.BAD_REQUEST, detail=str(error)
+        ) from error
+    except EmbeddingServiceError as error:
         raise HTTPException(
-            status_code=HTTPStatus.INTERNAL_SERVER_ERROR, detail=str(error)
+            status_code=embedding_error_status(error), detail=str(error)
         ) from error
-    finally:
-        if request.test_db is not None:
-            Path.unlink(test_db_path, missing_ok=True)
+    inserted = statuses.count(InsertStatus.INSERTED)
+    logger.info("Bulk data inserted", extra={"rows": inserted})
+    return BatchInsertResponse(inserted=inserted, statuses=statuses)
 
 
-@app.post("/similarity")
-async def get_similarity_embedding(request: EmbeddingRequest) -> list[str]:
-    """Endpoint to search for similar embeddings."""
-    global db
+@app.post("/similarity", response_model=list[SimilarityMatch])
+async def get_similarity_embedding(
+    request: SimilarityRequest,
+    database: Database = Depends(similarity_request_database),
+) -> list[SimilarityMatch] | Response:
+    """Endpoint to search for similar embeddings.
 
+    Returns:
+        The matches ranked offset to offset + top_k that score at least
+        min_score and whose metadata matches the filters, with their IDs and
+        scores. With `stream` set, they are returned as NDJSON, one match per
+        line, for clients that parse results line by line. The body is only
+        sent once ranking has finished, as the best match is not known before
+        every row is scored.
+    """
     if request.test_db is not None:
-        test_db_path = Path(__file__).parent / request.test_db
-        Path.unlink(test_db_path, missing_ok=True)
-        db = SearchEmbeddingService(test_db_path)
-        await db.setup()
-        logger.info("Test database setup complete")
         embedding = await get_embedding(es, request.text)
-        await db.insert(text=request.text, embeddings=embedding)
+        await database.insert(
+            text=request.text, embeddings=embedding, metadata=request.metadata
+        )
+
+    try:
+        matches = await database.find_similar(
+            request.text,
+            top_k=request.top_k,
+            offset=request.offset,
+            min_score=request.min_score,
+            filters=request.filters,
+        )
+    except EmbeddingServiceError as error:
+        raise HTTPException(
+            status_code=embedding_error_status(error), detail=str(error)
+        ) from error
+    if request.stream:
+        return Response(ndjson(matches), media_type="application/x-ndjson")
+    return matches
+
+
+@app.post("/similarity/batch")
+async def get_similarity_embeddings_batch(
+    request: BatchSimilarityRequest,
+    database: Database = Depends(batch_request_database),
+) -> list[list[SimilarityMatch]]:
+    """Endpoint to search for similar embeddings of many queries at once.
+
+    The queries are embedded in one upstream request and ranked together.
+
+    Returns:
+        The top_k matches of every query, with their IDs and scores.
+    """
+    if request.test_db is not None:
+        embeddings = await get_embeddings(es, request.texts)
+        await database.insert_many(texts=request.texts, embeddings=embeddings)
 
     try:
-        return await db.find_similar_embeddings(request.text)
-    except FlakyNetworkException as error:
+        return await database.find_similar_batch(
+            request.texts, top_k=request.top_k, filters=request.filters
+        )
+    except EmbeddingServiceError as error:
         raise HTTPException(
-            status_code=HTTPStatus.INTERNAL_SERVER_ERROR, detail=str(error)
+            status_code=embedding_error_status(error), detail=str(error)
         ) from error
-    finally:
-        if request.test_db is not None:
-            Path.unlink(test_db_path, missing_ok=True)
 
 
 if __name__ == "__main__":
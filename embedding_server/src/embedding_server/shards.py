@@ -0,0 +1,677 @@
+"""Sharded corpus searched with parallel scatter-gather top-k.
+
+Rows are assigned to shards by their ID, the SHA-256 of their text, so a text
+always lands on the same shard and duplicates are still caught there. A query
+is embedded once, every shard ranks its own rows in parallel and the partial
+top-k lists are merged with a heap.
+
+Shards are either `SearchEmbeddingService` instances in this process or
+`RemoteShard` clients of shard servers in other local processes, reached over
+`multiprocessing.connection`. Run a shard server with:
+
+    python -m embedding_server.shards --path data/shard-0 --address /tmp/shard-0.sock
+"""
+
+import argparse
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import queue
+import threading
+from concurrent.futures import Executor
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Connection, Listener
+from pathlib import Path
+from typing import Any, Protocol
+
+import numpy as np
+import numpy.typing as npt
+
+from embedding_server.cache import EmbeddingCache
+from embedding_server.gibson.database import EMBEDDING_DIMENSIONS, InsertStatus, text_id
+from embedding_server.gibson.embedding import AsyncEmbeddingService
+from embedding_server.gibson.metadata import Filters, Metadata
+from embedding_server.gibson.storage import read_json_rows
+from embedding_server.search import (
+    INDEX_TYPES,
+    SearchEmbeddingService,
+    SimilarityMatch,
+    search_seconds,
+)
+from embedding_server.similarity import normalize
+from embedding_server.utils import get_embedding, get_embeddings
+
+logging.basicConfig(level=logging.DEBUG if "DEBUG" in os.environ else logging.INFO)
+logger = logging.getLogger(__name__)
+
+# A Unix socket path, or a (host, port) pair for TCP on the local machine.
+Address = str | tuple[str, int]
+
+
+def shard_of(id_value: str, shards: int) -> int:
+    """Returns the shard a row belongs to.
+
+    Args:
+        id_value: The hex SHA-256 ID of the row.
+        shards: The number of shards.
+
+    Returns:
+        The index of the shard.
+    """
+    return int(id_value[:16], 16) % shards
+
+
+def parse_address(value: str) -> Address:
+    """Parses `host:port` into a TCP address and anything else as a socket path."""
+    host, _, port = value.rpartition(":")
+    if host and port.isdigit():
+        return host, int(port)
+    return value
+
+
+class Shard(Protocol):
+    """The operations the sharded service needs from each shard."""
+
+    async def setup(self) -> None:
+        """Prepares the shard for use."""
+
+    async def insert(
+        self, text: str, embeddings: list[float], metadata: Metadata | None = None
+    ) -> None:
+        """Inserts one row, raising ValueError for duplicates."""
+
+    async def insert_many(
+        self,
+        texts: list[str],
+        embeddings: list[list[float]],
+        metadata: list[Metadata] | None = None,
+    ) -> int:
+        """Inserts rows that are not stored yet and returns how many."""
+
+    async def insert_batch(
+        self,
+        texts: list[str],
+        embeddings: list[list[float]],
+        metadata: list[Metadata] | None = None,
+    ) -> list[InsertStatus]:
+        """Inserts the valid new rows and returns the status of each."""
+
+    async def upsert(
+        self, text: str, embeddings: list[float], metadata: Metadata | None = None
+    ) -> bool:
+        """Inserts or replaces one row and returns whether it replaced one."""
+
+    async def delete(self, id_value: str) -> bool:
+        """Deletes one row and returns whether it was stored."""
+
+    async def search_vectors(
+        self,
+        queries: npt.NDArray[np.float32],
+        top_k: int = 5,
+        min_score: float | None = None,
+        filters: Filters | None = None,
+    ) -> list[list[SimilarityMatch]]:
+        """Ranks the rows of the shard for embedded queries."""
+
+    def save_index(self) -> None:
+        """Persists the search index of the shard."""
+
+
+class RemoteShard:
+    """A client of a shard served by `serve_shard` in another local process.
+
+    Each call sends a request over a pooled connection from the executor, so
+    calls to several remote shards proceed in parallel.
+    """
+
+    def __init__(
+        self,
+        address: Address,
+        authkey: bytes,
+        executor: Executor | None = None,
+        max_connections: int = 4,
+    ):
+        """Initializes the remote shard client.
+
+        Args:
+            address: The address the shard server listens on.
+            authkey: The shared secret that authenticates connections.
+            executor: Runs the blocking calls, the event loop's default if None.
+            max_connections: The most connections kept open to the server.
+        """
+        self.address = address
+        self.authkey = authkey
+        self.executor = executor
+        self._pool: queue.LifoQueue[Connection] = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(max_connections)
+
+    def _request(self, method: str, *args: Any) -> Any:
+        """Sends a request and waits for the reply.
+
+        Raises:
+            Exception: The exception raised by the shard server.
+        """
+        with self._slots:
+            try:
+                connection = self._pool.get_nowait()
+            except queue.Empty:
+                connection = Client(self.address, authkey=self.authkey)
+            try:
+                connection.send((method, args))
+                ok, result = connection.recv()
+            except (EOFError, OSError):
+                connection.close()
+                raise
+            self._pool.put(connection)
+        if not ok:
+            raise result
+        return result
+
+    async def _call(self, method: str, *args: Any) -> Any:
+        """Sends a request from the executor."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self._request, method, *args)
+
+    async def setup(self) -> None:
+        """Checks the shard server is reachable."""
+        rows = await self._call("size")
+        logger.info(
+            "Connected to remote shard.",
+            extra={"address": str(self.address), "rows": rows},
+        )
+
+    async def insert(
+        self, text: str, embeddings: list[float], metadata: Metadata | None = None
+    ) -> None:
+        """Inserts one row on the shard server."""
+        await self._call("insert", text, embeddings, metadata)
+
+    async def insert_many(
+        self,
+        texts: list[str],
+        embeddings: list[list[float]],
+        metadata: list[Metadata] | None = None,
+    ) -> int:
+        """Inserts rows on the shard server."""
+        inserted: int = await self._call("insert_many", texts, embeddings, metadata)
+        return inserted
+
+    async def insert_batch(
+        self,
+        texts: list[str],
+        embeddings: list[list[float]],
+        metadata: list[Metadata] | None = None,
+    ) -> list[InsertStatus]:
+        """Inserts rows on the shard server and returns the status of each."""
+        statuses: list[InsertStatus] = await self._call(
+            "insert_batch", texts, embeddings, metadata
+        )
+        return statuses
+
+    async def upsert(
+        self, text: str, embeddings: list[float], metadata: Metadata | None = None
+    ) -> bool:
+        """Inserts or replaces one row on the shard server."""
+        replaced: bool = await self._call("upsert", text, embeddings, metadata)
+        return replaced
+
+    async def delete(self, id_value: str) -> bool:
+        """Deletes one row on the shard server."""
+        deleted: bool = await self._call("delete", id_value)
+        return deleted
+
+    async def search_vectors(
+        self,
+        queries: npt.NDArray[np.float32],
+        top_k: int = 5,
+        min_score: float | None = None,
+        filters: Filters | None = None,
+    ) -> list[list[SimilarityMatch]]:
+        """Ranks the rows of the shard server."""
+        matches: list[list[SimilarityMatch]] = await self._call(
+            "search_vectors", queries, top_k, min_score, filters
+        )
+        return matches
+
+    def save_index(self) -> None:
+        """Asks the shard server to persist its search index."""
+        self._request("save_index")
+
+    def close(self) -> None:
+        """Closes the pooled connections."""
+        while not self._pool.empty():
+            self._pool.get_nowait().close()
+
+
+class ShardedSearchService:
+    """Searches a corpus split into shards by row ID.
+
+    Offers the insert and search operations of `SearchEmbeddingService`.
+    """
+
+    def __init__(
+        self,
+        shards: list[Shard],
+        embedding_service: AsyncEmbeddingService | None = None,
+        embedding_cache: EmbeddingCache | None = None,
+    ):
+        """Initializes the sharded service.
+
+        Args:
+            shards: The shards, in a fixed order that decides row placement.
+            embedding_service: The service used to embed queries.
+            embedding_cache: The cache consulted before embedding queries.
+
+        Raises:
+            ValueError: If there are no shards.
+        """
+        if not shards:
+            raise ValueError("A sharded service needs at least one shard")
+        self.shards = shards
+        self.embedding_service = embedding_service or AsyncEmbeddingService()
+        self.embedding_cache = embedding_cache
+
+    @classmethod
+    def local(
+        cls,
+        path: Path,
+        shards: int,
+        embedding_service: AsyncEmbeddingService | None = None,
+        embedding_cache: EmbeddingCache | None = None,
+        **options: Any,
+    ) -> "ShardedSearchService":
+        """Creates a service with every shard in this process.
+
+        Args:
+            path: The directory holding one binary database per shard.
+            shards: The number of shards.
+            embedding_service: The service used to embed queries.
+            embedding_cache: The cache consulted before embedding queries.
+            **options: Passed to each `SearchEmbeddingService`.
+
+        Returns:
+            The sharded service.
+
+        Raises:
+            ValueError: If the path names a `.json` file rather than a directory.
+        """
+        if path.suffix == ".json":
+            raise ValueError(
+                f"Shards are stored under a directory, not the JSON file {path}"
+            )
+        embedding_service = embedding_service or AsyncEmbeddingService()
+        return cls(
+            [
+                SearchEmbeddingService(
+                    path / f"shard-{i}", embedding_service=embedding_service, **options
+                )
+                for i in range(shards)
+            ],
+            embedding_service=embedding_service,
+            embedding_cache=embedding_cache,
+        )
+
+    async def setup(self) -> None:
+        """Sets up every shard concurrently."""
+        await asyncio.gather(*(shard.setup() for shard in self.shards))
+
+    def save_index(self) -> None:
+        """Persists the search index of every shard."""
+        for shard in self.shards:
+            shard.save_index()
+
+    def shard_for(self, text: str) -> Shard:
+        """Returns the shard that holds a text."""
+        return self.shards[shard_of(text_id(text), len(self.shards))]
+
+    async def insert(
+        self, text: str, embeddings: list[float], metadata: Metadata | None = None
+    ) -> None:
+        """Inserts a new entry into the shard that owns it.
+
+        Raises:
+            ValueError: If the entry exists or the embeddings have incorrect dimensions.
+        """
+        await self.shard_for(text).insert(
+            text=text, embeddings=embeddings, metadata=metadata
+        )
+
+    async def upsert(
+        self, text: str, embeddings: list[float], metadata: Metadata | None = None
+    ) -> bool:
+        """Inserts or replaces an entry in the shard that owns it.
+
+        Returns:
+            Whether a stored row was replaced.
+
+        Raises:
+            ValueError: If the embeddings have incorrect dimensions.
+        """
+        return await self.shard_for(text).upsert(
+            text=text, embeddings=embeddings, metadata=metadata
+        )
+
+    async def delete(self, id_value: str) -> bool:
+        """Deletes a row from the shard that owns its ID.
+
+        Returns:
+            Whether a row with that ID was stored.
+        """
+        return await self.shards[shard_of(id_value, len(self.shards))].delete(id_value)
+
+    async def insert_many(
+        self,
+        texts: list[str],
+        embeddings: list[list[float]],
+        metadata: list[Metadata] | None = None,
+    ) -> int:
+        """Inserts many entries, one bulk insert per shard, concurrently.
+
+        Returns:
+            The number of inserted entries.
+
+        Raises:
+            ValueError: If the number of embeddings or metadata does not match
+                the texts or any embedding has incorrect dimensions.
+        """
+        if len(texts) != len(embeddings):
+            raise ValueError("Expected one embedding per text")
+        if metadata is None:
+            metadata = [{} for _ in texts]
+        elif len(metadata) != len(texts):
+            raise ValueError("Expected one metadata mapping per text")
+        groups: list[tuple[list[str], list[list[float]], list[Metadata]]] = [
+            ([], [], []) for _ in self.shards
+        ]
+        for text, embedding, fields in zip(texts, embeddings, metadata, strict=True):
+            group = groups[shard_of(text_id(text), len(self.shards))]
+            group[0].append(text)
+            group[1].append(embedding)
+            group[2].append(fields)
+        counts = await asyncio.gather(
+            *(
+                shard.insert_many(texts=group[0], embeddings=group[1], metadata=group[2])
+                for shard, group in zip(self.shards, groups, strict=True)
+                if group[0]
+            )
+        )
+        return sum(counts)
+
+    async def insert_batch(
+        self,
+        texts: list[str],
+        embeddings: list[list[float]],
+        metadata: list[Metadata] | None = None,
+    ) -> list[InsertStatus]:
+        """Inserts the valid new entries, one batch per shard, concurrently.
+
+        Returns:
+            The status of every entry, in order.
+
+        Raises:
+            ValueError: If the number of embeddings or metadata does not match
+                the texts.
+        """
+        if len(texts) != len(embeddings):
+            raise ValueError("Expected one embedding per text")
+        if metadata is None:
+            metadata = [{} for _ in texts]
+        elif len(metadata) != len(texts):
+            raise ValueError("Expected one metadata mapping per text")
+        positions: list[list[int]] = [[] for _ in self.shards]
+        for position, text in enumerate(texts):
+            positions[shard_of(text_id(text), len(self.shards))].append(position)
+        shard_statuses = await asyncio.gather(
+            *(
+                shard.insert_batch(
+                    texts=[texts[position] for position in group],
+                    embeddings=[embeddings[position] for position in group],
+                    metadata=[metadata[position] for position in group],
+                )
+                for shard, group in zip(self.shards, positions, strict=True)
+                if group
+            )
+        )
+        statuses = [InsertStatus.INVALID] * len(texts)
+        groups = [group for group in positions if group]
+        for group, group_statuses in zip(groups, shard_statuses, strict=True):
+            for position, status in zip(group, group_statuses, strict=True):
+                statuses[position] = status
+        return statuses
+
+    async def import_json(self, path: Path) -> int:
+        """Distributes the rows of a JSON export over the shards.
+
+        Returns:
+            The number of imported rows.
+        """
+        records, vectors = read_json_rows(path, EMBEDDING_DIMENSIONS)
+        return await self.insert_many(
+            [str(text) for text in records["Text"]],
+            vectors.tolist(),
+            list(records["Metadata"]),
+        )
+
+    async def search_vectors(
+        self,
+        queries: npt.NDArray[np.float32],
+        top_k: int = 5,
+        min_score: float | None = None,
+        filters: Filters | None = None,
+    ) -> list[list[SimilarityMatch]]:
+        """Ranks every shard in parallel and merges the partial top-k lists.
+
+        Args:
+            queries: The normalized query embeddings, one per row.
+            top_k: The number of matches to return per query.
+            min_score: The lowest similarity returned, unbounded if None.
+            filters: The metadata values the returned rows must have.
+
+        Returns:
+            The matches of every query in descending order of similarity.
+        """
+        partials = await asyncio.gather(
+            *(
+                shard.search_vectors(queries, top_k, min_score, filters)
+                for shard in self.shards
+            )
+        )
+        return [
+            list(
+                itertools.islice(
+                    heapq.merge(*per_shard, key=lambda match: -match.score), top_k
+                )
+            )
+            for per_shard in zip(*partials, strict=True)
+        ]
+
+    async def find_similar_embeddings(
+        self, query_text: str, top_k: int = 5, filters: Filters | None = None
+    ) -> list[str]:
+        """Finds the texts most similar to a query across all shards.
+
+        Raises:
+            EmbeddingServiceError once the retry policy gives up.
+        """
+        matches = await self.find_similar(query_text, top_k, filters=filters)
+        return [match.text for match in matches]
+
+    async def find_similar(
+        self,
+        query_text: str,
+        top_k: int = 5,
+        offset: int = 0,
+        min_score: float | None = None,
+        filters: Filters | None = None,
+    ) -> list[SimilarityMatch]:
+        """Finds a page of the rows most similar to a query across all shards.
+
+        Every shard returns its best offset + top_k rows, as any of them may
+        hold the whole page.
+
+        Raises:
+            EmbeddingServiceError once the retry policy gives up.
+        """
+        with search_seconds.time():
+            query_embedding = await get_embedding(
+                self.embedding_service, query_text, cache=self.embedding_cache
+            )
+            [matches] = await self.search_vectors(
+                normalize([query_embedding]), offset + top_k, min_score, filters
+            )
+            return matches[offset:]
+
+    async def find_similar_batch(
+        self,
+        query_texts: list[str],
+        top_k: int = 5,
+        filters: Filters | None = None,
+    ) -> list[list[SimilarityMatch]]:
+        """Finds the most similar rows for many queries across all shards.
+
+        Raises:
+            EmbeddingServiceError once the retry policy gives up.
+        """
+        if not query_texts:
+            return []
+        query_embeddings = await get_embeddings(
+            self.embedding_service, query_texts, cache=self.embedding_cache
+        )
+        return await self.search_vectors(
+            normalize(query_embeddings), top_k, filters=filters
+        )
+
+
+# The methods of a shard that clients may call over RPC.
+SHARD_METHODS = frozenset(
+    {
+        "insert",
+        "insert_many",
+        "insert_batch",
+        "upsert",
+        "delete",
+        "search_vectors",
+        "save_index",
+    }
+)
+
+
+async def _dispatch(
+    shard: SearchEmbeddingService, method: str, args: tuple[Any, ...]
+) -> Any:
+    """Runs one RPC request against the local shard.
+
+    Raises:
+        ValueError: If the method may not be called over RPC.
+    """
+    if method == "size":
+        await shard.refresh()
+        return len(shard)
+    if method not in SHARD_METHODS:
+        raise ValueError(f"Unknown shard method {method!r}")
+    result = getattr(shard, method)(*args)
+    return await result if asyncio.iscoroutine(result) else result
+
+
+async def serve_shard(
+    address: Address, path: Path, authkey: bytes, **options: Any
+) -> None:
+    """Serves one shard to `RemoteShard` clients until cancelled.
+
+    Each connection is handled on its own thread and requests run on this
+    process's event loop.
+
+    Args:
+        address: The Unix socket path or local TCP address to listen on.
+        path: The database of the shard.
+        authkey: The shared secret that authenticates connections.
+        **options: Passed to the `SearchEmbeddingService` of the shard.
+    """
+    shard = SearchEmbeddingService(path, **options)
+    await shard.setup()
+    loop = asyncio.get_running_loop()
+    listener = Listener(address, authkey=authkey)
+    logger.info(
+        "Shard server listening.",
+        extra={"address": str(address), "rows": len(shard)},
+    )
+
+    def handle(connection: Connection) -> None:
+        """Answers the requests of one client connection."""
+        with connection:
+            while True:
+                try:
+                    method, args = connection.recv()
+                except (EOFError, OSError):
+                    return
+                future = asyncio.run_coroutine_threadsafe(
+                    _dispatch(shard, method, args), loop
+                )
+                try:
+                    connection.send((True, future.result()))
+                except Exception as error:
+                    if not reply_error(connection, error):
+                        return
+
+    def reply_error(connection: Connection, error: Exception) -> bool:
+        """Sends error to the client, returning whether the connection is usable."""
+        try:
+            connection.send((False, error))
+        except OSError:
+            return False
+        except Exception:
+            # The error itself could not be pickled, so send its description.
+            try:
+                connection.send((False, RuntimeError(repr(error))))
+            except Exception:
+                logger.exception("Could not reply to a shard client.")
+                return False
+        return True
+
+    def accept() -> None:
+        """Accepts connections until the listener is closed."""
+        while True:
+            try:
+                connection = listener.accept()
+            except (AuthenticationError, EOFError, ConnectionError) as error:
+                logger.warning(
+                    "Rejected a shard connection.", extra={"error": repr(error)}
+                )
+                continue
+            except OSError:
+                if closed.is_set():
+                    return
+                logger.exception("Could not accept a shard connection.")
+                continue
+            threading.Thread(target=handle, args=(connection,), daemon=True).start()
+
+    closed = threading.Event()
+    threading.Thread(target=accept, daemon=True).start()
+    try:
+        await asyncio.Event().wait()
+    finally:
+        closed.set()
+        listener.close()
+        shard.save_index()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve one shard of the corpus.")
+    parser.add_argument("--path", type=Path, required=True)
+    parser.add_argument("--address", type=parse_address, required=True)
+    parser.add_argument("--mmap", action="store_true")
+    parser.add_argument("--wal", action="store_true")
+    parser.add_argument("--index", default="exact", choices=INDEX_TYPES)
+    args = parser.parse_args()
+    asyncio.run(
+        serve_shard(
+            args.address,
+            args.path,
+            os.environ["EMBEDDING_SHARD_AUTHKEY"].encode(),
+            mmap=args.mmap,
+            wal=args.wal,
+            index=args.index,
+        )
+    )
@@ -0,0 +1,52 @@
+"""Vector math shared by the similarity search structures."""
+
+from typing import Any
+
+import numpy as np
+import numpy.typing as npt
+
+
+def normalize(vectors: npt.ArrayLike) -> npt.NDArray[np.float32]:
+    """Scales vectors to unit length along their last axis.
+
+    Zero vectors are left as zeros rather than producing NaNs.
+
+    Args:
+        vectors: A single vector or a matrix with one vector per row.
+
+    Returns:
+        A float32 array of the same shape with unit-length rows.
+    """
+    array = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(array, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    normalized: npt.NDArray[np.float32] = array / norms
+    return normalized
+
+
+def top_k_indices(scores: npt.NDArray[Any], k: int) -> npt.NDArray[np.intp]:
+    """Returns the indices of the k highest scores in descending order.
+
+    Uses a partial selection so only the k winners are fully sorted. A matrix
+    of scores is ranked row by row.
+
+    Args:
+        scores: A vector of scores, or a matrix with one row of scores per query.
+        k: The number of indices to return.
+
+    Returns:
+        At most k indices into the last axis of scores, best first.
+    """
+    count = scores.shape[-1]
+    k = min(k, count)
+    if k <= 0:
+        return np.empty((*scores.shape[:-1], 0), dtype=np.intp)
+    if k < count:
+        candidates = np.argpartition(-scores, k - 1, axis=-1)[..., :k]
+    else:
+        candidates = np.broadcast_to(np.arange(count), scores.shape)
+    order = np.argsort(
+        -np.take_along_axis(scores, candidates, axis=-1), axis=-1, kind="stable"
+    )
+    best: npt.NDArray[np.intp] = np.take_along_axis(candidates, order, axis=-1)
+    return best
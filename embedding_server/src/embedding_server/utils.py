@@ -4,25 +4,78 @@ import asyncio
 import logging
 import os
 
+from embedding_server.cache import EmbeddingCache
 from embedding_server.gibson.embedding import AsyncEmbeddingService
-from embedding_server.gibson.exceptions import FlakyNetworkException
+from embedding_server.retry import call_with_retries
 
 logging.basicConfig(level=logging.DEBUG if "DEBUG" in os.environ else logging.INFO)
 logger = logging.getLogger(__name__)
 
-RETRIES = 5
-DELAY = 0.5
-
-
-async def get_embedding(es: AsyncEmbeddingService, text: str) -> list[float]:
-    """Used to call embed and retry a defined number of times if FlakyNetworkExceptiomn occurs."""
-    for attempt in range(RETRIES):
-        try:
-            return await es.embed(text)
-        except FlakyNetworkException:
-            logger.info("Caught FlakyNetworkException")
-            if attempt < RETRIES - 1:
-                await asyncio.sleep(DELAY)
-            else:
-                raise
-    return []
+
+async def get_embedding(
+    es: AsyncEmbeddingService, text: str, cache: EmbeddingCache | None = None
+) -> list[float]:
+    """Used to call embed, retrying transient errors under the service's retry policy.
+
+    When a cache is given it is consulted first, and fresh embeddings are added to it.
+    """
+    if cache is not None:
+        cached = cache.get(text)
+        if cached is not None:
+            return cached
+
+    embedding = await call_with_retries(
+        lambda: es.embed(text), es.retry_policy, es.circuit_breaker, es.latencies
+    )
+    if cache is not None:
+        cache.put(text, embedding)
+    return embedding
+
+
+async def get_embeddings(
+    es: AsyncEmbeddingService, texts: list[str], cache: EmbeddingCache | None = None
+) -> list[list[float]]:
+    """Used to call embed_batch, retrying transient errors under the service's retry policy.
+
+    Texts are sent upstream in concurrent batches of at most the service's
+    `max_batch_size`, each retried on its own. When a cache is given only the
+    distinct texts it misses are embedded, and fresh embeddings are added to it.
+    """
+    if cache is None:
+        return await _embed_in_batches(es, texts)
+
+    found = {text: cache.get(text) for text in dict.fromkeys(texts)}
+    missing = [text for text, embedding in found.items() if embedding is None]
+    if missing:
+        for text, embedding in zip(
+            missing, await _embed_in_batches(es, missing), strict=True
+        ):
+            cache.put(text, embedding)
+            found[text] = embedding
+    return [found[text] or [] for text in texts]
+
+
+async def _embed_in_batches(
+    es: AsyncEmbeddingService, texts: list[str]
+) -> list[list[float]]:
+    """Embeds texts in concurrent upstream batches, keeping their order."""
+    size = max(es.max_batch_size, 1)
+    batches = await asyncio.gather(
+        *(
+            _embed_batch_with_retries(es, texts[start : start + size])
+            for start in range(0, len(texts), size)
+        )
+    )
+    return [embedding for batch in batches for embedding in batch]
+
+
+async def _embed_batch_with_retries(
+    es: AsyncEmbeddingService, texts: list[str]
+) -> list[list[float]]:
+    """Calls embed_batch, retrying transient errors under the service's retry policy.
+
+    Batches are not hedged, as their latency depends on their size.
+    """
+    return await call_with_retries(
+        lambda: es.embed_batch(texts), es.retry_policy, es.circuit_breaker
+    )
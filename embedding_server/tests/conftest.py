@@ -5,7 +5,11 @@ import logging
 import os
 from collections.abc import Iterator
 
+import numpy as np
+import numpy.typing as npt
 import pytest
+from embedding_server.gibson.database import EMBEDDING_DIMENSIONS
+from embedding_server.similarity import normalize
 
 logging.basicConfig(level=logging.DEBUG if "DEBUG" in os.environ else logging.INFO)
 logger = logging.getLogger(__name__)
@@ -21,3 +25,19 @@ def event_loop() -> Iterator[asyncio.AbstractEventLoop]:
     with asyncio.Runner(debug=True) as runner:
         loop = runner.get_loop()
         yield loop
+
+
+def random_embeddings(count: int, seed: int = 0) -> list[list[float]]:
+    """Generates reproducible random embeddings."""
+    rng = np.random.default_rng(seed)
+    return rng.standard_normal((count, EMBEDDING_DIMENSIONS)).tolist()  # type: ignore
+
+
+def clustered_vectors(
+    count: int, clusters: int, seed: int = 0
+) -> npt.NDArray[np.float32]:
+    """Generates unit vectors scattered around random cluster centres."""
+    rng = np.random.default_rng(seed)
+    centres = rng.standard_normal((clusters, EMBEDDING_DIMENSIONS))
+    noise = rng.standard_normal((count, EMBEDDING_DIMENSIONS))
+    return normalize(centres[rng.integers(clusters, size=count)] + 0.8 * noise)
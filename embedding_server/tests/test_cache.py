@@ -0,0 +1,84 @@
+"""Tests the content-addressed embedding cache."""
+
+import logging
+import os
+import time
+from pathlib import Path
+from unittest.mock import AsyncMock
+
+import numpy as np
+import pytest
+from embedding_server.cache import EmbeddingCache
+from embedding_server.gibson.database import (
+    EMBEDDING_DIMENSIONS,
+    AsyncEmbeddingDatabase,
+)
+from embedding_server.gibson.embedding import AsyncEmbeddingService
+from embedding_server.utils import get_embedding
+from pytest_mock import MockerFixture
+
+logging.basicConfig(level=logging.DEBUG if "DEBUG" in os.environ else logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def _embedding(value: float) -> list[float]:
+    """Builds an embedding that float32 can represent exactly."""
+    return [value] * EMBEDDING_DIMENSIONS
+
+
+def test_cache_evicts_least_recently_used() -> None:
+    """Tests the in-memory tier keeps the most recently used entries."""
+    cache = EmbeddingCache(max_entries=2)
+    cache.put("a", _embedding(1.0))
+    cache.put("b", _embedding(2.0))
+    assert cache.get("a") == _embedding(1.0)
+    cache.put("c", _embedding(3.0))
+
+    assert cache.get("b") is None
+    assert cache.get("a") == _embedding(1.0)
+    assert cache.get("c") == _embedding(3.0)
+    assert (cache.hits, cache.misses) == (3, 1)
+
+
+def test_cache_expires_entries(tmp_path: Path) -> None:
+    """Tests entries older than the TTL are dropped from memory and disk."""
+    cache = EmbeddingCache(ttl=0.05, directory=tmp_path)
+    cache.put("a", _embedding(1.0))
+    assert cache.get("a") == _embedding(1.0)
+    time.sleep(0.1)
+
+    assert cache.get("a") is None
+    assert not list(tmp_path.rglob("*.f32"))
+
+
+@pytest.mark.asyncio
+async def test_cache_lower_tiers(tmp_path: Path) -> None:
+    """Tests misses fall back to the disk tier and then to database rows."""
+    EmbeddingCache(directory=tmp_path / "cache").put("on disk", _embedding(1.0))
+    database = AsyncEmbeddingDatabase(tmp_path / "db")
+    await database.setup()
+    await database.insert(text="in database", embeddings=_embedding(2.0))
+
+    cache = EmbeddingCache(directory=tmp_path / "cache", database=database)
+    assert cache.get("on disk") == _embedding(1.0)
+    assert cache.get("in database") == _embedding(2.0)
+    assert cache.get("nowhere") is None
+    assert len(cache) == 2
+
+
+@pytest.mark.asyncio
+async def test_get_embedding_uses_cache(mocker: MockerFixture) -> None:
+    """Tests repeated texts are embedded remotely only once."""
+    embed_mock = mocker.patch(
+        "embedding_server.gibson.embedding.AsyncEmbeddingService.embed",
+        new_callable=AsyncMock,
+        return_value=np.full(EMBEDDING_DIMENSIONS, 0.5).tolist(),
+    )
+    cache = EmbeddingCache()
+    embedding_service = AsyncEmbeddingService()
+
+    for _ in range(3):
+        embedding = await get_embedding(embedding_service, "query", cache=cache)
+        assert embedding == _embedding(0.5)
+
+    assert embed_mock.await_count == 1
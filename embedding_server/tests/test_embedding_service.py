@@ -4,13 +4,27 @@ import asyncio
 import json
 import logging
 import os
+from http import HTTPStatus
 from pathlib import Path
 
 import aiofiles
+import httpx
 import pytest
-
-from embedding_server.gibson.database import AsyncEmbeddingDatabase
+from embedding_server.gibson.database import (
+    AsyncEmbeddingDatabase,
+    InsertStatus,
+    text_id,
+)
 from embedding_server.gibson.embedding import AsyncEmbeddingService
+from embedding_server.gibson.exceptions import (
+    CircuitOpenError,
+    FlakyNetworkException,
+    UpstreamError,
+)
+from embedding_server.gibson.fake import FakeEmbeddingTransport
+from embedding_server.retry import CircuitBreaker, RetryPolicy
+from embedding_server.utils import get_embedding, get_embeddings
+from pytest_mock import MockerFixture
 
 logging.basicConfig(level=logging.DEBUG if "DEBUG" in os.environ else logging.INFO)
 logger = logging.getLogger(__name__)
@@ -46,7 +60,7 @@ async def test_async_insert(tmp_path: Path) -> None:
 
     logger.debug("Reading sentences from file.")
     async with aiofiles.open(
-        Path(__file__).parent.parent / "data" / "sentences.txt", "r", encoding="utf-8"
+        Path(__file__).parent.parent / "data" / "sentences.txt", encoding="utf-8"
     ) as file:
         data_content = await file.read()
         data = data_content.splitlines()[0:10]
@@ -66,14 +80,338 @@ async def test_async_insert(tmp_path: Path) -> None:
     counter += len(tasks)
 
     logger.debug("Verifying the insertion into the database by counting entries.")
-    async with aiofiles.open(tmp_path / "testdb.json", "r", encoding="utf-8") as file:
+    async with aiofiles.open(tmp_path / "testdb.json", encoding="utf-8") as file:
         json_content = json.loads(await file.read())
-        assert (
-            len(json_content["ID"]) == counter
-        ), "Mismatch in the number of inserted IDs."
-        assert (
-            len(json_content["Text"]) == counter
-        ), "Mismatch in the number of inserted Texts."
-        assert (
-            len(json_content["Embeddings"]) == counter
-        ), "Mismatch in the number of inserted Embeddings."
+        assert len(json_content["ID"]) == counter, (
+            "Mismatch in the number of inserted IDs."
+        )
+        assert len(json_content["Text"]) == counter, (
+            "Mismatch in the number of inserted Texts."
+        )
+        assert len(json_content["Embeddings"]) == counter, (
+            "Mismatch in the number of inserted Embeddings."
+        )
+
+
+@pytest.mark.asyncio
+async def test_embed_coalesces_concurrent_calls(mocker: MockerFixture) -> None:
+    """Tests concurrent embed calls are sent upstream as shared batches."""
+
+    async def fake_batch(texts: list[str]) -> list[list[float]]:
+        return [[float(len(text))] * 768 for text in texts]
+
+    batch_mock = mocker.patch.object(
+        AsyncEmbeddingService, "embed_batch", side_effect=fake_batch
+    )
+    embedding_service = AsyncEmbeddingService(batch_window=0.01, max_batch_size=4)
+    texts = ["a", "bb", "ccc", "a", "dddd", "eeeee"]
+
+    embeddings = await asyncio.gather(*(embedding_service.embed(t) for t in texts))
+
+    assert [embedding[0] for embedding in embeddings] == [1, 2, 3, 1, 4, 5]
+    assert [call.args[0] for call in batch_mock.call_args_list] == [
+        ["a", "bb", "ccc"],
+        ["dddd", "eeeee"],
+    ]
+
+
+@pytest.mark.asyncio
+async def test_embed_batch_failure_reaches_every_caller(mocker: MockerFixture) -> None:
+    """Tests a failed upstream batch raises in every coalesced caller."""
+    mocker.patch.object(
+        AsyncEmbeddingService, "embed_batch", side_effect=FlakyNetworkException()
+    )
+    embedding_service = AsyncEmbeddingService(batch_window=0.01)
+
+    results = await asyncio.gather(
+        *(embedding_service.embed(text) for text in ["a", "b", "c"]),
+        return_exceptions=True,
+    )
+
+    assert all(isinstance(result, FlakyNetworkException) for result in results)
+
+
+@pytest.mark.asyncio
+async def test_embed_batch_reuses_pooled_client() -> None:
+    """Tests requests share one pooled client, including the warm-up retry."""
+    responses = [
+        httpx.Response(HTTPStatus.SERVICE_UNAVAILABLE, json={"estimated_time": 0}),
+        httpx.Response(HTTPStatus.OK, json=[[0.5] * 768, [0.25] * 768]),
+        httpx.Response(HTTPStatus.OK, json=[[0.75] * 768]),
+    ]
+    requests: list[httpx.Request] = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        return responses[len(requests) - 1]
+
+    async with AsyncEmbeddingService(
+        flaky_network_rate=0.0, transport=httpx.MockTransport(handler)
+    ) as embedding_service:
+        client = embedding_service.client
+        embeddings = await embedding_service.embed_batch(["first", "second"])
+        assert [embedding[0] for embedding in embeddings] == [0.5, 0.25]
+        assert (await embedding_service.embed("third"))[0] == 0.75
+        assert embedding_service.client is client
+
+    assert client.is_closed
+    assert [json.loads(request.content)["inputs"] for request in requests] == [
+        ["first", "second"],
+        ["first", "second"],
+        ["third"],
+    ]
+
+
+@pytest.mark.asyncio
+async def test_fake_embeddings_are_deterministic() -> None:
+    """Tests the fake API embeds each text the same way for the same seed."""
+    transport = FakeEmbeddingTransport(seed=1)
+    async with AsyncEmbeddingService(
+        flaky_network_rate=0.0, transport=transport
+    ) as embedding_service:
+        first, second, again = await embedding_service.embed_batch(["a", "b", "a"])
+    async with AsyncEmbeddingService(
+        flaky_network_rate=0.0, transport=FakeEmbeddingTransport(seed=2)
+    ) as embedding_service:
+        reseeded = await embedding_service.embed("a")
+
+    assert len(first) == 768
+    assert first == again
+    assert first != second
+    assert first != reseeded
+    assert transport.requests == 1
+
+
+@pytest.mark.asyncio
+async def test_retry_policy_retries_transient_errors() -> None:
+    """Tests error statuses are retried only when they are transient."""
+    statuses = [HTTPStatus.INTERNAL_SERVER_ERROR, HTTPStatus.TOO_MANY_REQUESTS]
+    requests: list[httpx.Request] = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        if statuses:
+            return httpx.Response(statuses.pop(0))
+        if json.loads(request.content)["inputs"] == ["bad"]:
+            return httpx.Response(HTTPStatus.BAD_REQUEST)
+        return httpx.Response(HTTPStatus.OK, json=[[0.5] * 768])
+
+    async with AsyncEmbeddingService(
+        flaky_network_rate=0.0,
+        transport=httpx.MockTransport(handler),
+        retry_policy=RetryPolicy(base_delay=0.001),
+    ) as embedding_service:
+        assert await get_embeddings(embedding_service, ["text"]) == [[0.5] * 768]
+        assert len(requests) == 3
+        with pytest.raises(UpstreamError, match="400"):
+            await get_embedding(embedding_service, "bad")
+        assert len(requests) == 4
+
+
+@pytest.mark.asyncio
+async def test_circuit_breaker_fails_fast() -> None:
+    """Tests an open breaker rejects calls until a trial call succeeds."""
+    now = [0.0]
+    healthy = [False]
+    requests: list[httpx.Request] = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        if not healthy[0]:
+            return httpx.Response(HTTPStatus.BAD_GATEWAY)
+        return httpx.Response(HTTPStatus.OK, json=[[0.5] * 768])
+
+    breaker = CircuitBreaker(
+        failure_threshold=2, reset_timeout=30, clock=lambda: now[0]
+    )
+    async with AsyncEmbeddingService(
+        flaky_network_rate=0.0,
+        transport=httpx.MockTransport(handler),
+        retry_policy=RetryPolicy(attempts=3, base_delay=0.001),
+        circuit_breaker=breaker,
+    ) as embedding_service:
+        with pytest.raises(CircuitOpenError):
+            await get_embedding(embedding_service, "text")
+        assert len(requests) == 2
+        assert breaker.state == "open"
+        with pytest.raises(CircuitOpenError):
+            await get_embedding(embedding_service, "text")
+        assert len(requests) == 2
+
+        now[0] = 30.0
+        healthy[0] = True
+        assert breaker.state == "half_open"
+        assert await get_embedding(embedding_service, "text") == [0.5] * 768
+        assert breaker.state == "closed"
+
+
+@pytest.mark.asyncio
+async def test_coalesced_failure_counts_once() -> None:
+    """Tests a failed batch shared by many callers is one breaker failure."""
+    requests: list[httpx.Request] = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        if len(requests) == 1:
+            return httpx.Response(HTTPStatus.BAD_GATEWAY)
+        texts = json.loads(request.content)["inputs"]
+        return httpx.Response(HTTPStatus.OK, json=[[0.5] * 768 for _ in texts])
+
+    breaker = CircuitBreaker(failure_threshold=20)
+    async with AsyncEmbeddingService(
+        flaky_network_rate=0.0,
+        batch_window=0.01,
+        max_batch_size=64,
+        transport=httpx.MockTransport(handler),
+        retry_policy=RetryPolicy(base_delay=0.001),
+        circuit_breaker=breaker,
+    ) as embedding_service:
+        embeddings = await asyncio.gather(
+            *(get_embedding(embedding_service, f"text {i}") for i in range(24))
+        )
+
+    assert embeddings == [[0.5] * 768] * 24
+    assert breaker.state == "closed"
+    assert breaker.failures == 0
+
+
+@pytest.mark.asyncio
+async def test_slow_call_is_hedged() -> None:
+    """Tests a call slower than the hedging quantile is raced by a second one."""
+    requests: list[httpx.Request] = []
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        if len(requests) == 1:
+            await asyncio.sleep(10)
+        return httpx.Response(HTTPStatus.OK, json=[[float(len(requests))] * 768])
+
+    async with AsyncEmbeddingService(
+        flaky_network_rate=0.0,
+        transport=httpx.MockTransport(handler),
+        retry_policy=RetryPolicy(hedge_quantile=0.9, hedge_min_samples=1),
+    ) as embedding_service:
+        embedding_service.latencies.record(0.01)
+        embedding = await asyncio.wait_for(get_embedding(embedding_service, "a"), 1)
+
+    assert embedding == [2.0] * 768
+    assert len(requests) == 2
+
+
+@pytest.mark.asyncio
+async def test_insert_many_single_write(mocker: MockerFixture, tmp_path: Path) -> None:
+    """Tests bulk inserts skip known texts and persist each call with one write."""
+    embedding_database = AsyncEmbeddingDatabase(cache_path=tmp_path / "testdb")
+    await embedding_database.setup()
+    append_spy = mocker.spy(embedding_database.storage, "append")
+    await embedding_database.insert(text="a", embeddings=[0.0] * 768)
+
+    inserted = await embedding_database.insert_many(
+        texts=["a", "b", "c", "b"],
+        embeddings=[[float(i)] * 768 for i in range(4)],
+    )
+
+    assert inserted == 2
+    assert append_spy.call_count == 2
+    assert embedding_database.data["Text"].tolist() == ["a", "b", "c"]
+    with pytest.raises(ValueError, match="768 dimensions"):
+        await embedding_database.insert_many(texts=["d"], embeddings=[[0.0] * 767])
+
+
+@pytest.mark.asyncio
+async def test_insert_batch_statuses(mocker: MockerFixture, tmp_path: Path) -> None:
+    """Tests a bulk insert reports every entry and persists with one write."""
+    embedding_database = AsyncEmbeddingDatabase(cache_path=tmp_path / "testdb")
+    await embedding_database.setup()
+    await embedding_database.insert(text="a", embeddings=[0.0] * 768)
+    append_spy = mocker.spy(embedding_database.storage, "append")
+
+    statuses = await embedding_database.insert_batch(
+        texts=["a", "b", "c", "b", "d", "e"],
+        embeddings=[[float(i)] * 768 for i in range(4)] + [[0.0] * 767, [5.0] * 768],
+        metadata=[{}, {"tenant": "x"}, {}, {}, {}, {"tags": ["y"]}],  # type: ignore
+    )
+
+    assert statuses == [
+        InsertStatus.EXISTS,
+        InsertStatus.INSERTED,
+        InsertStatus.INSERTED,
+        InsertStatus.DUPLICATE,
+        InsertStatus.INVALID,
+        InsertStatus.INVALID,
+    ]
+    assert append_spy.call_count == 1
+    assert embedding_database.data["Text"].tolist() == ["a", "b", "c"]
+    assert embedding_database.get(text_id("b")).metadata == {"tenant": "x"}  # type: ignore
+
+
+@pytest.mark.asyncio
+async def test_lookup_by_id(tmp_path: Path) -> None:
+    """Tests rows are found by ID, also after reloading, and duplicates rejected."""
+    embedding_database = AsyncEmbeddingDatabase(cache_path=tmp_path / "testdb")
+    await embedding_database.setup()
+    for i in range(20):
+        await embedding_database.insert(text=f"text {i}", embeddings=[float(i)] * 768)
+
+    reloaded = AsyncEmbeddingDatabase(cache_path=tmp_path / "testdb")
+    await reloaded.setup()
+    await reloaded.insert(text="text 20", embeddings=[20.0] * 768)
+
+    for i in (0, 19, 20):
+        record = reloaded.get(text_id(f"text {i}"))
+        assert record is not None
+        assert record.text == f"text {i}"
+        assert record.embedding == [float(i)] * 768
+    assert reloaded.contains(text_id("text 5"))
+    assert not reloaded.contains(text_id("missing"))
+    assert reloaded.get(text_id("missing")) is None
+    with pytest.raises(ValueError, match="already exists"):
+        await reloaded.insert(text="text 3", embeddings=[0.0] * 768)
+    assert len(reloaded) == 21
+
+
+@pytest.mark.asyncio
+async def test_concurrent_inserts_share_flush(
+    mocker: MockerFixture, tmp_path: Path
+) -> None:
+    """Tests concurrent inserts are persisted together by one background write."""
+    embedding_database = AsyncEmbeddingDatabase(
+        cache_path=tmp_path / "testdb", flush_delay=0.01
+    )
+    await embedding_database.setup()
+    append_spy = mocker.spy(embedding_database.storage, "append")
+
+    await asyncio.gather(
+        *(
+            embedding_database.insert(text=f"text {i}", embeddings=[float(i)] * 768)
+            for i in range(10)
+        )
+    )
+
+    assert append_spy.call_count == 1
+    reloaded = AsyncEmbeddingDatabase(cache_path=tmp_path / "testdb")
+    await reloaded.setup()
+    assert reloaded.records.texts == [f"text {i}" for i in range(10)]
+
+
+@pytest.mark.asyncio
+async def test_concurrent_duplicate_inserts(tmp_path: Path) -> None:
+    """Tests only one of several concurrent inserts of the same text succeeds."""
+    embedding_database = AsyncEmbeddingDatabase(cache_path=tmp_path / "testdb")
+    await embedding_database.setup()
+    snapshot = embedding_database.snapshot()
+
+    results = await asyncio.gather(
+        *(
+            embedding_database.insert(text="same", embeddings=[0.0] * 768)
+            for _ in range(5)
+        ),
+        return_exceptions=True,
+    )
+
+    assert sum(result is None for result in results) == 1
+    assert all(
+        isinstance(result, ValueError) for result in results if result is not None
+    )
+    assert len(embedding_database) == 1
+    assert len(snapshot) == 0
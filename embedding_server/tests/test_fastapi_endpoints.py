@@ -2,22 +2,27 @@
 
 import json
 from http import HTTPStatus
+from pathlib import Path
 from unittest.mock import AsyncMock
 
 import pytest
-from fastapi.testclient import TestClient
-from pytest_mock import MockerFixture
-
+from embedding_server.gibson.database import EMBEDDING_DIMENSIONS, text_id
 from embedding_server.gibson.embedding import AsyncEmbeddingService
 from embedding_server.gibson.exceptions import FlakyNetworkException
-from embedding_server.server import app
+from embedding_server.gibson.storage import BinaryStorage
+from embedding_server.metrics import registry
+from embedding_server.retry import CircuitBreaker
+from embedding_server.server import app, es
 from embedding_server.utils import get_embedding
+from fastapi.testclient import TestClient
+from pytest_mock import MockerFixture
 
 
 @pytest.fixture
-def client() -> TestClient: # type: ignore
+def client() -> TestClient:  # type: ignore
     """Creates TestClient."""
     with TestClient(app) as client:
+        es.circuit_breaker.reset()
         yield client
 
 
@@ -27,6 +32,17 @@ def test_ready(client: TestClient) -> None:
     assert response.status_code == HTTPStatus.OK
 
 
+def test_ready_reports_open_circuit(mocker: MockerFixture, client: TestClient) -> None:
+    """Tests /ready fails while the breaker of the embedding API is open."""
+    breaker = CircuitBreaker(failure_threshold=1)
+    mocker.patch.object(es, "circuit_breaker", breaker)
+    assert client.get("/ready").json()["embedding_circuit"] == "closed"
+
+    breaker.record_failure()
+    response = client.get("/ready")
+    assert response.status_code == HTTPStatus.SERVICE_UNAVAILABLE
+
+
 def test_insert(client: TestClient) -> None:
     """Tests /insert endpoint."""
     response = client.post(
@@ -39,6 +55,17 @@ def test_insert(client: TestClient) -> None:
     assert response.status_code == HTTPStatus.OK
 
 
+def test_invalid_test_db(client: TestClient, tmp_path: Path) -> None:
+    """Tests test databases must be bare names, so no other path is removed."""
+    victim = tmp_path / "victim"
+    victim.mkdir()
+    (victim / "keep.txt").write_text("keep")
+    for name in (str(victim), "../victim", "a/b", "..", ""):
+        response = client.post("/insert", json={"text": "Spam", "test_db": name})
+        assert response.status_code == HTTPStatus.BAD_REQUEST
+    assert (victim / "keep.txt").exists()
+
+
 def test_search_find_expected(client: TestClient) -> None:
     """Tests /similarity endpoint returns expected."""
     expected = "Spam and eggs is a delicious breakfast."
@@ -51,7 +78,7 @@ def test_search_find_expected(client: TestClient) -> None:
     )
     body = json.loads(res1.content)
     assert res1.status_code == HTTPStatus.OK
-    assert body[0] == expected
+    assert body[0]["text"] == expected
 
 
 def test_search_no_match(client: TestClient) -> None:
@@ -66,7 +93,7 @@ def test_search_no_match(client: TestClient) -> None:
 
     body = json.loads(res2.content)
     assert res2.status_code == HTTPStatus.OK
-    assert body[0] != "some text"
+    assert body[0]["text"] != "some text"
 
 
 @pytest.mark.asyncio
@@ -76,19 +103,19 @@ async def test_search_exception(mocker: MockerFixture, client: TestClient) -> No
     emb = await get_embedding(AsyncEmbeddingService(), expected)
 
     async_mock = mocker.patch(
-            "embedding_server.gibson.embedding.AsyncEmbeddingService.embed",
-            new_callable=AsyncMock,
-        )
+        "embedding_server.gibson.embedding.AsyncEmbeddingService.embed",
+        new_callable=AsyncMock,
+    )
 
     async_mock.side_effect = [emb] + [FlakyNetworkException()] * 6
 
     response = client.post(
-            "/similarity",
-            json={
-                "text": expected,
-                "test_db": "unit_test",
-            },
-        )
+        "/similarity",
+        json={
+            "text": expected,
+            "test_db": "unit_test",
+        },
+    )
     assert response.status_code == HTTPStatus.INTERNAL_SERVER_ERROR
 
 
@@ -99,9 +126,9 @@ async def test_search_retried(mocker: MockerFixture, client: TestClient) -> None
     emb = await AsyncEmbeddingService().embed(expected)
 
     async_mock = mocker.patch(
-            "embedding_server.gibson.embedding.AsyncEmbeddingService.embed",
-            new_callable=AsyncMock,
-        )
+        "embedding_server.gibson.embedding.AsyncEmbeddingService.embed",
+        new_callable=AsyncMock,
+    )
 
     async_mock.side_effect = [emb, FlakyNetworkException(), emb]
     res3 = client.post(
@@ -113,4 +140,124 @@ async def test_search_retried(mocker: MockerFixture, client: TestClient) -> None
     )
     body = json.loads(res3.content)
     assert res3.status_code == HTTPStatus.OK
-    assert body[0] == expected
+    assert body[0]["text"] == expected
+
+
+def test_search_stream(mocker: MockerFixture, client: TestClient) -> None:
+    """Tests /similarity returns its matches as NDJSON with IDs and scores."""
+    mocker.patch(
+        "embedding_server.gibson.embedding.AsyncEmbeddingService.embed",
+        new_callable=AsyncMock,
+        return_value=[1.0] * EMBEDDING_DIMENSIONS,
+    )
+    response = client.post(
+        "/similarity",
+        json={
+            "text": "Spam",
+            "top_k": 10,
+            "stream": True,
+            "test_db": "unit_test",
+        },
+    )
+
+    assert response.status_code == HTTPStatus.OK
+    assert response.headers["content-type"] == "application/x-ndjson"
+    [match] = [json.loads(line) for line in response.text.splitlines()]
+    assert match["text"] == "Spam"
+    assert match["id"] == text_id("Spam")
+    assert match["score"] == pytest.approx(1.0)
+
+
+def test_insert_batch(mocker: MockerFixture, client: TestClient) -> None:
+    """Tests /insert/batch embeds in upstream batches and reports every text."""
+
+    async def fake_batch(texts: list[str]) -> list[list[float]]:
+        return [[float(len(text))] * EMBEDDING_DIMENSIONS for text in texts]
+
+    embed_batch_mock = mocker.patch.object(
+        AsyncEmbeddingService, "embed_batch", side_effect=fake_batch
+    )
+    texts = [f"text {i}" for i in range(70)] + ["text 0"]
+    response = client.post(
+        "/insert/batch", json={"texts": texts, "test_db": "unit_test"}
+    )
+
+    assert response.status_code == HTTPStatus.OK
+    assert embed_batch_mock.call_count == 3
+    body = response.json()
+    assert body["inserted"] == 70
+    assert body["statuses"] == ["inserted"] * 70 + ["duplicate"]
+
+
+def test_upsert_and_delete(mocker: MockerFixture, client: TestClient) -> None:
+    """Tests /upsert embeds afresh, and /delete removes a row once.
+
+    Test databases are removed after each request, so removal is disabled
+    while rows inserted by one request are deleted by the next ones.
+    """
+    embed_mock = mocker.patch(
+        "embedding_server.gibson.embedding.AsyncEmbeddingService.embed",
+        new_callable=AsyncMock,
+        return_value=[1.0] * EMBEDDING_DIMENSIONS,
+    )
+    response = client.post("/upsert", json={"text": "Spam", "test_db": "unit_test"})
+    assert response.status_code == HTTPStatus.OK
+    assert response.json()["replaced"] is False
+    assert embed_mock.await_count == 1
+
+    response = client.post(
+        "/delete", json={"id": text_id("never stored"), "test_db": "unit_test"}
+    )
+    assert response.status_code == HTTPStatus.NOT_FOUND
+
+    mocker.patch.object(
+        AsyncEmbeddingService,
+        "embed_batch",
+        new_callable=AsyncMock,
+        side_effect=lambda texts: [[1.0] * EMBEDDING_DIMENSIONS for _ in texts],
+    )
+    remove = mocker.patch.object(BinaryStorage, "remove")
+    texts = [f"text {i}" for i in range(5)]
+    response = client.post(
+        "/insert/batch", json={"texts": texts, "test_db": "unit_test"}
+    )
+    assert response.json()["inserted"] == 5
+    for status in (HTTPStatus.OK, HTTPStatus.NOT_FOUND):
+        response = client.post(
+            "/delete", json={"id": text_id("text 2"), "test_db": "unit_test"}
+        )
+        assert response.status_code == status
+
+    mocker.stop(remove)
+    # A last request removes the test database again.
+    response = client.post("/delete", json={"id": "", "test_db": "unit_test"})
+    assert response.status_code == HTTPStatus.NOT_FOUND
+
+
+def test_metrics(mocker: MockerFixture, client: TestClient) -> None:
+    """Tests /metrics and Server-Timing report the timings of a search."""
+    assert client.get("/metrics").status_code == HTTPStatus.NOT_FOUND
+    mocker.patch.object(registry, "enabled", True)
+    mocker.patch("embedding_server.server.server_timing_enabled", True)
+    mocker.patch(
+        "embedding_server.gibson.embedding.AsyncEmbeddingService.embed",
+        new_callable=AsyncMock,
+        return_value=[1.0] * EMBEDDING_DIMENSIONS,
+    )
+    registry.reset()
+
+    response = client.post("/similarity", json={"text": "Spam", "test_db": "unit_test"})
+    metrics = client.get("/metrics")
+
+    assert response.status_code == HTTPStatus.OK
+    timings = response.headers["server-timing"].split(", ")
+    assert [timing.split(";")[0] for timing in timings] == [
+        "search_rank",
+        "search",
+        "total",
+    ]
+    assert metrics.status_code == HTTPStatus.OK
+    assert "search_seconds_count 1" in metrics.text
+    assert 'http_request_seconds_count{path="/similarity"} 1' in metrics.text
+    assert "database_write_seconds_count" in metrics.text
+    assert "database_rows " in metrics.text
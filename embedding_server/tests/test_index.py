@@ -0,0 +1,118 @@
+"""Tests the approximate nearest-neighbour index."""
+
+import logging
+import os
+from pathlib import Path
+from unittest.mock import AsyncMock
+
+import numpy as np
+import pytest
+from embedding_server.index import IVFIndex
+from embedding_server.quantization import ScalarQuantizedIndex
+from embedding_server.search import SearchEmbeddingService
+from embedding_server.similarity import top_k_indices
+from pytest_mock import MockerFixture
+
+from tests.conftest import clustered_vectors
+
+logging.basicConfig(level=logging.DEBUG if "DEBUG" in os.environ else logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def test_ivf_recall_against_exact() -> None:
+    """Tests IVF recall rises with nprobe and is exact when every list is probed."""
+    vectors = clustered_vectors(4050, clusters=32)
+    vectors, queries = vectors[:4000], vectors[4000:]
+    index = IVFIndex.train(vectors, nlist=32)
+    index.add(vectors, np.arange(len(vectors)))
+
+    def recall(nprobe: int) -> float:
+        found = 0
+        for query in queries:
+            expected = set(top_k_indices(vectors @ query, 10).tolist())
+            _, rows = index.search(query, 10, nprobe=nprobe)
+            found += len(expected & set(rows.tolist()))
+        return found / (10 * len(queries))
+
+    assert recall(4) >= 0.9
+    assert recall(32) == 1.0
+
+
+def test_ivf_save_load(tmp_path: Path) -> None:
+    """Tests a persisted index returns the same results after loading."""
+    vectors = clustered_vectors(500, clusters=8)
+    index = IVFIndex.train(vectors, nlist=8, nprobe=2)
+    index.add(vectors, np.arange(len(vectors)))
+    index.save(tmp_path / "index.npz")
+
+    loaded = IVFIndex.load(tmp_path / "index.npz", nprobe=2)
+
+    assert len(loaded) == len(index)
+    for query in vectors[:5]:
+        scores, rows = index.search(query, 5)
+        loaded_scores, loaded_rows = loaded.search(query, 5)
+        np.testing.assert_array_equal(rows, loaded_rows)
+        np.testing.assert_array_equal(scores, loaded_scores)
+
+
+def test_index_search_mask() -> None:
+    """Tests masked index searches score only the flagged rows."""
+    vectors = clustered_vectors(500, clusters=8)
+    mask = np.arange(len(vectors)) % 5 == 0
+    ivf = IVFIndex.train(vectors, nlist=8, nprobe=8)
+    ivf.add(vectors, np.arange(len(vectors)))
+    scalar = ScalarQuantizedIndex.train(vectors)
+    scalar.add(vectors, np.arange(len(vectors)))
+
+    for query in vectors[:5]:
+        expected = np.flatnonzero(mask)[top_k_indices(vectors[mask] @ query, 5)]
+        _, rows = ivf.search(query, 5, mask=mask)
+        np.testing.assert_array_equal(rows, expected)
+        _, rows = scalar.search(query, 20, mask=mask)
+        assert mask[rows].all()
+        assert set(expected[:3]) <= set(rows.tolist())
+
+
+def test_index_search_stop() -> None:
+    """Tests index searches skip the rows added after a snapshot was taken."""
+    vectors = clustered_vectors(400, clusters=8)
+    ivf = IVFIndex.train(vectors, nlist=8, nprobe=8)
+    ivf.add(vectors, np.arange(len(vectors)))
+    scalar = ScalarQuantizedIndex.train(vectors)
+    scalar.add(vectors, np.arange(len(vectors)))
+
+    for query in vectors[350:355]:
+        for index in (ivf, scalar):
+            _, rows = index.search(query, 100, stop=300)
+            assert len(rows) == 100
+            assert rows.max() < 300
+
+
+@pytest.mark.asyncio
+async def test_search_service_ivf(mocker: MockerFixture, tmp_path: Path) -> None:
+    """Tests the service trains, persists and incrementally extends its index."""
+    vectors = clustered_vectors(300, clusters=8)
+    mocker.patch(
+        "embedding_server.gibson.embedding.AsyncEmbeddingService.embed",
+        new_callable=AsyncMock,
+        return_value=vectors[-1].tolist(),
+    )
+    service = SearchEmbeddingService(
+        tmp_path / "db", index="ivf", nlist=8, nprobe=8, min_index_rows=200
+    )
+    await service.setup()
+    await service.insert_many(
+        texts=[f"text {i}" for i in range(250)], embeddings=vectors[:250].tolist()
+    )
+    assert service.index is not None
+    assert service.index_path.exists()
+
+    reloaded = SearchEmbeddingService(tmp_path / "db", index="ivf", nprobe=8)
+    await reloaded.setup()
+    for i in range(250, 300):
+        await reloaded.insert(text=f"text {i}", embeddings=vectors[i].tolist())
+
+    assert reloaded.index is not None
+    assert len(reloaded.index) == len(reloaded.vectors) == 300
+    expected = [f"text {i}" for i in top_k_indices(vectors @ vectors[-1], 5)]
+    assert await reloaded.find_similar_embeddings("query") == expected
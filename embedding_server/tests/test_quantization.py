@@ -0,0 +1,154 @@
+"""Tests the quantized vector indexes."""
+
+import logging
+import os
+from pathlib import Path
+from unittest.mock import AsyncMock
+
+import numpy as np
+import numpy.typing as npt
+import pytest
+from embedding_server.quantization import (
+    ProductQuantizedIndex,
+    ProjectedIndex,
+    QuantizedIndex,
+    ScalarQuantizedIndex,
+)
+from embedding_server.search import SearchEmbeddingService
+from embedding_server.similarity import top_k_indices
+from pytest_mock import MockerFixture
+
+from tests.conftest import clustered_vectors
+
+logging.basicConfig(level=logging.DEBUG if "DEBUG" in os.environ else logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def _recall(
+    index: QuantizedIndex,
+    vectors: npt.NDArray[np.float32],
+    queries: npt.NDArray[np.float32],
+    candidates: int,
+) -> float:
+    """Returns the share of the exact top 10 found in the approximate candidates."""
+    found = 0
+    for query in queries:
+        expected = set(top_k_indices(vectors @ query, 10).tolist())
+        _, rows = index.search(query, candidates)
+        found += len(expected & set(rows.tolist()))
+    return found / (10 * len(queries))
+
+
+def test_quantized_recall_against_exact() -> None:
+    """Tests both quantizers shrink the vectors and keep the exact neighbours."""
+    vectors = clustered_vectors(2050, clusters=16)
+    vectors, queries = vectors[:2000], vectors[2000:]
+    scalar = ScalarQuantizedIndex.train(vectors)
+    scalar.add(vectors, np.arange(len(vectors)))
+    product = ProductQuantizedIndex.train(vectors, subspaces=96)
+    product.add(vectors, np.arange(len(vectors)))
+
+    assert scalar.nbytes * 4 == vectors.nbytes
+    assert product.nbytes * 32 == vectors.nbytes
+    assert _recall(scalar, vectors, queries, 10) >= 0.9
+    assert _recall(product, vectors, queries, 100) >= 0.95
+
+
+def test_projected_recall_against_exact() -> None:
+    """Tests the principal components keep the exact neighbours among few candidates."""
+    vectors = clustered_vectors(2050, clusters=16)
+    vectors, queries = vectors[:2000], vectors[2000:]
+    projected = ProjectedIndex.train(vectors, components=96)
+    projected.add(vectors, np.arange(len(vectors)))
+
+    assert projected.nbytes * 8 == vectors.nbytes
+    assert _recall(projected, vectors, queries, 100) >= 0.95
+
+
+def test_quantized_save_load(tmp_path: Path) -> None:
+    """Tests a persisted index returns the same results after loading."""
+    vectors = clustered_vectors(300, clusters=4)
+    for index in (
+        ScalarQuantizedIndex.train(vectors),
+        ProductQuantizedIndex.train(vectors, subspaces=48),
+        ProjectedIndex.train(vectors, components=32),
+    ):
+        index.add(vectors, np.arange(len(vectors)))
+        index.save(tmp_path / "index.npz")
+
+        loaded = type(index).load(tmp_path / "index.npz")
+
+        assert len(loaded) == len(index)
+        scores, rows = index.search(vectors[0], 5)
+        loaded_scores, loaded_rows = loaded.search(vectors[0], 5)
+        np.testing.assert_array_equal(rows, loaded_rows)
+        np.testing.assert_array_equal(scores, loaded_scores)
+
+
+@pytest.mark.asyncio
+async def test_search_service_pq_rerank(mocker: MockerFixture, tmp_path: Path) -> None:
+    """Tests re-ranking the PQ candidates returns the exact results and scores."""
+    vectors = clustered_vectors(300, clusters=8)
+    mocker.patch(
+        "embedding_server.gibson.embedding.AsyncEmbeddingService.embed",
+        new_callable=AsyncMock,
+        return_value=vectors[-1].tolist(),
+    )
+    service = SearchEmbeddingService(
+        tmp_path / "db", index="pq", subspaces=48, rerank=8, min_index_rows=200
+    )
+    await service.setup()
+    await service.insert_many(
+        texts=[f"text {i}" for i in range(300)], embeddings=vectors.tolist()
+    )
+
+    assert isinstance(service.index, ProductQuantizedIndex)
+    assert len(service.index) == 300
+    assert service.index_path.name == "db.pq.npz"
+    expected = top_k_indices(vectors @ vectors[-1], 5)
+    assert await service.find_similar_embeddings("query") == [
+        f"text {i}" for i in expected
+    ]
+    [matches] = await service.search_vectors(vectors[-1:], 5)
+    np.testing.assert_allclose(
+        [match.score for match in matches], vectors[expected] @ vectors[-1], rtol=1e-5
+    )
+
+
+@pytest.mark.asyncio
+async def test_stale_index_retrained(mocker: MockerFixture, tmp_path: Path) -> None:
+    """Tests an index saved before a JSON rewrite renumbered the rows is retrained.
+
+    The index is not saved again after the delete, as if the process was
+    killed, so the file on disk still numbers the rows before the rewrite.
+    """
+    vectors = clustered_vectors(102, clusters=8)
+    mocker.patch(
+        "embedding_server.gibson.embedding.AsyncEmbeddingService.embed",
+        new_callable=AsyncMock,
+        return_value=vectors[50].tolist(),
+    )
+    service = SearchEmbeddingService(
+        tmp_path / "db.json",
+        index="int8",
+        rerank=0,
+        min_index_rows=64,
+        compact_threshold=None,
+    )
+    await service.setup()
+    await service.insert_many(
+        texts=[f"text {i}" for i in range(100)], embeddings=vectors[:100].tolist()
+    )
+    assert service.index_path.exists()
+    await service.delete(service.records.ids[0])
+    for i in (100, 101):
+        await service.insert(text=f"text {i}", embeddings=vectors[i].tolist())
+
+    reloaded = SearchEmbeddingService(
+        tmp_path / "db.json", index="int8", rerank=0, min_index_rows=64
+    )
+    await reloaded.setup()
+    assert reloaded.index is not None
+    assert len(reloaded.index) == len(reloaded.vectors) == 101
+    [best] = await reloaded.find_similar_embeddings("query", top_k=1)
+    assert best == "text 50"
@@ -0,0 +1,304 @@
+"""Tests the similarity search engine."""
+
+import logging
+import os
+from pathlib import Path
+from unittest.mock import AsyncMock
+
+import numpy as np
+import pytest
+from embedding_server.cache import ResultCache
+from embedding_server.gibson.database import text_id
+from embedding_server.search import SearchEmbeddingService
+from embedding_server.similarity import top_k_indices
+from pytest_mock import MockerFixture
+
+from tests.conftest import random_embeddings
+
+logging.basicConfig(level=logging.DEBUG if "DEBUG" in os.environ else logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def _reference_ranking(embeddings: list[list[float]], query: list[float]) -> list[int]:
+    """Ranks embeddings by cosine similarity using float64 brute force."""
+    matrix = np.asarray(embeddings)
+    vector = np.asarray(query)
+    scores = matrix @ vector / (np.linalg.norm(matrix, axis=1) * np.linalg.norm(vector))
+    return np.argsort(-scores).tolist()  # type: ignore
+
+
+@pytest.mark.asyncio
+async def test_find_similar_matches_reference(
+    mocker: MockerFixture, tmp_path: Path
+) -> None:
+    """Tests the vectorized search ranks rows exactly like a brute-force scan."""
+    embeddings = random_embeddings(50)
+    query = random_embeddings(1, seed=1)[0]
+    mocker.patch(
+        "embedding_server.gibson.embedding.AsyncEmbeddingService.embed",
+        new_callable=AsyncMock,
+        return_value=query,
+    )
+
+    service = SearchEmbeddingService(tmp_path / "search.json")
+    await service.setup()
+    for i, embedding in enumerate(embeddings[:30]):
+        await service.insert(text=f"text {i}", embeddings=embedding)
+
+    # Reload from disk so the matrix is built from the persisted rows.
+    service = SearchEmbeddingService(tmp_path / "search.json")
+    await service.setup()
+    for i, embedding in enumerate(embeddings[30:], start=30):
+        await service.insert(text=f"text {i}", embeddings=embedding)
+
+    expected = [f"text {i}" for i in _reference_ranking(embeddings, query)]
+    assert await service.find_similar_embeddings("query", top_k=5) == expected[:5]
+    assert await service.find_similar_embeddings("query", top_k=100) == expected
+
+
+@pytest.mark.asyncio
+async def test_find_similar_mmap(mocker: MockerFixture, tmp_path: Path) -> None:
+    """Tests search over a memory-mapped database with rows added after startup."""
+    embeddings = random_embeddings(20)
+    query = random_embeddings(1, seed=1)[0]
+    mocker.patch(
+        "embedding_server.gibson.embedding.AsyncEmbeddingService.embed",
+        new_callable=AsyncMock,
+        return_value=query,
+    )
+
+    service = SearchEmbeddingService(tmp_path / "search")
+    await service.setup()
+    for i, embedding in enumerate(embeddings[:10]):
+        await service.insert(text=f"text {i}", embeddings=embedding)
+
+    service = SearchEmbeddingService(tmp_path / "search", mmap=True)
+    await service.setup()
+    await service.find_similar_embeddings("query")
+    for i, embedding in enumerate(embeddings[10:], start=10):
+        await service.insert(text=f"text {i}", embeddings=embedding)
+
+    expected = [f"text {i}" for i in _reference_ranking(embeddings, query)]
+    assert await service.find_similar_embeddings("query", top_k=20) == expected
+
+
+@pytest.mark.asyncio
+async def test_find_similar_batch(mocker: MockerFixture, tmp_path: Path) -> None:
+    """Tests a batch of queries is embedded once and ranked like single queries."""
+    embeddings = random_embeddings(40)
+    queries = random_embeddings(3, seed=1)
+    embed_batch_mock = mocker.patch(
+        "embedding_server.gibson.embedding.AsyncEmbeddingService.embed_batch",
+        new_callable=AsyncMock,
+        return_value=queries,
+    )
+
+    service = SearchEmbeddingService(tmp_path / "search")
+    await service.setup()
+    await service.insert_many(
+        texts=[f"text {i}" for i in range(40)], embeddings=embeddings
+    )
+    results = await service.find_similar_batch(["a", "b", "c"], top_k=4)
+
+    embed_batch_mock.assert_awaited_once()
+    for query, matches in zip(queries, results, strict=True):
+        expected = [f"text {i}" for i in _reference_ranking(embeddings, query)[:4]]
+        assert [match.text for match in matches] == expected
+        assert [match.score for match in matches] == sorted(
+            (match.score for match in matches), reverse=True
+        )
+
+
+@pytest.mark.asyncio
+async def test_find_similar_pages(mocker: MockerFixture, tmp_path: Path) -> None:
+    """Tests pages of matches follow the full ranking and stop at min_score."""
+    embeddings = random_embeddings(30)
+    query = random_embeddings(1, seed=1)[0]
+    mocker.patch(
+        "embedding_server.gibson.embedding.AsyncEmbeddingService.embed",
+        new_callable=AsyncMock,
+        return_value=query,
+    )
+    service = SearchEmbeddingService(tmp_path / "search")
+    await service.setup()
+    await service.insert_many(
+        texts=[f"text {i}" for i in range(30)], embeddings=embeddings
+    )
+
+    ranking = await service.find_similar("query", top_k=30)
+    pages = [
+        await service.find_similar("query", top_k=7, offset=offset)
+        for offset in range(0, 30, 7)
+    ]
+    threshold = ranking[9].score
+
+    assert [match.text for match in ranking] == [
+        f"text {i}" for i in _reference_ranking(embeddings, query)
+    ]
+    assert [match for page in pages for match in page] == ranking
+    assert (
+        await service.find_similar("query", top_k=30, min_score=threshold)
+        == (ranking[:10])
+    )
+
+
+@pytest.mark.asyncio
+async def test_find_similar_filters(mocker: MockerFixture, tmp_path: Path) -> None:
+    """Tests filtered searches rank only the rows whose stored metadata matches."""
+    embeddings = random_embeddings(60)
+    query = random_embeddings(1, seed=1)[0]
+    mocker.patch(
+        "embedding_server.gibson.embedding.AsyncEmbeddingService.embed",
+        new_callable=AsyncMock,
+        return_value=query,
+    )
+    metadata = [{"tenant": f"t{i % 3}", "even": i % 2 == 0} for i in range(60)]
+    service = SearchEmbeddingService(tmp_path / "search")
+    await service.setup()
+    await service.insert_many(
+        texts=[f"text {i}" for i in range(40)],
+        embeddings=embeddings[:40],
+        metadata=metadata[:40],
+    )
+
+    # Reload from disk so the metadata index is rebuilt from the stored rows.
+    service = SearchEmbeddingService(tmp_path / "search")
+    await service.setup()
+    for i in range(40, 60):
+        await service.insert(
+            text=f"text {i}", embeddings=embeddings[i], metadata=metadata[i]
+        )
+
+    ranking = _reference_ranking(embeddings, query)
+    for filters in (
+        {"tenant": "t1"},
+        {"tenant": ["t0", "t2"], "even": True},
+        {"tenant": "t9"},
+    ):
+        expected = [
+            f"text {i}"
+            for i in ranking
+            if all(
+                metadata[i][field] in (value if isinstance(value, list) else [value])
+                for field, value in filters.items()
+            )
+        ]
+        assert (
+            await service.find_similar_embeddings("query", top_k=60, filters=filters)
+            == expected
+        )
+    assert service.get(text_id("text 7")).metadata == metadata[7]  # type: ignore
+    with pytest.raises(ValueError, match="Metadata"):
+        await service.insert(
+            text="nested",
+            embeddings=query,
+            metadata={"tags": ["a"]},  # type: ignore
+        )
+
+
+@pytest.mark.asyncio
+async def test_find_similar_result_cache(mocker: MockerFixture, tmp_path: Path) -> None:
+    """Tests repeated searches are served from the cache until rows change."""
+    embeddings = random_embeddings(21)
+    query = random_embeddings(1, seed=1)[0]
+    embed_mock = mocker.patch(
+        "embedding_server.gibson.embedding.AsyncEmbeddingService.embed",
+        new_callable=AsyncMock,
+        return_value=query,
+    )
+    service = SearchEmbeddingService(tmp_path / "search", result_cache=ResultCache())
+    await service.setup()
+    await service.insert_many(
+        texts=[f"text {i}" for i in range(20)], embeddings=embeddings[:20]
+    )
+
+    first = await service.find_similar("query", top_k=5)
+    assert await service.find_similar("query", top_k=5) == first
+    assert embed_mock.await_count == 1
+    await service.find_similar("query", top_k=6)
+    assert embed_mock.await_count == 2
+
+    await service.insert(text="text 20", embeddings=embeddings[20])
+    expected = [f"text {i}" for i in _reference_ranking(embeddings, query)[:5]]
+    assert await service.find_similar_embeddings("query", top_k=5) == expected
+    assert embed_mock.await_count == 3
+    assert service.result_cache.hits == 1  # type: ignore
+
+
+@pytest.mark.asyncio
+async def test_delete_and_upsert(mocker: MockerFixture, tmp_path: Path) -> None:
+    """Tests deleted and replaced rows leave searches and stay gone on reload."""
+    embeddings = random_embeddings(21)
+    query = embeddings[3]
+    mocker.patch(
+        "embedding_server.gibson.embedding.AsyncEmbeddingService.embed",
+        new_callable=AsyncMock,
+        return_value=query,
+    )
+    service = SearchEmbeddingService(tmp_path / "search", compact_threshold=None)
+    await service.setup()
+    await service.insert_many(
+        texts=[f"text {i}" for i in range(20)], embeddings=embeddings[:20]
+    )
+
+    assert await service.delete(text_id("text 3"))
+    assert not await service.delete(text_id("text 3"))
+    assert not await service.upsert(text="text 20", embeddings=embeddings[20])
+    assert await service.upsert(text="text 5", embeddings=query)
+
+    others = [
+        f"text {i}"
+        for i in _reference_ranking(embeddings[:20], query)
+        if i not in (3, 5)
+    ]
+    expected = ["text 5", *others[:3]]
+    assert await service.find_similar_embeddings("query", top_k=4) == expected
+    assert len(service) == 20
+    assert service.get(text_id("text 3")) is None
+
+    reloaded = SearchEmbeddingService(tmp_path / "search")
+    await reloaded.setup()
+    assert await reloaded.find_similar_embeddings("query", top_k=4) == expected
+    assert reloaded.records.dead == 2
+
+
+@pytest.mark.asyncio
+async def test_compaction(mocker: MockerFixture, tmp_path: Path) -> None:
+    """Tests compaction reclaims dead rows and retrains the index on the rest."""
+    embeddings = random_embeddings(40)
+    mocker.patch(
+        "embedding_server.gibson.embedding.AsyncEmbeddingService.embed",
+        new_callable=AsyncMock,
+        return_value=embeddings[0],
+    )
+    service = SearchEmbeddingService(
+        tmp_path / "search", index="ivf", min_index_rows=16, compact_threshold=0.25
+    )
+    await service.setup()
+    await service.insert_many(
+        texts=[f"text {i}" for i in range(40)], embeddings=embeddings
+    )
+    old_index = service.index
+    for i in range(1, 12):
+        await service.delete(text_id(f"text {i}"))
+    assert service._compaction is not None
+    await service._compaction
+
+    assert len(service.records) == len(service.vectors) == 29
+    assert service.records.dead == 0
+    assert service.index is not old_index and len(service.index) == 29  # type: ignore
+    assert not service.storage.tombstones_path.exists()  # type: ignore
+    results = await service.find_similar_embeddings("query", top_k=40)
+    assert sorted(results) == sorted(
+        [f"text {i}" for i in range(40) if not 1 <= i < 12]
+    )
+
+
+def test_top_k_indices() -> None:
+    """Tests partial top-k selection returns the best indices in order."""
+    scores = np.array([0.1, 0.9, -0.4, 0.5, 0.7], dtype=np.float32)
+    assert top_k_indices(scores, 3).tolist() == [1, 4, 3]
+    assert top_k_indices(scores, 10).tolist() == [1, 4, 3, 0, 2]
+    assert top_k_indices(scores, 0).tolist() == []
+    matrix = np.stack([scores, -scores])
+    assert top_k_indices(matrix, 2).tolist() == [[1, 4], [2, 0]]
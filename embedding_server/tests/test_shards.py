@@ -0,0 +1,121 @@
+"""Tests the sharded search service and remote shards."""
+
+import asyncio
+import logging
+import os
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client
+from pathlib import Path
+
+import pytest
+from embedding_server.gibson.database import InsertStatus
+from embedding_server.search import SearchEmbeddingService
+from embedding_server.shards import (
+    RemoteShard,
+    Shard,
+    ShardedSearchService,
+    serve_shard,
+)
+from embedding_server.similarity import normalize
+
+from tests.conftest import random_embeddings
+
+logging.basicConfig(level=logging.DEBUG if "DEBUG" in os.environ else logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+@pytest.mark.asyncio
+async def test_sharded_search_matches_single_database(tmp_path: Path) -> None:
+    """Tests merged shard results equal the results of one unsharded database."""
+    embeddings = random_embeddings(200)
+    texts = [f"text {i}" for i in range(200)]
+    queries = normalize(random_embeddings(3, seed=1))
+
+    single = SearchEmbeddingService(tmp_path / "single")
+    await single.setup()
+    await single.insert_many(texts=texts, embeddings=embeddings)
+    with pytest.raises(ValueError, match="directory"):
+        ShardedSearchService.local(tmp_path / "sharded.json", shards=4)
+    sharded = ShardedSearchService.local(tmp_path / "sharded", shards=4)
+    await sharded.setup()
+    assert await sharded.insert_many(texts=texts, embeddings=embeddings) == 200
+    with pytest.raises(ValueError, match="already exists"):
+        await sharded.insert(text="text 7", embeddings=embeddings[7])
+    assert await sharded.insert_batch(
+        texts=["text 3", "new", "new", "text 9"],
+        embeddings=[embeddings[3], embeddings[0], embeddings[0], embeddings[9][:10]],
+    ) == [
+        InsertStatus.EXISTS,
+        InsertStatus.INSERTED,
+        InsertStatus.DUPLICATE,
+        InsertStatus.INVALID,
+    ]
+
+    sizes = [len(shard) for shard in sharded.shards]  # type: ignore
+    assert sum(sizes) == 201
+    assert all(size > 0 for size in sizes)
+    await single.insert(text="new", embeddings=embeddings[0])
+    expected = await single.search_vectors(queries, top_k=10)
+    actual = await sharded.search_vectors(queries, top_k=10)
+    for expected_matches, actual_matches in zip(expected, actual, strict=True):
+        assert [match.id for match in actual_matches] == [
+            match.id for match in expected_matches
+        ]
+
+
+@pytest.mark.asyncio
+async def test_remote_shards(tmp_path: Path) -> None:
+    """Tests a sharded service reaches shard servers over local RPC."""
+    embeddings = random_embeddings(50)
+    texts = [f"text {i}" for i in range(50)]
+    addresses = [str(tmp_path / f"shard-{i}.sock") for i in range(2)]
+    servers = [
+        asyncio.create_task(
+            serve_shard(address, tmp_path / f"shard-{i}", authkey=b"secret")
+        )
+        for i, address in enumerate(addresses)
+    ]
+    while not all(Path(address).exists() for address in addresses):
+        await asyncio.sleep(0.01)
+
+    shards = [RemoteShard(address, authkey=b"secret") for address in addresses]
+    service = ShardedSearchService(list[Shard](shards))
+    try:
+        await service.setup()
+        assert await service.insert_many(texts=texts, embeddings=embeddings) == 50
+        with pytest.raises(ValueError, match="already exists"):
+            await service.insert(text="text 3", embeddings=embeddings[3])
+        [matches] = await service.search_vectors(normalize([embeddings[3]]), top_k=3)
+        assert matches[0].text == "text 3"
+        assert len(matches) == 3
+    finally:
+        for shard in shards:
+            shard.close()
+        for server in servers:
+            server.cancel()
+        await asyncio.gather(*servers, return_exceptions=True)
+
+
+@pytest.mark.asyncio
+async def test_shard_server_survives_bad_clients(tmp_path: Path) -> None:
+    """Tests a client with the wrong key does not stop the server accepting."""
+    address = str(tmp_path / "shard.sock")
+    server = asyncio.create_task(
+        serve_shard(address, tmp_path / "shard", authkey=b"secret")
+    )
+    while not Path(address).exists():
+        await asyncio.sleep(0.01)
+
+    shard = RemoteShard(address, authkey=b"secret")
+    try:
+        with pytest.raises(AuthenticationError):
+            await asyncio.to_thread(Client, address, authkey=b"wrong")
+        await shard.setup()
+        embeddings = random_embeddings(1)
+        assert await shard.insert_many(texts=["text 0"], embeddings=embeddings) == 1
+        with pytest.raises(ValueError, match="already exists"):
+            await shard.insert(text="text 0", embeddings=embeddings[0])
+    finally:
+        shard.close()
+        server.cancel()
+        await asyncio.gather(server, return_exceptions=True)
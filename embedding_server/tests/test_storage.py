@@ -0,0 +1,282 @@
+"""Tests the database storage backends."""
+
+import asyncio
+import logging
+import os
+from pathlib import Path
+
+import numpy as np
+import pytest
+from embedding_server.gibson import storage as storage_module
+from embedding_server.gibson.database import (
+    EMBEDDING_DIMENSIONS,
+    AsyncEmbeddingDatabase,
+    text_id,
+)
+from embedding_server.gibson.storage import BinaryStorage, JsonStorage, WalStorage
+from embedding_server.gibson.vectors import VectorStore
+from pytest_mock import MockerFixture
+
+from tests.conftest import random_embeddings
+
+logging.basicConfig(level=logging.DEBUG if "DEBUG" in os.environ else logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+@pytest.mark.asyncio
+async def test_binary_storage_appends_rows(tmp_path: Path) -> None:
+    """Tests inserts append single rows and survive a reload."""
+    embeddings = random_embeddings(5)
+    database = AsyncEmbeddingDatabase(tmp_path / "db")
+    await database.setup()
+    assert isinstance(database.storage, BinaryStorage)
+
+    for i, embedding in enumerate(embeddings):
+        await database.insert(text=f"text {i}", embeddings=embedding)
+        size = database.storage.vectors_path.stat().st_size
+        assert size == (i + 1) * EMBEDDING_DIMENSIONS * 4
+
+    reloaded = AsyncEmbeddingDatabase(tmp_path / "db")
+    await reloaded.setup()
+    assert reloaded.data["Text"].tolist() == [f"text {i}" for i in range(5)]
+    np.testing.assert_array_equal(
+        reloaded.vectors.to_array(), np.asarray(embeddings, dtype=np.float32)
+    )
+
+
+def test_vector_store_range_across_segments() -> None:
+    """Tests row ranges are copied correctly from the base and tail segments."""
+    rows = np.arange(15 * 4, dtype=np.float32).reshape(15, 4)
+    vectors = VectorStore(4, base=rows[:10])
+    vectors.append(rows[10:])
+
+    for start, stop in [(2, 8), (0, 10), (8, 12), (10, 15), (12, 13), (3, None)]:
+        np.testing.assert_array_equal(vectors.to_array(start, stop), rows[start:stop])
+    assert vectors.to_array(5, 5).shape == (0, 4)
+
+
+@pytest.mark.asyncio
+async def test_binary_storage_repairs_partial_row(tmp_path: Path) -> None:
+    """Tests a torn trailing write is dropped instead of corrupting the store."""
+    database = AsyncEmbeddingDatabase(tmp_path / "db")
+    await database.setup()
+    for i, embedding in enumerate(random_embeddings(3)):
+        await database.insert(text=f"text {i}", embeddings=embedding)
+    storage = database.storage
+    assert isinstance(storage, BinaryStorage)
+    with Path.open(storage.vectors_path, "ab") as file:
+        file.write(b"\x00" * 100)
+
+    reloaded = AsyncEmbeddingDatabase(tmp_path / "db")
+    await reloaded.setup()
+    assert len(reloaded.data) == len(reloaded.vectors) == 3
+    assert storage.vectors_path.stat().st_size == 3 * EMBEDDING_DIMENSIONS * 4
+
+
+@pytest.mark.asyncio
+async def test_json_export_import_round_trip(tmp_path: Path) -> None:
+    """Tests JSON remains usable as an exchange format for binary databases."""
+    embeddings = random_embeddings(4)
+    source = AsyncEmbeddingDatabase(tmp_path / "source.json")
+    await source.setup()
+    assert isinstance(source.storage, JsonStorage)
+    for i, embedding in enumerate(embeddings):
+        await source.insert(text=f"text {i}", embeddings=embedding)
+
+    target = AsyncEmbeddingDatabase(tmp_path / "target")
+    await target.setup()
+    await target.insert(text="text 0", embeddings=embeddings[0])
+    assert await target.import_json(tmp_path / "source.json") == 3
+
+    await target.export_json(tmp_path / "export.json")
+    exported = AsyncEmbeddingDatabase(tmp_path / "export.json")
+    await exported.setup()
+    assert exported.data["Text"].tolist() == [f"text {i}" for i in range(4)]
+    np.testing.assert_array_equal(
+        exported.vectors.to_array(), np.asarray(embeddings, dtype=np.float32)
+    )
+
+
+@pytest.mark.asyncio
+async def test_binary_storage_mmap(tmp_path: Path) -> None:
+    """Tests mmap mode maps stored vectors and keeps new rows in memory."""
+    embeddings = random_embeddings(4)
+    database = AsyncEmbeddingDatabase(tmp_path / "db")
+    await database.setup()
+    for i, embedding in enumerate(embeddings[:3]):
+        await database.insert(text=f"text {i}", embeddings=embedding)
+
+    mapped = AsyncEmbeddingDatabase(tmp_path / "db", mmap=True)
+    await mapped.setup()
+    base = mapped.vectors.segments()[0]
+    assert isinstance(base, np.memmap)
+    assert not base.flags.writeable
+
+    await mapped.insert(text="text 3", embeddings=embeddings[3])
+    assert len(mapped.vectors) == 4
+    np.testing.assert_array_equal(
+        mapped.vectors.row(3), np.asarray(embeddings[3], dtype=np.float32)
+    )
+
+    reloaded = AsyncEmbeddingDatabase(tmp_path / "db", mmap=True)
+    await reloaded.setup()
+    np.testing.assert_array_equal(
+        reloaded.vectors.to_array(), np.asarray(embeddings, dtype=np.float32)
+    )
+
+
+@pytest.mark.asyncio
+async def test_binary_storage_interrupted_save(
+    mocker: MockerFixture, tmp_path: Path
+) -> None:
+    """Tests a compaction that dies halfway leaves the previous rows intact."""
+    embeddings = random_embeddings(4)
+    database = AsyncEmbeddingDatabase(tmp_path / "db", compact_threshold=None)
+    await database.setup()
+    for i, embedding in enumerate(embeddings):
+        await database.insert(text=f"text {i}", embeddings=embedding)
+    await database.delete(text_id("text 0"))
+
+    write_durably = storage_module._write_durably
+    calls = 0
+
+    def fail_second_write(target: Path, content: bytes) -> None:
+        nonlocal calls
+        calls += 1
+        if calls == 2:
+            raise OSError("Disk gone")
+        write_durably(target, content)
+
+    mocker.patch.object(storage_module, "_write_durably", fail_second_write)
+    with pytest.raises(OSError, match="Disk gone"):
+        await database.compact()
+    mocker.stopall()
+
+    reloaded = AsyncEmbeddingDatabase(tmp_path / "db", compact_threshold=None)
+    await reloaded.setup()
+    assert reloaded.data["Text"].tolist() == ["text 1", "text 2", "text 3"]
+    for i in range(1, 4):
+        np.testing.assert_array_equal(
+            reloaded.embedding_for_id(text_id(f"text {i}")),
+            np.asarray(embeddings[i], dtype=np.float32),
+        )
+
+    assert await reloaded.compact() == 1
+    assert sorted(path.name for path in (tmp_path / "db").glob("*-*")) == [
+        "records-2.jsonl",
+        "vectors-2.f32",
+    ]
+
+
+@pytest.mark.asyncio
+async def test_remove_keeps_foreign_files(tmp_path: Path) -> None:
+    """Tests removing a database deletes only the files its backend writes."""
+    for wal in (False, True):
+        path = tmp_path / f"db-{wal}"
+        database = AsyncEmbeddingDatabase(path, wal=wal)
+        await database.setup()
+        await database.insert(text="text 0", embeddings=random_embeddings(1)[0])
+        (path / "notes.txt").write_text("keep")
+
+        database.storage.remove()
+        assert [file.name for file in path.iterdir()] == ["notes.txt"]
+        (path / "notes.txt").unlink()
+        database.storage.remove()
+        assert not path.exists()
+
+
+@pytest.mark.asyncio
+async def test_shared_database_between_processes(tmp_path: Path) -> None:
+    """Tests rows written through one shared database reach the other one.
+
+    Each database holds its own lock file descriptor, so two of them in one
+    process lock each other out like two processes would.
+    """
+    embeddings = random_embeddings(4)
+    first = AsyncEmbeddingDatabase(tmp_path / "db", mmap=True, shared=True)
+    second = AsyncEmbeddingDatabase(tmp_path / "db", mmap=True, shared=True)
+    await first.setup()
+    await second.setup()
+
+    await first.insert(text="text 0", embeddings=embeddings[0])
+    assert await second.refresh()
+    assert not await second.refresh()
+    assert second.records.texts == ["text 0"]
+
+    await second.insert(text="text 1", embeddings=embeddings[1])
+    await first.insert_many(texts=["text 1", "text 2"], embeddings=embeddings[1:3])
+    with pytest.raises(ValueError, match="already exists"):
+        await second.insert(text="text 2", embeddings=embeddings[2])
+    await first.refresh()
+
+    for database in (first, second):
+        assert database.records.texts == ["text 0", "text 1", "text 2"]
+        assert isinstance(database.vectors.segments()[0], np.memmap)
+        np.testing.assert_array_equal(
+            database.vectors.to_array(), np.asarray(embeddings[:3], dtype=np.float32)
+        )
+
+
+@pytest.mark.asyncio
+async def test_wal_group_commit_and_recovery(
+    mocker: MockerFixture, tmp_path: Path
+) -> None:
+    """Tests concurrent inserts share fsyncs and a torn log entry is dropped."""
+    embeddings = random_embeddings(8)
+    database = AsyncEmbeddingDatabase(tmp_path / "db", wal=True, flush_delay=0.01)
+    await database.setup()
+    assert isinstance(database.storage, WalStorage)
+    fsync = mocker.spy(os, "fsync")
+
+    await asyncio.gather(
+        *(
+            database.insert(text=f"text {i}", embeddings=embedding)
+            for i, embedding in enumerate(embeddings)
+        )
+    )
+    assert fsync.call_count < len(embeddings)
+    await database.delete(text_id("text 2"))
+    with Path.open(database.storage.log_path, "ab") as file:
+        file.write(b"\x40\x00\x00\x00torn")
+
+    recovered = AsyncEmbeddingDatabase(tmp_path / "db", wal=True)
+    await recovered.setup()
+    assert recovered.data["Text"].tolist() == [f"text {i}" for i in range(8) if i != 2]
+    np.testing.assert_array_equal(
+        recovered.vectors.to_array(), np.asarray(embeddings, dtype=np.float32)
+    )
+    await recovered.insert(text="text 8", embeddings=embeddings[0])
+
+    reloaded = AsyncEmbeddingDatabase(tmp_path / "db", wal=True)
+    await reloaded.setup()
+    assert len(reloaded) == 8
+
+
+@pytest.mark.asyncio
+async def test_wal_checkpoint(tmp_path: Path) -> None:
+    """Tests a checkpoint replaces the snapshot and log once the log is large."""
+    embeddings = random_embeddings(3)
+    storage = WalStorage(tmp_path / "db", EMBEDDING_DIMENSIONS, checkpoint_bytes=8192)
+    database = AsyncEmbeddingDatabase(
+        tmp_path / "db", storage=storage, compact_threshold=None
+    )
+    await database.setup()
+    for i, embedding in enumerate(embeddings[:2]):
+        await database.insert(text=f"text {i}", embeddings=embedding)
+    assert database._compaction is None
+
+    await database.insert(text="text 2", embeddings=embeddings[2])
+    assert database._compaction is not None
+    await database._compaction
+    assert storage.snapshot == 2
+    assert sorted(path.name for path in storage.path.glob("*-*")) == [
+        "snapshot-2.f32",
+        "snapshot-2.jsonl",
+        "wal-2.log",
+    ]
+
+    await database.delete(text_id("text 0"))
+    reloaded = AsyncEmbeddingDatabase(tmp_path / "db", wal=True)
+    await reloaded.setup()
+    assert reloaded.data["Text"].tolist() == ["text 1", "text 2"]
+    assert reloaded.records.dead == 1